@@ -0,0 +1,56 @@
+from accounts.services import UserService
+from django.conf import settings
+from django.core import signing
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """
+    无状态的 token 登录， 请求头: Authorization: Token <token>
+    token 是用 SECRET_KEY 做 HMAC 签名的 "user_id:时间戳"， 校验签名和是否过期都不需要访问数据库
+    user 再从 UserService 的 cache 中读取， 不会像 session 登录那样每个请求都要查一次 session 和 User
+    没有带 token 的请求会交给后面的 SessionAuthentication， browsable api 和 admin 依然使用 session
+    token 是无状态的， logout 或者修改密码都不会让已经签发的 token 失效， 只能等它过期（AUTH_TOKEN_MAX_AGE）
+    request.user 是 cache 中读出来的 CachedUser， 只有 UserService.get_users 中缓存的字段， 不能 save
+    需要修改当前用户的 view 要用 User.objects.get(id=request.user.id) 从数据库中重新读
+    """
+    keyword = 'Token'
+    # 不同用途的签名使用不同的 salt， 其他地方签名的数据不能被当作 token 使用
+    salt = 'accounts.api.authentication.SignedTokenAuthentication'
+
+    @classmethod
+    def get_signer(cls):
+        return signing.TimestampSigner(salt=cls.salt)
+
+    @classmethod
+    def create_token(cls, user):
+        return cls.get_signer().sign(str(user.id))
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed('Invalid token header.')
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed('Invalid token.')
+
+        try:
+            user_id = self.get_signer().unsign(token, max_age=settings.AUTH_TOKEN_MAX_AGE)
+        except signing.SignatureExpired:
+            raise AuthenticationFailed('Token has expired.')
+        except signing.BadSignature:
+            raise AuthenticationFailed('Invalid token.')
+
+        user = UserService.get_user(user_id)
+        if user is None:
+            raise AuthenticationFailed('User does not exist.')
+        # 和 session 登录一样， 被禁用的用户不能登录
+        if not user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        return user, token
+
+    # 没有定义 authenticate_header， 和 session 登录一样， 未登录或者 token 不合法的时候都返回 403
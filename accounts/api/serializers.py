@@ -1,12 +1,23 @@
+from accounts.services import UserService
 from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework import exceptions
 
 
 class UserSerializer(serializers.ModelSerializer):
+    # 关注数从 UserProfile 中读取（通常在 cache 中）， 不需要在 Friendship 上 COUNT(*)
+    followers_count = serializers.SerializerMethodField()
+    followings_count = serializers.SerializerMethodField()
+
     class Meta:
         model = User
-        fields = ('username', 'email', )
+        fields = ('username', 'email', 'followers_count', 'followings_count')
+
+    def get_followers_count(self, obj):
+        return UserService.get_profile(obj.id).followers_count
+
+    def get_followings_count(self, obj):
+        return UserService.get_profile(obj.id).followings_count
 
 
 class UserSerializerForTweet(serializers.ModelSerializer):
@@ -23,6 +34,10 @@ class UserSerializerForFriendship(UserSerializerForTweet):
     pass
 
 
+class UserSerializerForLike(UserSerializerForTweet):
+    pass
+
+
 class LoginSerializer(serializers.Serializer):
     # 验证username和password是否存在
     username = serializers.CharField()
@@ -1,3 +1,68 @@
-from django.test import TestCase
+from accounts.api.authentication import SignedTokenAuthentication
+from django.core import signing
+from django.test import override_settings
+from rest_framework.test import APIClient
+from testing.testcases import TestCase
 
-# Create your tests here.
+
+LOGIN_URL = '/api/accounts/login/'
+LOGIN_STATUS_URL = '/api/accounts/login_status/'
+NEWSFEEDS_URL = '/api/newsfeeds/'
+
+
+class SignedTokenAuthenticationTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu', password='correct password')
+
+    def get_client(self, token):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token {}'.format(token))
+        return client
+
+    def test_login_returns_token(self):
+        response = APIClient().post(LOGIN_URL, {
+            'username': 'linghu',
+            'password': 'correct password',
+        })
+        self.assertEqual(response.status_code, 200)
+        client = self.get_client(response.data['token'])
+        response = client.get(LOGIN_STATUS_URL)
+        self.assertEqual(response.data['has_logged_in'], True)
+        self.assertEqual(response.data['user']['username'], 'linghu')
+
+    def test_no_queries(self):
+        client = self.get_client(SignedTokenAuthentication.create_token(self.linghu))
+        client.get(LOGIN_STATUS_URL)
+        # 校验 token 不访问数据库， user 和 profile 都在 cache 中， 也没有查 session
+        with self.assertNumQueries(0):
+            response = client.get(LOGIN_STATUS_URL)
+        self.assertEqual(response.data['has_logged_in'], True)
+
+    def test_invalid_tokens(self):
+        token = SignedTokenAuthentication.create_token(self.linghu)
+        # 没有 token 依然可以访问不需要登录的 api， 需要登录的 api 和以前一样返回 403
+        response = APIClient().get(LOGIN_STATUS_URL)
+        self.assertEqual(response.data['has_logged_in'], False)
+        self.assertEqual(APIClient().get(NEWSFEEDS_URL).status_code, 403)
+        self.assertEqual(self.get_client(token).get(NEWSFEEDS_URL).status_code, 200)
+
+        # 被篡改过的 token
+        user_id, rest = token.split(':', 1)
+        forged = '{}:{}'.format(self.create_user('dongxie').id, rest)
+        self.assertEqual(self.get_client(forged).get(NEWSFEEDS_URL).status_code, 403)
+        self.assertEqual(self.get_client('abc').get(NEWSFEEDS_URL).status_code, 403)
+        # 其他地方签名的数据不能当作 token
+        other = signing.TimestampSigner().sign(str(self.linghu.id))
+        self.assertEqual(self.get_client(other).get(NEWSFEEDS_URL).status_code, 403)
+        # 过期的 token
+        with override_settings(AUTH_TOKEN_MAX_AGE=-1):
+            self.assertEqual(self.get_client(token).get(NEWSFEEDS_URL).status_code, 403)
+        # 被禁用的用户， user 已经在 cache 中了也一样
+        self.linghu.is_active = False
+        self.linghu.save()
+        self.assertEqual(self.get_client(token).get(NEWSFEEDS_URL).status_code, 403)
+        # 被删除的用户
+        self.linghu.delete()
+        self.assertEqual(self.get_client(token).get(NEWSFEEDS_URL).status_code, 403)
@@ -10,6 +10,7 @@ from rest_framework import viewsets
 from rest_framework import permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from accounts.api.authentication import SignedTokenAuthentication
 from accounts.api.serializers import (
     UserSerializer,
     LoginSerializer,
@@ -73,9 +74,11 @@ class AccountViewSet(viewsets.ViewSet):
                 "message": "Username or password does not match",
             }, status=400)
         django_login(request, user)
+        # 除了 session 之外也返回一个 token， 客户端可以通过 Authorization 请求头使用
         return Response({
             "success": True,
             "user": UserSerializer(instance=user).data,
+            "token": SignedTokenAuthentication.create_token(user),
         })
 
     @action(methods=["POST"], detail=False)
@@ -93,4 +96,5 @@ class AccountViewSet(viewsets.ViewSet):
         return Response({
             "success": True,
             "user": UserSerializer(instance=user).data,
+            "token": SignedTokenAuthentication.create_token(user),
         }, status=201)
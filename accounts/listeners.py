@@ -0,0 +1,13 @@
+def create_user_profile(sender, instance, created, **kwargs):
+    # 注册的时候就创建 profile， 之后 follow / unfollow 只需要 UPDATE
+    # 读 profile 的时候也总是能命中 ObjectCacheHelper， 不会因为 profile 不存在而每次都去查数据库
+    if not created:
+        return
+    # 在函数内部 import 避免循环依赖
+    from accounts.models import UserProfile
+    UserProfile.objects.get_or_create(user_id=instance.id)
+
+
+def invalidate_user_cache(sender, instance, **kwargs):
+    from accounts.services import UserService
+    UserService.invalidate_user(instance.id)
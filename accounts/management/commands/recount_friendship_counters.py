@@ -0,0 +1,76 @@
+from accounts.models import UserProfile
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F
+from friendships.models import Friendship
+from utils.object_cache import ObjectCacheHelper
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the denormalized followers_count / followings_count of every '
+        'user profile in batches of user ids, creating missing profiles.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of users recounted by each batch.',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        scanned, fixed = 0, 0
+        last_id = 0
+        while True:
+            user_ids = list(User.objects.filter(
+                id__gt=last_id,
+            ).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+            fixed += self.recount(user_ids)
+            scanned += len(user_ids)
+
+        self.stdout.write('{} users scanned, {} profiles fixed'.format(scanned, fixed))
+
+    def count(self, field, user_ids):
+        # 走 ('to_user', 'created_at') / ('from_user', 'created_at') 的联合索引
+        return {
+            row[field]: row['count']
+            for row in Friendship.objects.filter(**{
+                '{}__in'.format(field): user_ids,
+            }).values(field).annotate(count=Count('id')).order_by()
+        }
+
+    def recount(self, user_ids):
+        """
+        每个 batch 两次 GROUP BY 的 query 算出真实的关注数
+        只更新不一致的行， 而且是用 F() 加上差值， 不会覆盖掉遍历过程中发生的 follow / unfollow
+        """
+        # 没有 profile 的用户先创建一个全 0 的 profile
+        UserProfile.objects.bulk_create(
+            [UserProfile(user_id=user_id) for user_id in user_ids],
+            ignore_conflicts=True,
+        )
+        actual = {
+            'followers_count': self.count('to_user_id', user_ids),
+            'followings_count': self.count('from_user_id', user_ids),
+        }
+        fixed = 0
+        for row in UserProfile.objects.filter(user_id__in=user_ids).values(
+            'user_id', *actual.keys(),
+        ):
+            changes = {}
+            for field, counts in actual.items():
+                delta = counts.get(row['user_id'], 0) - row[field]
+                if delta:
+                    changes[field] = F(field) + delta
+            if not changes:
+                continue
+            UserProfile.objects.filter(user_id=row['user_id']).update(**changes)
+            ObjectCacheHelper.invalidate_cached_object(UserProfile, row['user_id'])
+            fixed += 1
+        return fixed
@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User
+from django.db import models
+from accounts.listeners import create_user_profile, invalidate_user_cache
+from django.db.models.signals import post_save, post_delete
+
+
+class UserProfile(models.Model):
+    # 直接用 user 作为主键， profile 的 id 就是 user 的 id， 可以按照 user_id 从 ObjectCacheHelper 中读取
+    # profile 只是 user 的附属数据， 跟着 user 一起删除不会有级联的多米诺效应
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    # 反范式化的关注数， 避免在 Friendship 上做 COUNT(*)
+    # 由 friendships.listeners 在 follow / unfollow 的时候用 F() 原子地更新
+    # 出现偏差的时候， 或者给这个表上线之前注册的用户补 profile， 都用 python manage.py recount_friendship_counters
+    followers_count = models.IntegerField(default=0)
+    followings_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.user_id}: {self.followers_count} followers, {self.followings_count} followings'
+
+
+class CachedUser(User):
+    """
+    UserService.get_users 从 cache 中构造出来的 User， 只有 cache 中存的那几个字段， password 是空的
+    和 AnonymousUser 一样不能 save / delete， 否则会用空的 password 和默认值覆盖掉数据库中的 User
+    需要修改 User 的时候用 User.objects.get 从数据库中重新读
+    """
+
+    class Meta:
+        proxy = True
+
+    def save(self, *args, **kwargs):
+        raise NotImplementedError('CachedUser is a partial User read from cache and cannot be saved.')
+
+    def delete(self, *args, **kwargs):
+        raise NotImplementedError('CachedUser is a partial User read from cache and cannot be deleted.')
+
+
+post_save.connect(invalidate_user_cache, sender=User)
+post_save.connect(create_user_profile, sender=User)
+post_delete.connect(invalidate_user_cache, sender=User)
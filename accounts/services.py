@@ -0,0 +1,122 @@
+from accounts.models import CachedUser, UserProfile
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from twitter.cache import USER_PATTERN
+from utils.object_cache import ObjectCacheHelper
+
+
+class UserService(object):
+
+    @classmethod
+    def get_user_key(cls, user_id):
+        return USER_PATTERN.format(user_id=user_id)
+
+    @classmethod
+    def get_users(cls, user_ids):
+        """
+        返回 {user_id: user}， 不存在的 user 不会出现在返回值中
+        cache 中只存 (id, username, email, is_active, is_staff, is_superuser) 这几个序列化、登录和权限检查需要的字段，
+        而不是 pickle 整个 User（也不会把 password 的 hash 放进 cache）， 返回的是只有这几个字段的 CachedUser， 不能 save
+        一次 cache 的 multi-get， miss 的部分再用一次 id__in 的 query
+        cache 中的字段有变化的时候要修改 USER_PATTERN 中的版本号， 否则会读到旧格式的数据
+        """
+        user_ids = {int(user_id) for user_id in user_ids if user_id is not None}
+        if not user_ids:
+            return {}
+        keys = {cls.get_user_key(user_id): user_id for user_id in user_ids}
+        rows = list(cache.get_many(keys.keys()).values())
+
+        missing_ids = user_ids - {row[0] for row in rows}
+        if missing_ids:
+            db_rows = list(User.objects.filter(id__in=missing_ids).order_by().values_list(
+                'id', 'username', 'email', 'is_active', 'is_staff', 'is_superuser',
+            ))
+            cache.set_many({cls.get_user_key(row[0]): row for row in db_rows})
+            rows.extend(db_rows)
+
+        return {
+            user_id: CachedUser(
+                id=user_id,
+                username=username,
+                email=email,
+                is_active=is_active,
+                is_staff=is_staff,
+                is_superuser=is_superuser,
+            )
+            for user_id, username, email, is_active, is_staff, is_superuser in rows
+        }
+
+    @classmethod
+    def get_user(cls, user_id):
+        return cls.get_users([user_id]).get(int(user_id))
+
+    @classmethod
+    def attach_users(cls, objects, *fields):
+        """
+        给 objects 批量挂上 user， fields 是外键的名字， 默认是 'user'
+        所有 objects 的所有 fields 一起只需要一次 get_users， 序列化的时候不会再去 query User
+        """
+        fields = fields or ('user',)
+        users = cls.get_users([
+            getattr(obj, field + '_id')
+            for obj in objects
+            for field in fields
+        ])
+        for obj in objects:
+            for field in fields:
+                setattr(obj, field, users.get(getattr(obj, field + '_id')))
+        return objects
+
+    @classmethod
+    def invalidate_user(cls, user_id):
+        cache.delete(cls.get_user_key(user_id))
+
+    @classmethod
+    def get_profile(cls, user_id):
+        # 注册时会创建 profile， 只有在 recount_friendship_counters 补齐之前的老用户没有， 返回一个没有保存的空 profile
+        profile = ObjectCacheHelper.get_object(UserProfile, user_id)
+        if profile is None:
+            profile = UserProfile(user_id=user_id)
+        return profile
+
+    @classmethod
+    def incr_friendship_counts(cls, from_user_id, to_user_id, delta):
+        # from_user 的 followings_count 和 to_user 的 followers_count 同时 +delta
+        cls._incr_profile(from_user_id, followings_count=F('followings_count') + delta)
+        cls._incr_profile(to_user_id, followers_count=F('followers_count') + delta)
+
+    @classmethod
+    def incr_bulk_friendship_counts(cls, from_user_id, to_user_ids):
+        # 批量关注之后 from_user 的 followings_count 只更新一次， 所有 to_users 的 followers_count 一条 UPDATE
+        if not to_user_ids:
+            return
+        cls._incr_profile(
+            from_user_id,
+            followings_count=F('followings_count') + len(to_user_ids),
+        )
+        # 还没有 profile 的老用户在这里会被跳过， 由 recount_friendship_counters 补齐
+        UserProfile.objects.filter(user_id__in=to_user_ids).update(
+            followers_count=F('followers_count') + 1,
+        )
+        keys = [ObjectCacheHelper.get_key(UserProfile, user_id) for user_id in to_user_ids]
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+    @classmethod
+    def _incr_profile(cls, user_id, **changes):
+        if user_id is None:
+            return
+        # 注册时已经创建了 profile， 只需要一条 UPDATE， 老用户第一次的时候才需要创建
+        if not UserProfile.objects.filter(user_id=user_id).update(**changes):
+            try:
+                # savepoint， 两个请求同时创建同一个 profile 的时候外层的 transaction 还可以继续使用
+                with transaction.atomic():
+                    UserProfile.objects.create(user_id=user_id)
+            except IntegrityError:
+                pass
+            UserProfile.objects.filter(user_id=user_id).update(**changes)
+        # 提交之后再让 cache 失效， 否则提交之前的读请求会把旧的计数重新写回 cache
+        transaction.on_commit(
+            lambda: ObjectCacheHelper.invalidate_cached_object(UserProfile, user_id),
+        )
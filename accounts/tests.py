@@ -0,0 +1,122 @@
+from accounts.models import UserProfile
+from accounts.services import UserService
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from friendships.models import Friendship
+from io import StringIO
+from rest_framework.test import APIClient
+from testing.testcases import TestCase
+
+
+LOGIN_STATUS_URL = '/api/accounts/login_status/'
+
+
+class UserProfileTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+
+    def test_friendship_counts(self):
+        # 注册的时候就有 profile
+        self.assertEqual(UserProfile.objects.count(), 2)
+
+        self.create_friendship(self.dongxie, self.linghu)
+        self.create_friendship(self.create_user('user0'), self.linghu)
+        self.assertEqual(UserService.get_profile(self.linghu.id).followers_count, 2)
+        self.assertEqual(UserService.get_profile(self.linghu.id).followings_count, 0)
+        self.assertEqual(UserService.get_profile(self.dongxie.id).followings_count, 1)
+
+        # 提交之后 cache 才会失效， 提交之前读到的还是旧的计数
+        with self.captureOnCommitCallbacks() as callbacks:
+            Friendship.objects.filter(from_user=self.dongxie).delete()
+        self.assertEqual(UserService.get_profile(self.linghu.id).followers_count, 2)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(UserService.get_profile(self.linghu.id).followers_count, 1)
+        self.assertEqual(UserService.get_profile(self.dongxie.id).followings_count, 0)
+
+        # 之后的读取都在 cache 中
+        with self.assertNumQueries(0):
+            UserService.get_profile(self.linghu.id)
+
+        client = APIClient()
+        client.force_authenticate(self.linghu)
+        response = client.get(LOGIN_STATUS_URL)
+        self.assertEqual(response.data['user']['followers_count'], 1)
+        self.assertEqual(response.data['user']['followings_count'], 0)
+
+    def test_recount_friendship_counters(self):
+        self.create_friendship(self.dongxie, self.linghu)
+        self.create_friendship(self.linghu, self.dongxie)
+        # 制造不一致的计数， 以及一个没有 profile 的老用户
+        UserProfile.objects.filter(user=self.linghu).update(followers_count=10)
+        UserProfile.objects.filter(user=self.dongxie).delete()
+        UserService.get_profile(self.linghu.id)
+
+        out = StringIO()
+        call_command('recount_friendship_counters', batch_size=1, stdout=out)
+        self.assertIn('2 users scanned, 2 profiles fixed', out.getvalue())
+        for user in [self.linghu, self.dongxie]:
+            profile = UserService.get_profile(user.id)
+            self.assertEqual(profile.followers_count, 1)
+            self.assertEqual(profile.followings_count, 1)
+
+        # 计数都正确的时候不会更新任何数据
+        out = StringIO()
+        call_command('recount_friendship_counters', stdout=out)
+        self.assertIn('0 profiles fixed', out.getvalue())
+
+
+class UserServiceTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        self.user_ids = [user.id for user in self.users]
+
+    def test_get_users(self):
+        # 一次 query 取出所有 cache miss 的 users， 不存在的 id 会被跳过
+        with self.assertNumQueries(1):
+            users = UserService.get_users(self.user_ids + [-1])
+        self.assertEqual(
+            {user_id: user.username for user_id, user in users.items()},
+            {user.id: user.username for user in self.users},
+        )
+        with self.assertNumQueries(0):
+            users = UserService.get_users(self.user_ids)
+        # cache 中只有序列化需要的字段
+        self.assertEqual(users[self.users[0].id].email, self.users[0].email)
+        self.assertEqual(users[self.users[0].id].password, '')
+        self.assertEqual(UserService.get_user(str(self.users[1].id)).username, 'user1')
+
+        # 权限检查需要的字段也在 cache 中， 但是只有部分字段的 user 不能 save， 否则会清空 password
+        self.users[2].is_staff = True
+        self.users[2].save()
+        cached_user = UserService.get_user(self.users[2].id)
+        self.assertEqual((cached_user.is_staff, cached_user.is_superuser), (True, False))
+        with self.assertRaises(NotImplementedError):
+            cached_user.save()
+        with self.assertRaises(NotImplementedError):
+            cached_user.delete()
+        self.assertNotEqual(User.objects.get(id=self.users[2].id).password, '')
+
+        # 修改之后 cache 失效
+        self.users[0].username = 'linghu'
+        self.users[0].save()
+        self.assertEqual(UserService.get_user(self.users[0].id).username, 'linghu')
+
+    def test_attach_users(self):
+        friendships = [
+            self.create_friendship(self.users[0], self.users[1]),
+            self.create_friendship(self.users[2], self.users[1]),
+        ]
+        friendships = list(Friendship.objects.filter(id__in=[f.id for f in friendships]))
+        # from_user 和 to_user 一起只需要一次 query
+        with self.assertNumQueries(1):
+            UserService.attach_users(friendships, 'from_user', 'to_user')
+            self.assertEqual(
+                [(f.from_user.username, f.to_user.username) for f in friendships],
+                [('user0', 'user1'), ('user2', 'user1')],
+            )
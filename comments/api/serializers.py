@@ -1,8 +1,9 @@
 from accounts.api.serializers import UserSerializerForComment
 from comments.models import Comment
+from likes.api.serializers import LikeSerializer
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
-from tweets.models import Tweet
+from tweets.services import TweetService
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -19,9 +20,18 @@ class CommentSerializer(serializers.ModelSerializer):
             'content',
             'created_at',
             'updated_at',
+            'likes_count',
         )
 
 
+class CommentSerializerWithLikes(CommentSerializer):
+    # tweet 详情页中的评论带上最新的几个点赞， 由 LikeService.attach_likes_preview 设置
+    likes = LikeSerializer(source='preview_likes', many=True)
+
+    class Meta(CommentSerializer.Meta):
+        fields = CommentSerializer.Meta.fields + ('likes',)
+
+
 class CommentSerializerForCreate(serializers.ModelSerializer):
     # 这两项必须手动添加
     # 因为默认 ModelSerializer里只会包含user和tweet而不是user_id 和tweet_id
@@ -34,7 +44,8 @@ class CommentSerializerForCreate(serializers.ModelSerializer):
 
     def validate(self, data):
         tweet_id = data['tweet_id']
-        if not Tweet.objects.filter(id=tweet_id).exists():
+        # 通过 cache 检查 tweet 是否存在， 热门 tweet 的评论不需要每次都访问数据库
+        if TweetService.get_by_id(tweet_id) is None:
             raise ValidationError({'message': 'tweet does not exist'})
         # 必须 return validated data
         # 也就是验证过之后的， 进行过处理的（当然也可以不做处理） 输入数据
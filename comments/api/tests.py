@@ -1,8 +1,10 @@
 
 from comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from utils.paginations import EndlessPagination
 
 
 COMMENT_URL = '/api/comments/'
@@ -12,6 +14,7 @@ COMMENT_URL_DETAIL = '/api/comments/{}/'
 class CommentApiTests(TestCase):
 
     def setUp(self):
+        self.clear_cache()
         self.linghu = self.create_user('linghu')
         self.linghu_client = APIClient()
         self.linghu_client.force_authenticate(self.linghu)
@@ -138,4 +141,51 @@ class CommentApiTests(TestCase):
             'tweet_id': self.tweet.id,
             'user_id': self.linghu.id,
         })
-        self.assertEqual(len(response.data['comments']), 2)
\ No newline at end of file
+        self.assertEqual(len(response.data['comments']), 2)
+
+    def test_list_pagination(self):
+        page_size = EndlessPagination.page_size
+        comments = [
+            self.create_comment(self.dongxie, self.tweet, str(i))
+            for i in range(page_size * 2 + 3)
+        ][::-1]
+        # tweet 详情页中显示的最后一条评论
+        preview_last = comments[2]
+
+        # 带了游标的时候按照时间倒序翻页， users 和点赞数都是批量取出来的， query 的数量和评论的数量无关:
+        # tweet_id 的 filter 校验 tweet + comments + users 的 id__in + 分片计数器中的点赞数
+        ContentType.objects.get_for_model(Comment)
+        with self.assertNumQueries(4):
+            response = self.anonymous_client.get(COMMENT_URL, {
+                'tweet_id': self.tweet.id,
+                'created_at__lt': preview_last.created_at,
+                'id__lt': preview_last.id,
+            })
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            [comment.id for comment in comments[3:page_size + 3]],
+        )
+        self.assertEqual(response.data['comments'][0]['user']['username'], 'dongxie')
+
+        last_comment = response.data['comments'][-1]
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'created_at__lt': last_comment['created_at'],
+            'id__lt': last_comment['id'],
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            [comment.id for comment in comments[page_size + 3:]],
+        )
+
+        # 没有带游标的时候还是按照时间顺序返回所有的评论
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+        })
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            [comment.id for comment in comments[::-1]],
+        )
+        self.assertNotIn('has_next_page', response.data)
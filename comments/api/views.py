@@ -8,7 +8,9 @@ from comments.api.serializers import (
     CommentSerializerForUpdate,
 )
 from comments.api.permissions import IsObjectOwner
+from comments.services import CommentService
 from utils.decorators import required_params
+from utils.paginations import EndlessPagination
 
 
 # GenericViewSet如果不定义list方法是不能显示model具体内容的
@@ -25,6 +27,7 @@ class CommentViewSet(viewsets.GenericViewSet):
     queryset = Comment.objects.all()
     # 需要实现安装django_filter才能使用
     filterset_fields = ('tweet_id',)
+    pagination_class = EndlessPagination
 
     # 已经被实现好的方法 如果要更改的话就是重写该方法
     # POST /api/comments/ -> create
@@ -60,15 +63,35 @@ class CommentViewSet(viewsets.GenericViewSet):
                 'message': 'missing tweet_id in request',
                 'success': False,
             }, status=status.HTTP_400_BAD_REQUEST,)
-        queryset = self.get_queryset()
-        comments = self.filter_queryset(queryset)\
-            .prefetch_related('user')\
-            .order_by('created_at')
-        serializer = CommentSerializer(comments, many=True)
-        return Response(
-            {'comments': serializer.data},
-            status=status.HTTP_200_OK,
+        queryset = self.filter_queryset(self.get_queryset())
+        if not self.has_cursor(request):
+            # 没有带游标的时候和以前一样， 按照时间顺序返回所有的评论
+            comments = queryset.order_by('created_at')
+            # users 和点赞数都是批量取出来的
+            serializer = CommentSerializer(
+                CommentService.hydrate_comments(comments),
+                many=True,
+            )
+            return Response(
+                {'comments': serializer.data},
+                status=status.HTTP_200_OK,
+            )
+
+        # 带了游标（tweet 详情页中的 next_comments_cursor）的时候按照 (created_at, id) 倒序翻页
+        # 和评论预览的顺序一致， 走 ('tweet', 'created_at') 的联合索引
+        page = self.paginator.paginate_queryset(queryset, request)
+        serializer = CommentSerializer(
+            CommentService.hydrate_comments(page),
+            many=True,
         )
+        return Response({
+            'comments': serializer.data,
+            'has_next_page': self.paginator.has_next_page,
+        }, status=status.HTTP_200_OK)
+
+    def has_cursor(self, request):
+        return 'created_at__lt' in request.query_params \
+            or 'created_at__gt' in request.query_params
 
     def create(self, request, *args, **kwargs):
 
@@ -88,7 +111,8 @@ class CommentViewSet(viewsets.GenericViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
 
         # save 方法会触发serializer 里的create 方法， 点进 save的具体实现里可以看到
-        comment = serializer.save()
+        # 新创建的 comment 只有 user_id， 通过 CommentService 从 cache 中挂上 user
+        comment = CommentService.hydrate_comments([serializer.save()])[0]
         return Response(
             CommentSerializer(comment).data,
             status=status.HTTP_201_CREATED,
@@ -110,7 +134,7 @@ class CommentViewSet(viewsets.GenericViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
         # save 方法会触发 serializer 里的update方法， 点进 save的具体实现里可以看到
         # save 是根据 instance 参数有没有传来决定是触发create 还是 update
-        comment = serializer.save()
+        comment = CommentService.hydrate_comments([serializer.save()])[0]
         return Response(
             CommentSerializer(comment).data,
             status=status.HTTP_200_OK,
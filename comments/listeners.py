@@ -0,0 +1,21 @@
+from django.db.models import F
+from utils.object_cache import ObjectCacheHelper
+
+
+def _update_comments_count(instance, delta):
+    # 在函数内部 import 避免循环依赖
+    from tweets.models import Tweet
+    Tweet.objects.filter(id=instance.tweet_id).update(
+        comments_count=F('comments_count') + delta,
+    )
+    ObjectCacheHelper.invalidate_cached_object(Tweet, instance.tweet_id)
+
+
+def incr_comments_count(sender, instance, created, **kwargs):
+    if not created:
+        return
+    _update_comments_count(instance, 1)
+
+
+def decr_comments_count(sender, instance, **kwargs):
+    _update_comments_count(instance, -1)
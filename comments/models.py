@@ -1,8 +1,10 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 from tweets.models import Tweet
 from likes.models import Like
-from django.contrib.contenttypes.models import ContentType
+from likes.services import LikeService
+from comments.listeners import incr_comments_count, decr_comments_count
 
 
 class Comment(models.Model):
@@ -15,6 +17,10 @@ class Comment(models.Model):
     content = models.TextField(max_length=140)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # 冗余存储的点赞数， 显示的时候不需要再去 likes 表中 COUNT(*)
+    # 点赞写到 LikeCounterShard 的分片中， 由 fold_like_counters_task 定期合并到这里
+    # 真实的点赞数 = likes_count + 还没有合并的分片， 显示之前用 LikeService.prime_likes_counts 加上
+    likes_count = models.IntegerField(default=0)
 
     class Meta:
         # 有在某个 Tweet 下排序所有 comments 的需求
@@ -23,7 +29,7 @@ class Comment(models.Model):
     @property
     def like_set(self):
         return Like.objects.filter(
-            content_type=ContentType.objects.get_for_model(Comment),
+            content_type_id=LikeService.get_content_type_id(Comment),
             object_id=self.id,
         ).order_by('-created_at')
 
@@ -34,3 +40,7 @@ class Comment(models.Model):
             self.content,
             self.tweet_id,
         )
+
+
+post_save.connect(incr_comments_count, sender=Comment)
+post_delete.connect(decr_comments_count, sender=Comment)
@@ -0,0 +1,32 @@
+from accounts.services import UserService
+from django.conf import settings
+from comments.models import Comment
+from likes.services import LikeService
+
+
+class CommentService(object):
+
+    @classmethod
+    def hydrate_comments(cls, comments):
+        """
+        CommentSerializer -> UserSerializerForComment
+        直接序列化的话每条 comment 都会产生一次 user 的 query （N + 1 Queries）
+        这里用 UserService 一次把所有的 users 取出来挂到 comment 上， 同时加上分片计数器中的点赞数
+        """
+        comments = UserService.attach_users(list(comments))
+        return LikeService.prime_likes_counts(comments)
+
+    @classmethod
+    def attach_comments_preview(cls, tweet):
+        """
+        tweet 详情页中只显示最新的 COMMENTS_PREVIEW_SIZE 条评论
+        走 ('tweet', 'created_at') 的联合索引， 多取一条用来判断是否还有更多的评论
+        更早的评论通过 CommentViewSet.list 用 (created_at__lt, id__lt) 继续翻页
+        """
+        size = settings.COMMENTS_PREVIEW_SIZE
+        comments = list(Comment.objects.filter(
+            tweet_id=tweet.id,
+        ).order_by('-created_at', '-id')[:size + 1])
+        tweet.has_more_comments = len(comments) > size
+        tweet.preview_comments = cls.hydrate_comments(comments[:size])
+        return tweet
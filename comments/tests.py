@@ -1,9 +1,11 @@
+from likes.services import LikeService
 from testing.testcases import TestCase
 
 # Create your tests here.
 class CommentModelTests(TestCase):
 
     def setUp(self):
+        self.clear_cache()
         self.user = self.create_user('gary')
         self.tweet = self.create_tweet(self.user)
         self.comment = self.create_comment(self.user, self.tweet)
@@ -21,3 +23,18 @@ class CommentModelTests(TestCase):
         chenmo = self.create_user('chenmo')
         self.create_like(chenmo, self.comment)
         self.assertEqual(self.comment.like_set.count(), 2)
+
+    def test_likes_count(self):
+        chenmo = self.create_user('chenmo')
+        self.create_like(self.user, self.comment)
+        like = self.create_like(chenmo, self.comment)
+        # 重复点赞不会重复计数
+        self.create_like(chenmo, self.comment)
+        self.assertEqual(LikeService.prime_likes_counts([self.comment])[0].likes_count, 2)
+
+        like.delete()
+        self.clear_cache()
+        self.comment.refresh_from_db()
+        self.assertEqual(LikeService.prime_likes_counts([self.comment])[0].likes_count, 1)
+        # 给 comment 点赞不会影响 tweet 的点赞数
+        self.assertEqual(LikeService.prime_likes_counts([self.tweet])[0].likes_count, 0)
@@ -1,8 +1,10 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 from accounts.api.serializers import UserSerializerForFriendship
 from friendships.models import Friendship
 from rest_framework.exceptions import ValidationError
-from django.contrib.auth.models import User
 
 
 # 可以通过 source = xxx 指定去访问每个model instance 的xxx 方法 或者是 属性 (@property)
@@ -12,20 +14,30 @@ class FollowerSerializer(serializers.ModelSerializer):
     user = UserSerializerForFriendship(source='from_user') # 程序怎么知道要取哪个model？ 是通过Meta里的model？
     # 此处created_at也可以不写 系统默认的就是DateTimeField
     created_at = serializers.DateTimeField()
+    # 当前登录的用户是否关注了这个 user， 由 FriendshipService.prime_has_followed 批量设置
+    has_followed = serializers.BooleanField(read_only=True, default=False)
 
     class Meta:
         model = Friendship
-        fields = ('user', 'created_at')
+        fields = ('user', 'created_at', 'has_followed')
 
 
 class FollowingSerializer(serializers.ModelSerializer):
     user = UserSerializerForFriendship(source='to_user')
     # 此处created_at也可以不写 系统默认的就是DateTimeField
     created_at = serializers.DateTimeField()
+    # 当前登录的用户是否关注了这个 user， 由 FriendshipService.prime_has_followed 批量设置
+    has_followed = serializers.BooleanField(read_only=True, default=False)
 
     class Meta:
         model = Friendship
-        fields = ('user', 'created_at')
+        fields = ('user', 'created_at', 'has_followed')
+
+
+class RecommendationSerializer(serializers.Serializer):
+    user = UserSerializerForFriendship()
+    # 共同关注的人数， 即当前用户关注的人里面有多少人关注了 user
+    score = serializers.IntegerField()
 
 
 class FriendshipSerializerForCreate(serializers.ModelSerializer):
@@ -37,26 +49,79 @@ class FriendshipSerializerForCreate(serializers.ModelSerializer):
         fields = ('from_user_id', 'to_user_id')
 
     def validate(self, attrs):
+        # 只检查不需要访问数据库的部分
+        # 是否已经关注过、 被关注的用户是否存在都交给数据库的唯一索引和外键在 INSERT 的时候检查
         if attrs['from_user_id'] == attrs['to_user_id']:
             raise ValidationError({
                 'message': 'from_user_id and to_user_id should be different',
             })
-        if Friendship.objects.filter(
-                from_user_id=attrs['from_user_id'],
-                to_user_id=attrs['to_user_id'],
+        return attrs
+
+    def create(self, validated_data):
+        """
+        先查再插入的写法需要多两次 query， 并且两个并发的请求（比如双击）可能都查到没有关注过
+        这里直接 INSERT， 失败之后再用一次 query 判断是哪一个约束导致的， 返回和以前一样的错误信息
+        - ('from_user', 'to_user') 的唯一索引: 已经关注过了
+        - to_user 的外键: 被关注的用户不存在
+        """
+        connection = transaction.get_connection()
+        # 线上 MySQL 的外键是在 INSERT 的时候立即检查的
+        # sqlite / postgres 的外键是 DEFERRABLE INITIALLY DEFERRED， 要到 COMMIT 才检查
+        # 外层没有 transaction 的时候下面的 atomic 就是一次 COMMIT， 外键会在退出的时候检查
+        # 外层还有 transaction 的时候（比如单元测试）只是一个 savepoint， 需要在这里手动检查一次
+        # 要在进入 atomic 之前判断， 进入之后 in_atomic_block 一定是 True
+        check_constraints = connection.in_atomic_block \
+            and connection.features.can_defer_constraint_checks
+        try:
+            # savepoint， 插入失败之后外层的 transaction 还可以继续使用
+            with transaction.atomic():
+                friendship = Friendship.objects.create(
+                    from_user_id=validated_data['from_user_id'],
+                    to_user_id=validated_data['to_user_id'],
+                )
+                if check_constraints:
+                    connection.check_constraints(table_names=[Friendship._meta.db_table])
+                return friendship
+        except IntegrityError:
+            if Friendship.objects.filter(
+                from_user_id=validated_data['from_user_id'],
+                to_user_id=validated_data['to_user_id'],
             ).exists():
+                raise ValidationError({
+                    'message': 'You has already followed this user.'
+                })
+            raise ValidationError({
+                'message': 'The user you are following does not exist.'
+            })
+
+
+class FriendshipSerializerForBulkCreate(serializers.Serializer):
+    to_user_ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        min_length=1,
+        max_length=settings.FRIENDSHIP_BULK_FOLLOW_LIMIT,
+    )
+
+    def validate(self, attrs):
+        from_user_id = self.context['request'].user.id
+        # 去重， 保持原来的顺序
+        to_user_ids = list(dict.fromkeys(attrs['to_user_ids']))
+        if from_user_id in to_user_ids:
             raise ValidationError({
-                'message': 'You has already followed this user.'
+                'message': 'from_user_id and to_user_id should be different',
             })
-        # 检测被follow的用户是否存在
-        if not User.objects.filter(id=attrs['to_user_id']).exists():
+        # 一次 id__in 的 query 检查所有的用户是否存在
+        existing_ids = set(User.objects.filter(
+            id__in=to_user_ids,
+        ).values_list('id', flat=True))
+        missing_ids = [
+            to_user_id for to_user_id in to_user_ids
+            if to_user_id not in existing_ids
+        ]
+        if missing_ids:
             raise ValidationError({
-                'message': 'The user you are following does not exist.'
+                'message': 'The users you are following do not exist.',
+                'to_user_ids': missing_ids,
             })
+        attrs['to_user_ids'] = to_user_ids
         return attrs
-
-    def create(self, validated_data):
-        return Friendship.objects.create(
-            from_user_id=validated_data['from_user_id'],
-            to_user_id=validated_data['to_user_id'],
-        )
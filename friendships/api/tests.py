@@ -1,17 +1,37 @@
+import contextlib
+import threading
+
+from array import array
+
+from accounts.services import UserService
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from friendships.api.serializers import FriendshipSerializerForCreate
 from friendships.models import Friendship
+from friendships.services import FriendshipService
+from io import StringIO
+from rest_framework.exceptions import ValidationError
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from utils.paginations import EndlessPagination
 
 
 FOLLOW_URL = '/api/friendships/{}/follow/'
+BULK_FOLLOW_URL = '/api/friendships/bulk_follow/'
 UNFOLLOW_URL = '/api/friendships/{}/unfollow/'
 FOLLOWERS_URL = '/api/friendships/{}/followers/'
 FOLLOWINGS_URL = '/api/friendships/{}/followings/'
+RECOMMENDATIONS_URL = '/api/friendships/recommendations/'
 
 
 class FriendshipApiTests(TestCase):
 
     def setUp(self):
+        self.clear_cache()
         self.linghu = self.create_user('linghu')
         self.linghu_client = APIClient()
         self.linghu_client.force_authenticate(self.linghu)
@@ -40,6 +60,10 @@ class FriendshipApiTests(TestCase):
         # 不可以 follow 自己
         response = self.linghu_client.post(url)
         self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data['errors']['message'],
+            ['from_user_id and to_user_id should be different'],
+        )
         # follow 成功
         response = self.dongxie_client.post(url)
         self.assertEqual(response.status_code, 201)
@@ -50,12 +74,141 @@ class FriendshipApiTests(TestCase):
         # 重复 follow 改为了400
         response = self.dongxie_client.post(url)
         self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data['errors']['message'],
+            ['You has already followed this user.'],
+        )
         # self.assertEqual(response.data['duplicate'], True)
         # 反向关注会创建新的数据
         count = Friendship.objects.count()
         response = self.linghu_client.post(FOLLOW_URL.format(self.dongxie.id))
         self.assertEqual(response.status_code, 201)
         self.assertEqual(Friendship.objects.count(), count + 1)
+        # follow 不存在的用户
+        response = self.dongxie_client.post(FOLLOW_URL.format(-1))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data['errors']['message'],
+            ['The user you are following does not exist.'],
+        )
+        self.assertEqual(Friendship.objects.count(), count + 1)
+
+    def test_bulk_follow(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(5)]
+        for user in users:
+            self.create_tweet(user)
+        user_ids = [user.id for user in users]
+
+        # 需要登录
+        response = self.anonymous_client.post(BULK_FOLLOW_URL, {'to_user_ids': user_ids})
+        self.assertEqual(response.status_code, 403)
+        # 参数不对
+        response = self.linghu_client.post(BULK_FOLLOW_URL, {'to_user_ids': []}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.linghu_client.post(BULK_FOLLOW_URL, {
+            'to_user_ids': user_ids + [self.linghu.id],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.linghu_client.post(BULK_FOLLOW_URL, {
+            'to_user_ids': user_ids + [-1],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['errors']['to_user_ids'], ['-1'])
+        self.assertFalse(Friendship.objects.filter(from_user=self.linghu).exists())
+
+        # 已经关注过的人和重复的 id 都会被忽略
+        self.create_friendship(self.linghu, users[0])
+        # following ids 的 cache 在 transaction 提交之后才更新
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.linghu_client.post(BULK_FOLLOW_URL, {
+                'to_user_ids': user_ids + user_ids[:2],
+            }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 4)
+        self.assertEqual(Friendship.objects.filter(from_user=self.linghu).count(), 5)
+        self.assertEqual(FriendshipService.get_following_user_id_set(self.linghu.id), set(user_ids))
+        # 关注数
+        self.assertEqual(UserService.get_profile(self.linghu.id).followings_count, 5)
+        for user in users:
+            self.assertEqual(UserService.get_profile(user.id).followers_count, 1)
+        # 对方的 tweets 都被补到了 inbox 中
+        self.assertEqual(self.count_newsfeeds(user=self.linghu), 4)
+
+        response = self.linghu_client.post(BULK_FOLLOW_URL, {
+            'to_user_ids': user_ids,
+        }, format='json')
+        self.assertEqual(response.data['created'], 0)
+        self.assertEqual(UserService.get_profile(self.linghu.id).followings_count, 5)
+
+        # 重复提交的时候 cache 还没来得及更新， 已经插入的关注也不会再算一次关注数
+        cache.set(FriendshipService.get_following_key(self.linghu.id), array('q'))
+        response = self.linghu_client.post(BULK_FOLLOW_URL, {
+            'to_user_ids': user_ids,
+        }, format='json')
+        self.assertEqual(response.data['created'], 0)
+        self.assertEqual(UserService.get_profile(self.linghu.id).followings_count, 5)
+        self.assertEqual(UserService.get_profile(users[1].id).followers_count, 1)
+
+        # 已经关注过的人从数据库中判断， cache 中的 following ids 过期了也不会漏掉
+        new_user = self.create_user('new_user')
+        cache.set(
+            FriendshipService.get_following_key(self.linghu.id),
+            array('q', user_ids + [new_user.id]),
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.linghu_client.post(BULK_FOLLOW_URL, {
+                'to_user_ids': [new_user.id],
+            }, format='json')
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(UserService.get_profile(self.linghu.id).followings_count, 6)
+
+    @override_settings(NEWSFEED_BACKFILL_LIMIT=2)
+    def test_bulk_follow_queries(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(20)]
+        user_ids = [user.id for user in users]
+        for user in users[:3]:
+            for i in range(3):
+                self.create_tweet(user)
+        FriendshipService.get_following_user_id_set(self.dongxie.id)
+        # 检查用户是否存在一次 query， 锁住 profile 一次， 查已经关注过的人一次， 插入一次， 关注数两次 UPDATE
+        # 外层的 transaction 和 bulk_create 的 savepoint 各两次
+        # backfill 中每个人是否为明星用户一次， 写入之前确认关注关系还在一次（写入 inbox 在 newsfeed 的分库上， 不算在内）
+        # tweets 每个人只读最近的几条， MySQL 上 UNION ALL 成一次 query， sqlite 上每个人一次
+        if connection.features.supports_slicing_ordering_in_compound:
+            tweet_queries = 1
+        else:
+            tweet_queries = len(user_ids)
+        with self.assertNumQueries(6 + 4 + 2 + tweet_queries):
+            response = self.dongxie_client.post(BULK_FOLLOW_URL, {
+                'to_user_ids': user_ids,
+            }, format='json')
+        self.assertEqual(response.data['created'], 20)
+        # 每个人最多补 NEWSFEED_BACKFILL_LIMIT 条
+        self.assertEqual(self.count_newsfeeds(user=self.dongxie), 3 * 2)
+
+    def test_follow_queries(self):
+        serializer = FriendshipSerializerForCreate(data={
+            'from_user_id': self.dongxie.id,
+            'to_user_id': self.linghu.id,
+        })
+        # 不再先查是否已经关注过和用户是否存在， 只有一条 INSERT
+        # （savepoint 和 sqlite 上的外键检查不算在内）
+        with CaptureQueriesContext(connection) as captured:
+            self.assertTrue(serializer.is_valid())
+            serializer.save()
+        # 另外两条 UPDATE 是 UserProfile 中的关注数
+        statements = [query['sql'].split()[0] for query in captured.captured_queries]
+        self.assertEqual(statements.count('INSERT'), 1)
+        self.assertEqual(statements.count('UPDATE'), 2)
+        self.assertEqual(statements.count('SELECT'), 0)
+
+        # 插入失败的时候才多一次 query 判断是哪一个约束
+        response = self.dongxie_client.post(FOLLOW_URL.format(self.linghu.id))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data['errors']['message'],
+            ['You has already followed this user.'],
+        )
 
     def test_unfollow(self):
         url = UNFOLLOW_URL.format(self.linghu.id)
@@ -131,4 +284,221 @@ class FriendshipApiTests(TestCase):
         self.assertEqual(
             response.data['followers'][1]['user']['username'],
             'dongxie_follower0',
-        )
\ No newline at end of file
+        )
+
+    def test_followers_pagination(self):
+        page_size = EndlessPagination.page_size
+        followers = []
+        for i in range(page_size * 2):
+            follower = self.create_user('linghu_follower{}'.format(i))
+            Friendship.objects.create(from_user=follower, to_user=self.linghu)
+            followers.append(follower)
+        followers = followers[::-1]
+
+        url = FOLLOWERS_URL.format(self.linghu.id)
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [item['user']['id'] for item in response.data['followers']],
+            [user.id for user in followers[:page_size]],
+        )
+
+        last = Friendship.objects.get(
+            from_user=followers[page_size - 1],
+            to_user=self.linghu,
+        )
+        response = self.anonymous_client.get(url, {
+            'created_at__lt': last.created_at,
+            'id__lt': last.id,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [item['user']['id'] for item in response.data['followers']],
+            [user.id for user in followers[page_size:]],
+        )
+
+        # 下拉刷新
+        newest = Friendship.objects.get(from_user=followers[0], to_user=self.linghu)
+        response = self.anonymous_client.get(url, {'created_at__gt': newest.created_at})
+        self.assertEqual(len(response.data['followers']), 0)
+        Friendship.objects.create(from_user=self.dongxie, to_user=self.linghu)
+        response = self.anonymous_client.get(url, {'created_at__gt': newest.created_at})
+        self.assertEqual(
+            [item['user']['id'] for item in response.data['followers']],
+            [self.dongxie.id],
+        )
+
+    def test_followings_queries(self):
+        for i in range(EndlessPagination.page_size + 5):
+            following = self.create_user('linghu_following{}'.format(i))
+            Friendship.objects.create(from_user=self.linghu, to_user=following)
+
+        # 一页 friendships 一次 query， 这一页所有的 users 一次 query
+        url = FOLLOWINGS_URL.format(self.linghu.id)
+        with self.assertNumQueries(2):
+            response = self.anonymous_client.get(url)
+        self.assertEqual(len(response.data['followings']), EndlessPagination.page_size)
+        self.assertEqual(response.data['has_next_page'], True)
+        # users 都在 cache 中之后只需要一次 query
+        with self.assertNumQueries(1):
+            self.anonymous_client.get(url)
+
+    def test_has_followed(self):
+        # linghu 关注了 dongxie 的一个 follower
+        follower = Friendship.objects.filter(to_user=self.dongxie).first().from_user
+        self.create_friendship(self.linghu, follower)
+
+        response = self.linghu_client.get(FOLLOWERS_URL.format(self.dongxie.id))
+        self.assertEqual(
+            {item['user']['id']: item['has_followed'] for item in response.data['followers']},
+            {
+                friendship.from_user_id: friendship.from_user_id == follower.id
+                for friendship in Friendship.objects.filter(to_user=self.dongxie)
+            },
+        )
+        response = self.anonymous_client.get(FOLLOWERS_URL.format(self.dongxie.id))
+        self.assertFalse(any(item['has_followed'] for item in response.data['followers']))
+
+        # 自己的 followings 都是已经关注的
+        response = self.dongxie_client.get(FOLLOWINGS_URL.format(self.dongxie.id))
+        self.assertTrue(all(item['has_followed'] for item in response.data['followings']))
+
+
+class FriendshipConcurrencyTests(TransactionTestCase):
+    # 多个线程要能看到彼此提交的数据， 所以不能用包在 transaction 里的 TestCase
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_follow_after_concurrent_insert(self):
+        linghu = User.objects.create_user('linghu')
+        dongxie = User.objects.create_user('dongxie')
+        serializer = FriendshipSerializerForCreate(data={
+            'from_user_id': dongxie.id,
+            'to_user_id': linghu.id,
+        })
+        self.assertTrue(serializer.is_valid())
+        # 另一个请求在 validate 和 INSERT 之间抢先关注了
+        Friendship.objects.create(from_user=dongxie, to_user=linghu)
+        with self.assertRaises(ValidationError) as context:
+            serializer.save()
+        self.assertEqual(
+            context.exception.detail['message'],
+            'You has already followed this user.',
+        )
+        self.assertEqual(Friendship.objects.count(), 1)
+
+    def test_follow_missing_user_without_outer_transaction(self):
+        dongxie = User.objects.create_user('dongxie')
+        serializer = FriendshipSerializerForCreate(data={
+            'from_user_id': dongxie.id,
+            'to_user_id': dongxie.id + 100,
+        })
+        self.assertTrue(serializer.is_valid())
+        # 没有外层的 transaction， 外键在 COMMIT 的时候检查
+        with self.assertRaises(ValidationError) as context:
+            serializer.save()
+        self.assertEqual(
+            context.exception.detail['message'],
+            'The user you are following does not exist.',
+        )
+        self.assertEqual(Friendship.objects.count(), 0)
+
+    def post_in_parallel(self, user, url, data=None, threads_count=8):
+        # 用 threads_count 个线程同时发同一个请求， 返回所有的 responses
+        barrier = threading.Barrier(threads_count)
+        responses = []
+        # sqlite 的内存测试数据库不支持多个连接同时写入（database table is locked）
+        # 这时每个线程还是用自己的连接发请求， 但是一次只发一个， MySQL 上是真正并发的
+        if connection.features.test_db_allows_multiple_connections:
+            request_lock = contextlib.nullcontext()
+        else:
+            request_lock = threading.Lock()
+
+        def post():
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                barrier.wait()
+                with request_lock:
+                    responses.append(client.post(url, data, format='json'))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=post) for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_parallel_follows(self):
+        linghu = User.objects.create_user('linghu')
+        dongxie = User.objects.create_user('dongxie')
+        responses = self.post_in_parallel(dongxie, FOLLOW_URL.format(linghu.id))
+
+        # 同时发出的多个 follow 只有一个会成功， 其他的都是 400 而不是 500
+        self.assertEqual(
+            sorted(response.status_code for response in responses),
+            [201] + [400] * (len(responses) - 1),
+        )
+        self.assertEqual(Friendship.objects.filter(from_user=dongxie).count(), 1)
+
+    def test_parallel_bulk_follows(self):
+        dongxie = User.objects.create_user('dongxie')
+        user_ids = [User.objects.create_user('user{}'.format(i)).id for i in range(5)]
+        # 其中一个已经被单个 follow 关注过了
+        Friendship.objects.create(from_user=dongxie, to_user_id=user_ids[0])
+        responses = self.post_in_parallel(
+            dongxie,
+            BULK_FOLLOW_URL,
+            {'to_user_ids': user_ids},
+            threads_count=4,
+        )
+
+        # 重复提交的 bulk follow 只有一个真正插入了数据， 关注数也只加了一次
+        self.assertEqual(
+            sorted(response.data['created'] for response in responses),
+            [0, 0, 0, 4],
+        )
+        self.assertEqual(Friendship.objects.filter(from_user=dongxie).count(), 5)
+        self.assertEqual(UserService.get_profile(dongxie.id).followings_count, 5)
+        for user_id in user_ids:
+            self.assertEqual(UserService.get_profile(user_id).followers_count, 1)
+
+
+class RecommendationApiTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.linghu_client = APIClient()
+        self.linghu_client.force_authenticate(self.linghu)
+
+    def test_recommendations(self):
+        url = RECOMMENDATIONS_URL
+        # 需要登录
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.status_code, 403)
+        # 还没有计算过推荐
+        response = self.linghu_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['recommendations'], [])
+
+        friends = [self.create_user('friend{}'.format(i)) for i in range(3)]
+        stranger = self.create_user('stranger')
+        for friend in friends:
+            self.create_friendship(self.linghu, friend)
+            self.create_friendship(friend, stranger)
+        self.create_friendship(friends[0], self.create_user('other'))
+        call_command('compute_recommendations', stdout=StringIO())
+
+        response = self.linghu_client.get(url)
+        self.assertEqual(
+            [(item['user']['username'], item['score']) for item in response.data['recommendations']],
+            [('stranger', 3), ('other', 1)],
+        )
+        # 推荐、 following 的人和被推荐的 users 都在 cache 中
+        with self.assertNumQueries(0):
+            self.linghu_client.get(url)
@@ -1,15 +1,23 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
+from rest_framework.serializers import as_serializer_error
 
 from friendships.models import Friendship
 from friendships.api.serializers import (
     FollowerSerializer,
     FollowingSerializer,
+    FriendshipSerializerForBulkCreate,
     FriendshipSerializerForCreate,
+    RecommendationSerializer,
 )
+from friendships.services import FriendshipService
+from newsfeeds.services import NewsFeedService
+from utils.paginations import EndlessPagination
 
+from django.conf import settings
 from django.contrib.auth.models import User
 
 
@@ -22,26 +30,51 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     # 在调用POST的方法时， 程序会去寻找serializer
     serializer_class = FriendshipSerializerForCreate
     queryset = User.objects.all()
+    pagination_class = EndlessPagination
 
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
     # pk 是primary key
     # 查询用户 pk 的followers
     def followers(self, request, pk):
         # GET /api/friendships/1/followers/
-        friendships = Friendship.objects.filter(to_user_id=pk).order_by('-created_at')
+        # 按照 (created_at, id) 翻页， 走 ('to_user', 'created_at') 的联合索引
+        # 每一页一次 query 取 friendships， 再最多一次 query 取 users， 与 followers 的总数无关
+        page = self.paginate_queryset(Friendship.objects.filter(to_user_id=pk))
+        friendships = FriendshipService.hydrate_friendships(page)
+        FriendshipService.prime_has_followed(friendships, request.user, 'from_user_id')
         serializer = FollowerSerializer(friendships, many=True)
-        return Response(
-            {"followers": serializer.data},
-            status=status.HTTP_200_OK,
-        )
+        return Response({
+            "followers": serializer.data,
+            "has_next_page": self.paginator.has_next_page,
+        }, status=status.HTTP_200_OK)
 
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
     def followings(self, request, pk):
         # GET /api/friendships/1/followings/
-        friendships = Friendship.objects.filter(from_user_id=pk).order_by('-created_at')
+        # 同上， 走 ('from_user', 'created_at') 的联合索引
+        page = self.paginate_queryset(Friendship.objects.filter(from_user_id=pk))
+        friendships = FriendshipService.hydrate_friendships(page)
+        FriendshipService.prime_has_followed(friendships, request.user, 'to_user_id')
         serializer = FollowingSerializer(friendships, many=True)
+        return Response({
+            "followings": serializer.data,
+            "has_next_page": self.paginator.has_next_page,
+        }, status=status.HTTP_200_OK)
+
+    @action(methods=['GET'], detail=False, permission_classes=[IsAuthenticated])
+    def recommendations(self, request):
+        # GET /api/friendships/recommendations/
+        # 离线计算好的 "可能认识的人"， 参考 friendships.recommendations.RecommendationEngine
+        recommendations = FriendshipService.get_recommendations(
+            request.user,
+            settings.FRIENDSHIP_RECOMMENDATIONS_LIMIT,
+        )
+        serializer = RecommendationSerializer(
+            [{'user': user, 'score': score} for user, score in recommendations],
+            many=True,
+        )
         return Response(
-            {"followings": serializer.data},
+            {"recommendations": serializer.data},
             status=status.HTTP_200_OK,
         )
 
@@ -49,10 +82,8 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     def follow(self, request, pk):
         # /api/friendships/<pk>/follow
 
-        # get_object会检测是否有pk对应的用户，如果没有就会报错
-        # 这里也能起到检测要follow的用户是否存在的效果
-        # 若不存在会返回404
-        self.get_object()
+        # 不再先用 get_object 检查被 follow 的用户是否存在， 而是交给 INSERT 时的外键约束
+        # 参考 FriendshipSerializerForCreate.create
         serializer = FriendshipSerializerForCreate(data={
             'from_user_id': request.user.id,
             'to_user_id': pk,
@@ -71,9 +102,46 @@ class FriendshipViewSet(viewsets.GenericViewSet):
 
         # serializer.save()
         # return Response({'success': True}, status=status.HTTP_201_CREATED)
-        instance = serializer.save()
+        try:
+            instance = serializer.save()
+        except ValidationError as exc:
+            # 已经关注过了或者被关注的用户不存在
+            # 和 is_valid 失败的时候一样， 转成 {field: [message]} 的格式
+            return Response({
+                "success": False,
+                "message": "Please check input",
+                "errors": as_serializer_error(exc),
+            }, status=status.HTTP_400_BAD_REQUEST)
+        NewsFeedService.backfill_newsfeeds(request.user.id, [instance.to_user_id])
+        FriendshipService.hydrate_friendships([instance])
         return Response(FollowingSerializer(instance).data, status=status.HTTP_201_CREATED)
 
+    @action(methods=['POST'], detail=False, permission_classes=[IsAuthenticated])
+    def bulk_follow(self, request):
+        # POST /api/friendships/bulk_follow/ {"to_user_ids": [1, 2, 3]}
+        # 一次 query 检查所有的用户， 一次 bulk_create， 一次 backfill， 而不是 N 次 follow
+        serializer = FriendshipSerializerForBulkCreate(
+            data=request.data,
+            context={'request': request},
+        )
+        if not serializer.is_valid():
+            return Response({
+                "success": False,
+                "message": "Please check input",
+                "errors": serializer.errors,
+            }, status=status.HTTP_400_BAD_REQUEST)
+        to_user_ids = FriendshipService.bulk_follow(
+            request.user.id,
+            serializer.validated_data['to_user_ids'],
+        )
+        if to_user_ids:
+            NewsFeedService.backfill_newsfeeds(request.user.id, to_user_ids)
+        # 已经关注过的人不会被重复关注， created 是新关注的人数
+        return Response({
+            'success': True,
+            'created': len(to_user_ids),
+        }, status=status.HTTP_201_CREATED)
+
     @action(methods=['POST'], detail=True, permission_classes=[IsAuthenticated])
     def unfollow(self, request, pk):
         # raise 404 if No user with id=pk
@@ -99,6 +167,8 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             from_user=request.user,
             to_user=unfollow_usr,
         ).delete()
+        if deleted:
+            NewsFeedService.remove_newsfeeds(request.user.id, unfollow_usr.id)
         return Response({'success': True, 'deleted': deleted})
 
         # MYSQL
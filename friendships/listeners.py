@@ -0,0 +1,38 @@
+from django.db import transaction
+
+
+def add_to_following_cache(sender, instance, created, **kwargs):
+    if not created or instance.to_user_id is None:
+        return
+    # 在函数内部 import 避免循环依赖
+    from friendships.services import FriendshipService
+    transaction.on_commit(lambda: FriendshipService.update_following_cache(
+        instance.from_user_id,
+        added_ids=[instance.to_user_id],
+    ))
+
+
+def remove_from_following_cache(sender, instance, **kwargs):
+    if instance.to_user_id is None:
+        return
+    from friendships.services import FriendshipService
+    transaction.on_commit(lambda: FriendshipService.update_following_cache(
+        instance.from_user_id,
+        removed_ids=[instance.to_user_id],
+    ))
+
+
+def incr_friendship_counts(sender, instance, created, **kwargs):
+    if not created:
+        return
+    from accounts.services import UserService
+    UserService.incr_friendship_counts(instance.from_user_id, instance.to_user_id, 1)
+
+
+def decr_friendship_counts(sender, instance, **kwargs):
+    from accounts.services import UserService
+    from newsfeeds.services import NewsFeedService
+    UserService.incr_friendship_counts(instance.from_user_id, instance.to_user_id, -1)
+    # follower 数量降到阈值以下的明星用户需要把之前没有 fanout 的 tweets 补到 followers 的 inbox 中
+    if instance.to_user_id is not None:
+        NewsFeedService.demote_celebrity_if_needed(instance.to_user_id)
@@ -0,0 +1,85 @@
+import time
+import tracemalloc
+
+import numpy as np
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from friendships.recommendations import RecommendationEngine
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the recommendation engine on a synthetic follow graph generated '
+        'in memory. Nothing is read from or written to the database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--edges', type=int, default=2000000)
+        parser.add_argument(
+            '--top-k',
+            type=int,
+            default=settings.FRIENDSHIP_RECOMMENDATIONS_STORED,
+        )
+        parser.add_argument(
+            '--block-size',
+            type=int,
+            default=settings.FRIENDSHIP_RECOMMENDATIONS_BLOCK_SIZE,
+        )
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        from_user_ids, to_user_ids = self.generate_graph(
+            options['users'],
+            options['edges'],
+            options['seed'],
+        )
+        self.stdout.write('{} users, {} edges'.format(
+            options['users'],
+            len(from_user_ids),
+        ))
+
+        # numpy 的内存分配也会被 tracemalloc 统计到
+        tracemalloc.start()
+        start = time.time()
+        adjacency, user_ids = RecommendationEngine.build_adjacency(from_user_ids, to_user_ids)
+        built = time.time()
+        users, recommendations = 0, 0
+        for row, candidates, scores in RecommendationEngine.iter_top_k(
+            adjacency,
+            options['top_k'],
+            options['block_size'],
+        ):
+            users += 1
+            recommendations += len(candidates)
+        finished = time.time()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.stdout.write('build adjacency: {:.2f}s'.format(built - start))
+        self.stdout.write('top {} for {} users: {:.2f}s ({:.0f} users/s)'.format(
+            options['top_k'],
+            users,
+            finished - built,
+            users / (finished - built) if finished > built else 0,
+        ))
+        self.stdout.write('{} recommendations, peak memory {:.1f} MB'.format(
+            recommendations,
+            peak / 1024 / 1024,
+        ))
+
+    def generate_graph(self, users, edges, seed):
+        """
+        关注的人是按照 zipf 分布选出来的， 少数明星用户有大量的 followers， 和真实的关注关系比较接近
+        重复的边和自己关注自己的边会被去掉， 所以最后的边会比 edges 少一些
+        """
+        random = np.random.RandomState(seed)
+        from_user_ids = random.randint(1, users + 1, size=edges).astype(np.int64)
+        to_user_ids = np.minimum(random.zipf(1.5, size=edges), users).astype(np.int64)
+        # zipf 分布中小的数字出现得多， 打乱一下明星用户的 id
+        to_user_ids = random.permutation(users)[to_user_ids - 1] + 1
+        keys = np.unique(from_user_ids * (users + 1) + to_user_ids)
+        from_user_ids, to_user_ids = keys // (users + 1), keys % (users + 1)
+        not_self = from_user_ids != to_user_ids
+        return from_user_ids[not_self], to_user_ids[not_self]
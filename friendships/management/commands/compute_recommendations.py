@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from friendships.recommendations import RecommendationEngine
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the friend-of-friend recommendations of every user from the '
+        'friendship graph and store the top K of each user.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top-k',
+            type=int,
+            default=settings.FRIENDSHIP_RECOMMENDATIONS_STORED,
+            help='Number of recommendations stored for each user.',
+        )
+        parser.add_argument(
+            '--edge-chunk-size',
+            type=int,
+            default=settings.FRIENDSHIP_RECOMMENDATIONS_EDGE_CHUNK_SIZE,
+            help='Number of friendships read from the database by each query.',
+        )
+        parser.add_argument(
+            '--block-size',
+            type=int,
+            default=settings.FRIENDSHIP_RECOMMENDATIONS_BLOCK_SIZE,
+            help='Number of users whose two-hop scores are computed at a time.',
+        )
+
+    def handle(self, *args, **options):
+        edges, users, stale = RecommendationEngine.compute(
+            top_k=options['top_k'],
+            chunk_size=options['edge_chunk_size'],
+            block_size=options['block_size'],
+        )
+        self.stdout.write(
+            '{} edges loaded, {} users recommended, {} stale recommendations removed'.format(
+                edges,
+                users,
+                stale,
+            )
+        )
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.3 on 2026-10-18 18:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('friendships', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendshipRecommendation',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='auth.user')),
+                ('user_ids', models.BinaryField()),
+                ('scores', models.BinaryField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
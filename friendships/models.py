@@ -1,5 +1,15 @@
+from array import array
+
 from django.db import models
 from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+from friendships.listeners import (
+    add_to_following_cache,
+    decr_friendship_counts,
+    incr_friendship_counts,
+    remove_from_following_cache,
+)
 
 
 # Create your models here.
@@ -34,3 +44,34 @@ class Friendship(models.Model):
 
     def __str__(self):
         return f'{self.from_user_id} followed {self.to_user_id}'
+
+
+class FriendshipRecommendation(models.Model):
+    """
+    离线计算出来的 "可能认识的人"， 由 python manage.py compute_recommendations 定期重新生成
+    每个用户只有一行， 推荐的 user_ids 和对应的分数（共同关注的人数）按照分数倒序
+    打包成 array 的 bytes 存储， 比每条推荐一行要紧凑很多， 整行也可以直接放进 ObjectCacheHelper
+    """
+    # 直接用 user 作为主键， 可以按照 user_id 从 ObjectCacheHelper 中读取
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    # array('q')， 每个 id 8 个字节
+    user_ids = models.BinaryField()
+    # array('i')， 和 user_ids 一一对应
+    scores = models.BinaryField()
+    # 生成这一行的那次计算开始的时间， 之后的计算中没有被重新生成的行会被删掉
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def get_user_ids(self):
+        return array('q', bytes(self.user_ids))
+
+    def get_scores(self):
+        return array('i', bytes(self.scores))
+
+    def __str__(self):
+        return f'{len(self.get_user_ids())} recommendations for {self.user_id}'
+
+
+post_save.connect(add_to_following_cache, sender=Friendship)
+post_delete.connect(remove_from_following_cache, sender=Friendship)
+post_save.connect(incr_friendship_counts, sender=Friendship)
+post_delete.connect(decr_friendship_counts, sender=Friendship)
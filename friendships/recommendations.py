@@ -0,0 +1,155 @@
+import numpy as np
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from friendships.models import Friendship, FriendshipRecommendation
+from scipy import sparse
+from utils.object_cache import ObjectCacheHelper
+
+
+class RecommendationEngine(object):
+    """
+    离线计算 "可能认识的人"（friend of friend）
+    - 把 Friendship 的边按主键分批读出来， 组成一个稀疏的邻接矩阵 A， A[i, j] = 1 表示 i 关注了 j
+    - A * A 中的 (i, j) 就是 i 关注的人里面有多少人关注了 j， 作为推荐 j 给 i 的分数
+    - 按照 block_size 个用户一批计算 A[rows] * A， 不会生成完整的 A * A， 内存的占用只和边的数量以及一批的大小有关
+    - 去掉已经关注的人和自己， 每个用户只保留分数最高的 top_k 个
+    """
+
+    @classmethod
+    def load_edges(cls, chunk_size):
+        # 返回 (from_user_ids, to_user_ids) 两个 numpy array， 每次只从数据库中读 chunk_size 条
+        from_chunks, to_chunks = [], []
+        last_id = 0
+        while True:
+            rows = list(Friendship.objects.filter(
+                id__gt=last_id,
+                from_user_id__isnull=False,
+                to_user_id__isnull=False,
+            ).order_by('id').values_list('id', 'from_user_id', 'to_user_id')[:chunk_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            # 每个 chunk 立即转成 numpy array， 不会在内存中留下大量的 python tuple
+            chunk = np.array(rows, dtype=np.int64)
+            from_chunks.append(chunk[:, 1])
+            to_chunks.append(chunk[:, 2])
+            if len(rows) < chunk_size:
+                break
+        if not from_chunks:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(from_chunks), np.concatenate(to_chunks)
+
+    @classmethod
+    def build_adjacency(cls, from_user_ids, to_user_ids):
+        """
+        user id 不是连续的， 先压缩成 0 ~ n - 1 的下标， 返回 (邻接矩阵, 下标对应的 user_ids)
+        """
+        user_ids, indexes = np.unique(
+            np.concatenate([from_user_ids, to_user_ids]),
+            return_inverse=True,
+        )
+        edges_count = len(from_user_ids)
+        adjacency = sparse.csr_matrix(
+            (
+                np.ones(edges_count, dtype=np.int32),
+                (indexes[:edges_count], indexes[edges_count:]),
+            ),
+            shape=(len(user_ids), len(user_ids)),
+        )
+        # 唯一索引保证了没有重复的边， 这里保险起见把重复的边合并成 1
+        adjacency.data[:] = 1
+        return adjacency, user_ids
+
+    @classmethod
+    def iter_top_k(cls, adjacency, top_k, block_size):
+        """
+        逐个 yield (row, 推荐的下标, 分数)， 分数从高到低， 分数相同的时候下标小的在前
+        只计算至少关注了一个人的用户， 没有可以推荐的人的时候也会 yield 空的 array
+        """
+        rows_with_followings = np.flatnonzero(np.diff(adjacency.indptr))
+        for start in range(0, len(rows_with_followings), block_size):
+            rows = rows_with_followings[start:start + block_size]
+            block = adjacency[rows]
+            two_hop = (block @ adjacency).tocsr()
+            # 已经关注的人和自己都不需要推荐
+            self_loops = sparse.csr_matrix(
+                (np.ones(len(rows), dtype=np.int32), (np.arange(len(rows)), rows)),
+                shape=block.shape,
+            )
+            excluded = (block + self_loops) > 0
+            two_hop = (two_hop - two_hop.multiply(excluded)).tocsr()
+            two_hop.eliminate_zeros()
+
+            for i, row in enumerate(rows):
+                begin, end = two_hop.indptr[i], two_hop.indptr[i + 1]
+                candidates = two_hop.indices[begin:end]
+                scores = two_hop.data[begin:end]
+                if len(candidates) > top_k:
+                    # argpartition 是 O(n) 的， 不需要把所有的候选人都排序
+                    top = np.argpartition(-scores, top_k - 1)[:top_k]
+                    candidates, scores = candidates[top], scores[top]
+                order = np.lexsort((candidates, -scores))
+                yield row, candidates[order], scores[order]
+
+    @classmethod
+    def compute(cls, top_k, chunk_size, block_size):
+        """
+        重新生成所有用户的推荐， 返回 (读取了多少条边, 生成了多少个用户的推荐, 删掉了多少个过期的推荐)
+        每个 block 的写入在一个 transaction 中完成， 计算的过程中读到的都是完整的旧数据或者新数据
+        """
+        started_at = timezone.now()
+        from_user_ids, to_user_ids = cls.load_edges(chunk_size)
+        adjacency, user_ids = cls.build_adjacency(from_user_ids, to_user_ids)
+        edges_count = len(from_user_ids)
+        # 后面只需要邻接矩阵， 原始的边可以先释放掉
+        del from_user_ids, to_user_ids
+
+        recommendations = []
+        users_count = 0
+        for row, candidates, scores in cls.iter_top_k(adjacency, top_k, block_size):
+            # 没有可以推荐的人的用户不需要存， 旧的推荐会在最后被当作过期的删掉
+            if not len(candidates):
+                continue
+            recommendations.append(FriendshipRecommendation(
+                user_id=int(user_ids[row]),
+                user_ids=user_ids[candidates].astype(np.int64).tobytes(),
+                scores=scores.astype(np.int32).tobytes(),
+                created_at=started_at,
+            ))
+            if len(recommendations) >= block_size:
+                cls._save(recommendations)
+                users_count += len(recommendations)
+                recommendations = []
+        if recommendations:
+            cls._save(recommendations)
+            users_count += len(recommendations)
+
+        # 这一次没有被重新生成的（比如已经取关了所有人）都是过期的推荐
+        stale_user_ids = list(FriendshipRecommendation.objects.filter(
+            created_at__lt=started_at,
+        ).values_list('user_id', flat=True))
+        for start in range(0, len(stale_user_ids), block_size):
+            cls._delete(stale_user_ids[start:start + block_size])
+        return edges_count, users_count, len(stale_user_ids)
+
+    @classmethod
+    def _save(cls, recommendations):
+        user_ids = [recommendation.user_id for recommendation in recommendations]
+        with transaction.atomic():
+            FriendshipRecommendation.objects.filter(user_id__in=user_ids).delete()
+            FriendshipRecommendation.objects.bulk_create(recommendations)
+        cls._invalidate_cache(user_ids)
+
+    @classmethod
+    def _delete(cls, user_ids):
+        FriendshipRecommendation.objects.filter(user_id__in=user_ids).delete()
+        cls._invalidate_cache(user_ids)
+
+    @classmethod
+    def _invalidate_cache(cls, user_ids):
+        cache.delete_many([
+            ObjectCacheHelper.get_key(FriendshipRecommendation, user_id)
+            for user_id in user_ids
+        ])
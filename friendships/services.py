@@ -1,5 +1,23 @@
-from friendships.models import Friendship
-from django.contrib.auth.models import User
+import uuid
+
+from array import array
+
+from accounts.models import UserProfile
+from accounts.services import UserService
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from friendships.models import Friendship, FriendshipRecommendation
+from twitter.cache import (
+    CELEBRITY_DEMOTION_PATTERN,
+    CELEBRITY_FLAG_PATTERN,
+    CELEBRITY_FOLLOWINGS_PATTERN,
+    FOLLOWING_IDS_GENERATION_PATTERN,
+    FOLLOWING_IDS_LOCK_PATTERN,
+    FOLLOWING_IDS_PATTERN,
+)
+from utils.object_cache import ObjectCacheHelper
+from utils.queryset_helpers import iterate_by_created_at
 
 
 class FriendshipService(object):
@@ -32,3 +50,290 @@ class FriendshipService(object):
             to_user=user,
         ).prefetch_related('from_user')
         return [friendship.from_user for friendship in friendships]
+
+    @classmethod
+    def hydrate_friendships(cls, friendships):
+        """
+        FollowerSerializer / FollowingSerializer 直接序列化的话每个 friendship 都会去 query 一次 user
+        这里用一次 cache 的 multi-get 把一页中所有的 from_user / to_user 都取出来挂到 friendship 上
+        cache 没有命中的 users 用一次 IN query 补齐
+        """
+        return UserService.attach_users(list(friendships), 'from_user', 'to_user')
+
+    @classmethod
+    def prime_has_followed(cls, friendships, viewer, user_id_attr):
+        # user_id_attr 是列表中显示的那个 user， followers 中是 from_user_id， followings 中是 to_user_id
+        followed = cls.has_followed(
+            viewer,
+            [getattr(friendship, user_id_attr) for friendship in friendships],
+        )
+        for friendship in friendships:
+            friendship.has_followed = followed[getattr(friendship, user_id_attr)]
+        return friendships
+
+    @classmethod
+    def bulk_follow(cls, from_user_id, to_user_ids):
+        """
+        一次关注多个人， 返回新关注的 user ids
+        - 先锁住 from_user 的 UserProfile， 同一个人重复提交的 bulk follow 会排队执行
+        - 已经关注过的人用一次 to_user_id__in 的 query 从数据库中过滤掉， 而不是相信 cache
+        - 剩下的一次 bulk_create， 和单个 follow 并发冲突的时候再一条一条地插入
+        关注数只按照真正插入的行更新， bulk_create 不会触发 post_save， 所以关注数和 following ids 的 cache 在这里手动更新
+        """
+        requested_ids = list(to_user_ids)
+        with transaction.atomic():
+            # 老用户还没有 profile 的时候锁不到任何行， 由 recount_friendship_counters 修正可能的误差
+            list(UserProfile.objects.select_for_update().filter(user_id=from_user_id))
+            following_ids = set(Friendship.objects.filter(
+                from_user_id=from_user_id,
+                to_user_id__in=requested_ids,
+            ).values_list('to_user_id', flat=True))
+            created_ids = cls._insert_friendships(from_user_id, [
+                to_user_id for to_user_id in requested_ids
+                if to_user_id not in following_ids
+            ])
+            UserService.incr_bulk_friendship_counts(from_user_id, created_ids)
+        # 提交之后所有请求的人都已经被关注了， 包括之前就关注过的， 顺便修正 cache 中可能过期的数据
+        transaction.on_commit(
+            lambda: cls.update_following_cache(from_user_id, added_ids=requested_ids),
+        )
+        return created_ids
+
+    @classmethod
+    def _insert_friendships(cls, from_user_id, to_user_ids):
+        """
+        返回真正插入的 to_user_ids
+        正常情况下一次 bulk_create 就全部写入了， 有并发的单个 follow 抢先插入的时候唯一索引会冲突，
+        这时再一条一条地插入， 跳过已经存在的关注
+        """
+        if not to_user_ids:
+            return []
+        friendships = [
+            Friendship(from_user_id=from_user_id, to_user_id=to_user_id)
+            for to_user_id in to_user_ids
+        ]
+        try:
+            # savepoint， 冲突的时候不会让外层的 transaction 失效
+            with transaction.atomic():
+                Friendship.objects.bulk_create(
+                    friendships,
+                    batch_size=settings.FRIENDSHIP_BULK_FOLLOW_LIMIT,
+                )
+            return list(to_user_ids)
+        except IntegrityError:
+            pass
+        created_ids = []
+        for friendship in friendships:
+            try:
+                with transaction.atomic():
+                    Friendship.objects.bulk_create([friendship])
+            except IntegrityError:
+                continue
+            created_ids.append(friendship.to_user_id)
+        return created_ids
+
+    @classmethod
+    def get_follower_id_chunks(cls, user_id, chunk_size):
+        # 按 chunk 逐批返回 follower 的 id， 不会一次性把所有 followers 都加载到内存中
+        for rows in iterate_by_created_at(
+            Friendship.objects.filter(to_user_id=user_id),
+            chunk_size=chunk_size,
+            fields=('from_user_id',),
+        ):
+            yield [from_user_id for _, _, from_user_id in rows]
+
+    @classmethod
+    def get_following_user_ids(cls, user_id):
+        return list(cls.get_following_user_id_set(user_id))
+
+    @classmethod
+    def get_following_key(cls, user_id):
+        return FOLLOWING_IDS_PATTERN.format(user_id=user_id)
+
+    @classmethod
+    def get_following_user_id_set(cls, user_id):
+        """
+        user 关注的所有人的 id， 判断 "A 是否关注了 B" 的时候不需要再去 query Friendship
+        cache 中存的是 array('q')， 每个 id 只占 8 个字节， 比 pickle 一个 set 要紧凑很多
+        取出来之后转成 set， 之后每次判断都是 O(1)
+        """
+        key = cls.get_following_key(user_id)
+        following_ids = cache.get(key)
+        if following_ids is not None:
+            return set(following_ids)
+
+        generation_key = FOLLOWING_IDS_GENERATION_PATTERN.format(user_id=user_id)
+        generation = cache.get(generation_key)
+        # 走 ('from_user', 'created_at') 的联合索引， 只取 id 不取整个 User
+        # to_user 被删除之后 to_user_id 是 NULL （SET_NULL）， array 中不能存 None
+        following_ids = array('q', Friendship.objects.filter(
+            from_user_id=user_id,
+            to_user_id__isnull=False,
+        ).values_list('to_user_id', flat=True))
+        # query 期间有 follow / unfollow 提交的话 generation 会变， 这次读到的可能是旧数据， 写回之后马上删掉
+        # 用 cache.add 写回， 不会覆盖 update_following_cache 已经写进去的新数据
+        if cache.add(key, following_ids) and cache.get(generation_key) != generation:
+            cache.delete(key)
+        return set(following_ids)
+
+    @classmethod
+    def get_celebrity_following_ids(cls, user_id):
+        """
+        user 关注的人里面的明星用户， 每次读 newsfeed 都要用到
+        不需要每次都读出所有 following ids 再逐个检查明星用户的标记， 结果在 cache 中保存 CELEBRITY_FOLLOWINGS_CACHE_TIMEOUT 秒
+        follow / unfollow 之后在 update_following_cache 中失效
+        关注的人刚刚变成明星用户的时候， 最多要等这么多秒才会开始拉取他的 tweets （拉取的是 timeline， 不会漏掉）
+        """
+        key = CELEBRITY_FOLLOWINGS_PATTERN.format(user_id=user_id)
+        celebrity_ids = cache.get(key)
+        if celebrity_ids is not None:
+            return set(celebrity_ids)
+
+        # 和 following ids 共用一个 generation， 计算期间有 follow / unfollow 提交的话不写回
+        generation_key = FOLLOWING_IDS_GENERATION_PATTERN.format(user_id=user_id)
+        generation = cache.get(generation_key)
+        celebrity_ids = cls.get_celebrity_ids(cls.get_following_user_ids(user_id))
+        timeout = settings.CELEBRITY_FOLLOWINGS_CACHE_TIMEOUT
+        if cache.add(key, array('q', celebrity_ids), timeout) \
+                and cache.get(generation_key) != generation:
+            cache.delete(key)
+        return celebrity_ids
+
+    @classmethod
+    def update_following_cache(cls, from_user_id, added_ids=(), removed_ids=()):
+        """
+        follow / unfollow 之后直接修改 from_user 在 cache 中的那一份， 不需要把所有的 following ids 重新查一遍
+        需要在 transaction 提交之后调用， 否则回滚的 follow 也会被写进 cache
+        读改写的过程用 cache.add 加一个短暂的锁， 避免并发的 follow / unfollow 互相覆盖
+        拿不到锁的时候直接删掉， 下一次读的时候重建
+        开始之前先换掉 generation， 正在从数据库中重建的读请求不会再把旧数据写回来
+        """
+        key = cls.get_following_key(from_user_id)
+        lock_key = FOLLOWING_IDS_LOCK_PATTERN.format(user_id=from_user_id)
+        generation_key = FOLLOWING_IDS_GENERATION_PATTERN.format(user_id=from_user_id)
+        token = uuid.uuid4().hex
+        cache.set(generation_key, token)
+        # 关注的明星用户可能变了， 下一次读 newsfeed 的时候重新计算
+        cache.delete(CELEBRITY_FOLLOWINGS_PATTERN.format(user_id=from_user_id))
+        if not cache.add(lock_key, token, timeout=settings.FOLLOWING_CACHE_LOCK_TIMEOUT):
+            cache.delete(key)
+            return
+        try:
+            following_ids = cache.get(key)
+            # 不在 cache 中的时候什么都不用做， 下一次读的时候会从数据库中读到最新的数据
+            if following_ids is None:
+                return
+            following_ids = set(following_ids) | set(added_ids)
+            following_ids -= set(removed_ids)
+            cache.set(key, array('q', following_ids))
+            # 拿不到锁的 update 在这之间删过一次 key， 刚写进去的不包含它的修改
+            if cache.get(generation_key) != token:
+                cache.delete(key)
+        finally:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    @classmethod
+    def has_followed(cls, viewer, user_ids):
+        """
+        批量判断 viewer 是否关注了 user_ids 中的每一个人， 返回 {user_id: bool}
+        一整页的用户只需要读一次 cache， 未登录的用户都是 False
+        """
+        if viewer is None or not viewer.is_authenticated:
+            return {user_id: False for user_id in user_ids}
+        following_ids = cls.get_following_user_id_set(viewer.id)
+        return {user_id: user_id in following_ids for user_id in user_ids}
+
+    @classmethod
+    def get_recommendations(cls, user, limit):
+        """
+        返回 [(user, score)]， score 是共同关注的人数
+        推荐是离线计算的， 这里再去掉计算之后新关注的人， 每个被推荐的 user 都从 cache 中批量读取
+        """
+        recommendation = ObjectCacheHelper.get_object(FriendshipRecommendation, user.id)
+        if recommendation is None:
+            return []
+        following_ids = cls.get_following_user_id_set(user.id)
+        candidates = [
+            (user_id, score)
+            for user_id, score in zip(
+                recommendation.get_user_ids(),
+                recommendation.get_scores(),
+            )
+            if user_id not in following_ids
+        ][:limit]
+        users = UserService.get_users([user_id for user_id, _ in candidates])
+        # 被删除的用户直接跳过
+        return [
+            (users[user_id], score)
+            for user_id, score in candidates
+            if user_id in users
+        ]
+
+    @classmethod
+    def is_celebrity(cls, user_id):
+        return user_id in cls.get_celebrity_ids([user_id])
+
+    @classmethod
+    def get_celebrity_key(cls, user_id):
+        return CELEBRITY_FLAG_PATTERN.format(user_id=user_id)
+
+    @classmethod
+    def get_cached_celebrity_flag(cls, user_id):
+        # 只读 cache， 不存在的时候返回 None， 不会去查 UserProfile
+        return cache.get(cls.get_celebrity_key(user_id))
+
+    @classmethod
+    def start_celebrity_demotion(cls, user_id):
+        """
+        follower 数量降到阈值以下的时候调用， 同一个用户同时只会有一次降级
+        降级完成之前 cache 中一直标记为明星用户， 读 newsfeed 的时候会继续拉取他的 tweets
+        返回 False 表示已经有一次降级在进行中了
+        """
+        timeout = settings.CELEBRITY_FLAG_CACHE_TIMEOUT
+        if not cache.add(CELEBRITY_DEMOTION_PATTERN.format(user_id=user_id), True, timeout):
+            return False
+        cache.set(cls.get_celebrity_key(user_id), True, timeout)
+        return True
+
+    @classmethod
+    def finish_celebrity_demotion(cls, user_id):
+        # 删掉之后下一次会按照当前的 followers_count 重新判断
+        cache.delete_many([
+            cls.get_celebrity_key(user_id),
+            CELEBRITY_DEMOTION_PATTERN.format(user_id=user_id),
+        ])
+
+    @classmethod
+    def get_celebrity_ids(cls, user_ids):
+        """
+        返回 user_ids 中 follower 数量超过 NEWSFEED_CELEBRITY_THRESHOLD 的用户
+        结果会在 cache 中保存一段时间， 并且可以被所有的读者共享
+        """
+        keys = {user_id: cls.get_celebrity_key(user_id) for user_id in user_ids}
+        cached_flags = cache.get_many(keys.values())
+
+        missing_ids = [
+            user_id for user_id, key in keys.items()
+            if key not in cached_flags
+        ]
+        # 直接读 UserProfile 中反范式化的 followers_count， 所有 miss 的用户一次 query
+        followers_counts = dict(UserProfile.objects.filter(
+            user_id__in=missing_ids,
+        ).values_list('user_id', 'followers_count')) if missing_ids else {}
+
+        celebrity_ids = set()
+        to_set = {}
+        for user_id, key in keys.items():
+            if key in cached_flags:
+                is_celebrity = cached_flags[key]
+            else:
+                is_celebrity = followers_counts.get(user_id, 0) > \
+                    settings.NEWSFEED_CELEBRITY_THRESHOLD
+                to_set[key] = is_celebrity
+            if is_celebrity:
+                celebrity_ids.add(user_id)
+
+        if to_set:
+            cache.set_many(to_set, timeout=settings.CELEBRITY_FLAG_CACHE_TIMEOUT)
+        return celebrity_ids
@@ -1,3 +1,217 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from friendships.models import Friendship, FriendshipRecommendation
+from io import StringIO
+from friendships.services import FriendshipService
+from testing.testcases import TestCase
+from twitter.cache import FOLLOWING_IDS_LOCK_PATTERN
 
-# Create your tests here.
+
+class FriendshipServiceTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+
+    def test_get_follower_id_chunks(self):
+        follower_ids = []
+        for i in range(7):
+            follower = self.create_user('follower{}'.format(i))
+            self.create_friendship(follower, self.linghu)
+            follower_ids.append(follower.id)
+        # 别人的 follower 不会被算进来
+        self.create_friendship(self.create_user('other'), self.create_user('x'))
+
+        chunks = list(FriendshipService.get_follower_id_chunks(
+            self.linghu.id,
+            chunk_size=3,
+        ))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+        self.assertEqual(sum(chunks, []), follower_ids)
+
+        # created_at 相同的时候也不会重复或者遗漏
+        friendship = Friendship.objects.filter(to_user=self.linghu).first()
+        Friendship.objects.filter(to_user=self.linghu).update(
+            created_at=friendship.created_at,
+        )
+        chunks = list(FriendshipService.get_follower_id_chunks(
+            self.linghu.id,
+            chunk_size=2,
+        ))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 2, 1])
+        self.assertEqual(sorted(sum(chunks, [])), sorted(follower_ids))
+
+        # 每个 chunk 只需要一次 query
+        with self.assertNumQueries(3):
+            list(FriendshipService.get_follower_id_chunks(
+                self.linghu.id,
+                chunk_size=3,
+            ))
+        self.assertEqual(list(FriendshipService.get_follower_id_chunks(
+            self.create_user('nobody').id,
+            chunk_size=3,
+        )), [])
+
+    def test_has_followed(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(5)]
+        self.create_friendship(self.linghu, users[1])
+        self.create_friendship(self.linghu, users[3])
+        # 反方向的关注不算
+        self.create_friendship(users[0], self.linghu)
+        user_ids = [user.id for user in users]
+
+        expected = {user.id: False for user in users}
+        expected[users[1].id] = expected[users[3].id] = True
+        self.assertEqual(FriendshipService.has_followed(self.linghu, user_ids), expected)
+        # 之后的判断都在 cache 中
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                FriendshipService.has_followed(self.linghu, user_ids),
+                expected,
+            )
+
+        # follow / unfollow 提交之后直接修改 cache， 不需要重新查数据库
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_friendship(self.linghu, users[0])
+            Friendship.objects.filter(from_user=self.linghu, to_user=users[1]).delete()
+        expected[users[0].id], expected[users[1].id] = True, False
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                FriendshipService.has_followed(self.linghu, user_ids),
+                expected,
+            )
+        self.assertEqual(
+            FriendshipService.has_followed(users[0], user_ids + [self.linghu.id]),
+            {user_id: user_id == self.linghu.id for user_id in user_ids + [self.linghu.id]},
+        )
+
+    def test_update_following_cache(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        self.create_friendship(self.linghu, users[0])
+        FriendshipService.get_following_user_id_set(self.linghu.id)
+
+        # transaction 提交之前 cache 不会被修改， 回滚的 follow 不会被写进 cache
+        # 提交之后执行的有三个： 更新 following ids， 以及两个人的 profile 失效
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.create_friendship(self.linghu, users[1])
+        self.assertEqual(len(callbacks), 3)
+        self.assertEqual(
+            FriendshipService.get_following_user_id_set(self.linghu.id),
+            {users[0].id},
+        )
+
+        # 有并发的修改拿不到锁的时候直接删掉， 下一次读的时候重建
+        cache.set(FOLLOWING_IDS_LOCK_PATTERN.format(user_id=self.linghu.id), 'other')
+        FriendshipService.update_following_cache(self.linghu.id, added_ids=[users[2].id])
+        self.assertIsNone(cache.get(FriendshipService.get_following_key(self.linghu.id)))
+        self.assertEqual(
+            FriendshipService.get_following_user_id_set(self.linghu.id),
+            {users[0].id, users[1].id},
+        )
+
+    def test_rebuild_does_not_overwrite_newer_follow(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(2)]
+        self.create_friendship(self.linghu, users[0])
+        key = FriendshipService.get_following_key(self.linghu.id)
+
+        # 重建的 query 读到的是旧数据， 写回 cache 之前 follow 提交了
+        # update 的时候 cache 中还没有这个 key， 什么都不会写
+        def follow_during_rebuild(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            FriendshipService.update_following_cache(self.linghu.id, added_ids=[users[1].id])
+            return result
+
+        with connection.execute_wrapper(follow_during_rebuild):
+            following_ids = FriendshipService.get_following_user_id_set(self.linghu.id)
+        self.assertEqual(following_ids, {users[0].id})
+        # 旧的数据不会留在 cache 中
+        self.assertIsNone(cache.get(key))
+
+        # 没有并发修改的时候正常写回
+        FriendshipService.get_following_user_id_set(self.linghu.id)
+        self.assertIsNotNone(cache.get(key))
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=1)
+    def test_get_celebrity_following_ids(self):
+        celebrity = self.create_user('celebrity')
+        other = self.create_user('other')
+        self.create_friendship(self.create_user('fan'), celebrity)
+        self.create_friendship(self.linghu, celebrity)
+        self.create_friendship(self.linghu, other)
+
+        # 第一次读 following ids 和明星用户的标记， 之后只读一次 cache
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                FriendshipService.get_celebrity_following_ids(self.linghu.id),
+                {celebrity.id},
+            )
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                FriendshipService.get_celebrity_following_ids(self.linghu.id),
+                {celebrity.id},
+            )
+
+        # unfollow 提交之后重新计算
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.filter(from_user=self.linghu, to_user=celebrity).delete()
+        self.assertEqual(FriendshipService.get_celebrity_following_ids(self.linghu.id), set())
+
+
+class RecommendationEngineTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.users = [self.create_user('user{}'.format(i)) for i in range(4)]
+        a, b, c, d = self.users
+        for from_user, to_user in [
+            (self.linghu, a), (self.linghu, b),
+            (a, c), (a, d),
+            (b, c), (b, self.linghu),
+            (d, self.linghu),
+        ]:
+            self.create_friendship(from_user, to_user)
+
+    def get_recommendations(self, user):
+        return [
+            (recommended.id, score)
+            for recommended, score in FriendshipService.get_recommendations(user, 10)
+        ]
+
+    def test_compute(self):
+        a, b, c, d = self.users
+        out = StringIO()
+        # 很小的 chunk 和 block， 分批读取和分批计算的结果是一样的
+        call_command(
+            'compute_recommendations',
+            edge_chunk_size=2,
+            block_size=2,
+            stdout=out,
+        )
+        self.assertIn('7 edges loaded', out.getvalue())
+        # 关注了 a 和 b， a 和 b 都关注了 c， 已经关注的人和自己都不会被推荐
+        self.assertEqual(self.get_recommendations(self.linghu), [(c.id, 2), (d.id, 1)])
+        self.assertEqual(self.get_recommendations(d), [(a.id, 1), (b.id, 1)])
+        # c 没有关注任何人
+        self.assertEqual(self.get_recommendations(c), [])
+
+        # 之后新关注的人马上就不会再被推荐
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_friendship(self.linghu, d)
+        self.assertEqual(self.get_recommendations(self.linghu), [(c.id, 2)])
+
+        # top_k 只保留分数最高的
+        call_command('compute_recommendations', top_k=1, stdout=StringIO())
+        self.assertEqual(self.get_recommendations(d), [(a.id, 1)])
+
+        # 取关了所有人之后， 旧的推荐会被删掉
+        # a 关注的 c 和 d 都不再关注任何人， a 也没有可以推荐的人了
+        Friendship.objects.filter(from_user=d).delete()
+        out = StringIO()
+        call_command('compute_recommendations', stdout=out)
+        self.assertIn('2 users recommended, 2 stale recommendations removed', out.getvalue())
+        self.assertEqual(self.get_recommendations(a), [])
+        self.assertEqual(self.get_recommendations(d), [])
+        self.assertFalse(FriendshipRecommendation.objects.filter(user=d).exists())
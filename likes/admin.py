@@ -1,5 +1,5 @@
 from django.contrib import admin
-from likes.models import Like
+from likes.models import Like, LikeCounterShard
 
 
 @admin.register(Like)
@@ -14,3 +14,8 @@ class LikeAdmin(admin.ModelAdmin):
     list_filter = ('content_type',)
     date_hierarchy = 'created_at'
 
+
+@admin.register(LikeCounterShard)
+class LikeCounterShardAdmin(admin.ModelAdmin):
+    list_display = ('content_type', 'object_id', 'shard', 'count')
+    list_filter = ('content_type',)
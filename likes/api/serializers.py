@@ -0,0 +1,89 @@
+from accounts.api.serializers import UserSerializerForLike
+from comments.models import Comment
+from django.db import IntegrityError, transaction
+from likes.models import Like
+from likes.services import LikeBufferService, LikeService
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from tweets.models import Tweet
+
+
+class LikeSerializer(serializers.ModelSerializer):
+    user = UserSerializerForLike()
+
+    class Meta:
+        model = Like
+        fields = ('user', 'created_at')
+
+
+class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
+    # 前端传过来的是 'tweet' 或者 'comment'， 而不是 content type 的 id
+    content_type = serializers.ChoiceField(choices=['comment', 'tweet'])
+    object_id = serializers.IntegerField()
+
+    class Meta:
+        model = Like
+        fields = ('content_type', 'object_id')
+
+    def _get_model_class(self, data):
+        if data['content_type'] == 'comment':
+            return Comment
+        if data['content_type'] == 'tweet':
+            return Tweet
+        return None
+
+    def _get_filter_kwargs(self, validated_data):
+        return {
+            'content_type_id': LikeService.get_content_type_id(
+                self._get_model_class(validated_data),
+            ),
+            'object_id': validated_data['object_id'],
+            'user': self.context['request'].user,
+        }
+
+    def validate(self, data):
+        model_class = self._get_model_class(data)
+        if not model_class.objects.filter(id=data['object_id']).exists():
+            raise ValidationError({'object_id': 'Object does not exist'})
+        return data
+
+    def enqueue(self, liked):
+        # LIKE_WRITE_BEHIND 打开的时候不直接写数据库， 而是放进 write-behind 队列
+        kwargs = self._get_filter_kwargs(self.validated_data)
+        return LikeBufferService.push(
+            kwargs['user'].id,
+            kwargs['content_type_id'],
+            kwargs['object_id'],
+            liked,
+        )
+
+
+class LikeSerializerForCreate(BaseLikeSerializerForCreateAndCancel):
+
+    def get_or_create(self):
+        """
+        不先查一次是否已经点过赞再去创建（两个并发的请求可能都查到没有点过赞）
+        而是直接 INSERT， 由 ('user', 'content_type', 'object_id') 的唯一索引保证不会重复点赞
+        返回 (like, created)
+        """
+        kwargs = self._get_filter_kwargs(self.validated_data)
+        try:
+            # savepoint， 唯一索引冲突之后外层的 transaction 还可以继续使用
+            with transaction.atomic():
+                return Like.objects.create(**kwargs), True
+        except IntegrityError:
+            return Like.objects.get(**kwargs), False
+
+
+class LikeSerializerForCancel(BaseLikeSerializerForCreateAndCancel):
+
+    def cancel(self):
+        """
+        直接按照唯一索引删除， 没有点过赞的时候删除 0 条， 重复取消也不会出错
+        queryset 的 delete 同样会触发 post_delete， 点赞数会被正确地减掉
+        返回删除的条数
+        """
+        deleted, _ = Like.objects.filter(
+            **self._get_filter_kwargs(self.validated_data),
+        ).delete()
+        return deleted
@@ -0,0 +1,261 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.test import override_settings
+from likes.models import Like
+from likes.services import LikeBufferService
+from rest_framework.test import APIClient
+from testing.testcases import TestCase
+from twitter.cache import LIKE_BUFFER_LOCK_KEY
+
+
+LIKE_BASE_URL = '/api/likes/'
+LIKE_CANCEL_URL = '/api/likes/cancel/'
+TWEET_LIST_API = '/api/tweets/'
+TWEET_RETRIEVE_API = '/api/tweets/{}/'
+NEWSFEED_LIST_API = '/api/newsfeeds/'
+
+
+class LikeApiTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.linghu_client = APIClient()
+        self.linghu_client.force_authenticate(self.linghu)
+        self.dongxie = self.create_user('dongxie')
+        self.dongxie_client = APIClient()
+        self.dongxie_client.force_authenticate(self.dongxie)
+
+    def test_tweet_likes(self):
+        tweet = self.create_tweet(self.linghu)
+        data = {'content_type': 'tweet', 'object_id': tweet.id}
+
+        # 需要登录
+        response = self.anonymous_client.post(LIKE_BASE_URL, data)
+        self.assertEqual(response.status_code, 403)
+        # get 不允许
+        response = self.linghu_client.get(LIKE_BASE_URL, data)
+        self.assertEqual(response.status_code, 405)
+        # 参数不全或者不对
+        response = self.linghu_client.post(LIKE_BASE_URL, {'content_type': 'tweet'})
+        self.assertEqual(response.status_code, 400)
+        response = self.linghu_client.post(LIKE_BASE_URL, {
+            'content_type': 'twitter',
+            'object_id': tweet.id,
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('content_type', response.data['errors'])
+        response = self.linghu_client.post(LIKE_BASE_URL, {
+            'content_type': 'tweet',
+            'object_id': -1,
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('object_id', response.data['errors'])
+
+        # 点赞成功
+        response = self.linghu_client.post(LIKE_BASE_URL, data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['user']['id'], self.linghu.id)
+        self.assertEqual(Like.objects.count(), 1)
+
+        # 重复点赞是幂等的
+        response = self.linghu_client.post(LIKE_BASE_URL, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Like.objects.count(), 1)
+        self.dongxie_client.post(LIKE_BASE_URL, data)
+        self.assertEqual(Like.objects.count(), 2)
+
+    def test_comment_likes(self):
+        tweet = self.create_tweet(self.linghu)
+        comment = self.create_comment(self.dongxie, tweet)
+        data = {'content_type': 'comment', 'object_id': comment.id}
+
+        response = self.linghu_client.post(LIKE_BASE_URL, data)
+        self.assertEqual(response.status_code, 201)
+        like = Like.objects.get()
+        self.assertEqual(like.content_type, ContentType.objects.get_for_model(comment))
+        self.assertEqual(like.object_id, comment.id)
+
+    def test_cancel(self):
+        tweet = self.create_tweet(self.linghu)
+        comment = self.create_comment(self.dongxie, tweet)
+        like_tweet_data = {'content_type': 'tweet', 'object_id': tweet.id}
+        like_comment_data = {'content_type': 'comment', 'object_id': comment.id}
+        self.linghu_client.post(LIKE_BASE_URL, like_tweet_data)
+        self.linghu_client.post(LIKE_BASE_URL, like_comment_data)
+        self.dongxie_client.post(LIKE_BASE_URL, like_comment_data)
+
+        # 需要登录， 参数要正确
+        response = self.anonymous_client.post(LIKE_CANCEL_URL, like_comment_data)
+        self.assertEqual(response.status_code, 403)
+        response = self.linghu_client.post(LIKE_CANCEL_URL, {'content_type': 'comment'})
+        self.assertEqual(response.status_code, 400)
+
+        # 只会取消自己的赞
+        response = self.linghu_client.post(LIKE_CANCEL_URL, like_comment_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['deleted'], 1)
+        self.assertEqual(Like.objects.count(), 2)
+        self.assertTrue(Like.objects.filter(user=self.dongxie).exists())
+
+        # 重复取消是幂等的
+        response = self.linghu_client.post(LIKE_CANCEL_URL, like_comment_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['deleted'], 0)
+
+        response = self.linghu_client.post(LIKE_CANCEL_URL, like_tweet_data)
+        self.assertEqual(response.data['deleted'], 1)
+        self.assertEqual(Like.objects.count(), 1)
+
+    def test_has_liked(self):
+        tweets = [self.create_tweet(self.linghu) for i in range(3)]
+        self.create_like(self.dongxie, tweets[1])
+        self.create_like(self.linghu, tweets[2])
+
+        response = self.dongxie_client.get(TWEET_LIST_API, {'user_id': self.linghu.id})
+        self.assertEqual(
+            {tweet['id']: tweet['has_liked'] for tweet in response.data['tweets']},
+            {tweets[0].id: False, tweets[1].id: True, tweets[2].id: False},
+        )
+        response = self.anonymous_client.get(TWEET_LIST_API, {'user_id': self.linghu.id})
+        self.assertFalse(any(tweet['has_liked'] for tweet in response.data['tweets']))
+
+        response = self.dongxie_client.get(TWEET_RETRIEVE_API.format(tweets[1].id))
+        self.assertEqual(response.data['has_liked'], True)
+        response = self.linghu_client.get(TWEET_RETRIEVE_API.format(tweets[1].id))
+        self.assertEqual(response.data['has_liked'], False)
+
+        self.create_friendship(self.dongxie, self.linghu)
+        for tweet in tweets:
+            self.create_newsfeed(self.dongxie, tweet)
+        response = self.dongxie_client.get(NEWSFEED_LIST_API)
+        self.assertEqual(
+            [newsfeed['tweet']['has_liked'] for newsfeed in response.data['newsfeeds']],
+            [False, True, False],
+        )
+
+    def test_has_liked_is_batched(self):
+        tweets = [self.create_tweet(self.linghu) for i in range(10)]
+        for tweet in tweets[::2]:
+            self.create_like(self.dongxie, tweet)
+        self.dongxie_client.get(TWEET_LIST_API, {'user_id': self.linghu.id})
+
+        # 所有的 tweets 都在 cache 中之后， 整页的 has_liked 只需要一次 query
+        with self.assertNumQueries(1):
+            response = self.dongxie_client.get(TWEET_LIST_API, {
+                'user_id': self.linghu.id,
+            })
+        self.assertEqual(
+            sum(tweet['has_liked'] for tweet in response.data['tweets']),
+            5,
+        )
+
+    @override_settings(LIKE_WRITE_BEHIND=True)
+    def test_write_behind(self):
+        tweet = self.create_tweet(self.linghu)
+        data = {'content_type': 'tweet', 'object_id': tweet.id}
+
+        # 参数依然会被检查
+        response = self.dongxie_client.post(LIKE_BASE_URL, {
+            'content_type': 'tweet',
+            'object_id': -1,
+        })
+        self.assertEqual(response.status_code, 400)
+
+        response = self.dongxie_client.post(LIKE_BASE_URL, data)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Like.objects.count(), 0)
+        # 点赞的人马上可以看到自己的点赞， 其他人要等到 flush 之后
+        response = self.dongxie_client.get(TWEET_RETRIEVE_API.format(tweet.id))
+        self.assertEqual(response.data['has_liked'], True)
+        self.assertEqual(response.data['likes_count'], 1)
+        response = self.linghu_client.get(TWEET_RETRIEVE_API.format(tweet.id))
+        self.assertEqual(response.data['likes_count'], 0)
+        self.assertEqual(response.data['likes'], [])
+
+        self.linghu_client.post(LIKE_BASE_URL, data)
+        self.assertEqual(LikeBufferService.flush(batch_size=100), (2, 2))
+        self.assertEqual(Like.objects.count(), 2)
+        response = self.linghu_client.get(TWEET_RETRIEVE_API.format(tweet.id))
+        self.assertEqual(response.data['likes_count'], 2)
+        self.assertEqual(response.data['has_liked'], True)
+        # flush 之后点赞列表的 cache 也失效了
+        self.assertEqual(
+            {like['user']['username'] for like in response.data['likes']},
+            {'linghu', 'dongxie'},
+        )
+        # 队列已经空了
+        self.assertEqual(LikeBufferService.flush(batch_size=100), (0, 0))
+
+        # 取消点赞之后马上看不到， flush 之后真正删除
+        response = self.dongxie_client.post(LIKE_CANCEL_URL, data)
+        self.assertEqual(response.status_code, 202)
+        response = self.dongxie_client.get(TWEET_RETRIEVE_API.format(tweet.id))
+        self.assertEqual(response.data['has_liked'], False)
+        self.assertEqual(response.data['likes_count'], 1)
+        LikeBufferService.flush(batch_size=100)
+        self.assertEqual(Like.objects.count(), 1)
+        response = self.linghu_client.get(TWEET_RETRIEVE_API.format(tweet.id))
+        self.assertEqual(response.data['likes_count'], 1)
+        self.assertEqual(
+            [like['user']['username'] for like in response.data['likes']],
+            ['linghu'],
+        )
+
+    @override_settings(LIKE_WRITE_BEHIND=True)
+    def test_write_behind_coalesces_events(self):
+        tweets = [self.create_tweet(self.linghu) for i in range(3)]
+        for tweet in tweets:
+            data = {'content_type': 'tweet', 'object_id': tweet.id}
+            self.dongxie_client.post(LIKE_BASE_URL, data)
+            self.dongxie_client.post(LIKE_CANCEL_URL, data)
+            self.dongxie_client.post(LIKE_BASE_URL, data)
+        # 点赞又取消的两个事件抵消， 什么都不写
+        data = {'content_type': 'tweet', 'object_id': tweets[0].id}
+        self.linghu_client.post(LIKE_BASE_URL, data)
+        self.linghu_client.post(LIKE_CANCEL_URL, data)
+
+        # 分两次 flush， 第二次从上一次停下的地方继续
+        self.assertEqual(LikeBufferService.flush(batch_size=5), (5, 2))
+        self.assertEqual(LikeBufferService.flush(batch_size=100), (6, 3))
+        self.assertEqual(Like.objects.filter(user=self.dongxie).count(), 3)
+        self.assertEqual(Like.objects.filter(user=self.linghu).count(), 0)
+
+        response = self.linghu_client.get(TWEET_LIST_API, {'user_id': self.linghu.id})
+        self.assertEqual(
+            [tweet['likes_count'] for tweet in response.data['tweets']],
+            [1, 1, 1],
+        )
+
+    def test_write_behind_counts_only_written_rows(self):
+        tweet = self.create_tweet(self.linghu)
+        tweet_type_id = ContentType.objects.get_for_model(tweet).id
+        # flush 查完已经存在的点赞之后， 其他请求又直接点了同一个赞
+        self.create_like(self.dongxie, tweet)
+        created = LikeBufferService._insert_likes([
+            Like(user_id=user.id, content_type_id=tweet_type_id, object_id=tweet.id)
+            for user in [self.dongxie, self.linghu]
+        ])
+        self.assertEqual([like.user_id for like in created], [self.linghu.id])
+        self.assertEqual(Like.objects.filter(object_id=tweet.id).count(), 2)
+
+        # 要删除的点赞已经被其他请求直接删掉了
+        likes = list(Like.objects.filter(object_id=tweet.id).order_by('id'))
+        likes[0].delete()
+        deleted = LikeBufferService._delete_likes([like.id for like in likes])
+        self.assertEqual(deleted, [(likes[1].id, tweet.id)])
+        self.assertEqual(Like.objects.filter(object_id=tweet.id).count(), 0)
+
+    @override_settings(LIKE_WRITE_BEHIND=True)
+    def test_write_behind_lock(self):
+        tweet = self.create_tweet(self.linghu)
+        self.dongxie_client.post(LIKE_BASE_URL, {'content_type': 'tweet', 'object_id': tweet.id})
+
+        # 另一个 flush 还在执行的时候什么都不做， 也不会释放别人的锁
+        cache.set(LIKE_BUFFER_LOCK_KEY, 'other')
+        self.assertEqual(LikeBufferService.flush(batch_size=100), (0, 0))
+        self.assertEqual(cache.get(LIKE_BUFFER_LOCK_KEY), 'other')
+
+        cache.delete(LIKE_BUFFER_LOCK_KEY)
+        self.assertEqual(LikeBufferService.flush(batch_size=100), (1, 1))
+        self.assertIsNone(cache.get(LIKE_BUFFER_LOCK_KEY))
@@ -0,0 +1,62 @@
+from likes.api.serializers import (
+    LikeSerializer,
+    LikeSerializerForCancel,
+    LikeSerializerForCreate,
+)
+from django.conf import settings
+from likes.models import Like
+from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from utils.decorators import required_params
+
+
+class LikeViewSet(viewsets.GenericViewSet):
+    queryset = Like.objects.all()
+    permission_classes = [IsAuthenticated]
+    serializer_class = LikeSerializerForCreate
+
+    @required_params(request_attr='data', params=['content_type', 'object_id'])
+    def create(self, request, *args, **kwargs):
+        # POST /api/likes/ 点赞， 已经点过赞的时候直接返回之前的那个赞
+        serializer = LikeSerializerForCreate(
+            data=request.data,
+            context={'request': request},
+        )
+        if not serializer.is_valid():
+            return Response({
+                'message': 'Please check input',
+                'errors': serializer.errors,
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if settings.LIKE_WRITE_BEHIND:
+            # 202: 点赞已经被接受， 会在下一次 flush 的时候写入数据库
+            serializer.enqueue(liked=True)
+            return Response({'success': True}, status=status.HTTP_202_ACCEPTED)
+        instance, created = serializer.get_or_create()
+        return Response(
+            LikeSerializer(instance).data,
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
+
+    @action(methods=['POST'], detail=False)
+    @required_params(request_attr='data', params=['content_type', 'object_id'])
+    def cancel(self, request, *args, **kwargs):
+        # POST /api/likes/cancel/ 取消点赞， 没有点过赞的时候也返回成功
+        serializer = LikeSerializerForCancel(
+            data=request.data,
+            context={'request': request},
+        )
+        if not serializer.is_valid():
+            return Response({
+                'message': 'Please check input',
+                'errors': serializer.errors,
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if settings.LIKE_WRITE_BEHIND:
+            serializer.enqueue(liked=False)
+            return Response({'success': True}, status=status.HTTP_202_ACCEPTED)
+        deleted = serializer.cancel()
+        return Response({
+            'success': True,
+            'deleted': deleted,
+        }, status=status.HTTP_200_OK)
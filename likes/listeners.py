@@ -0,0 +1,23 @@
+def _update_likes_count(instance, delta):
+    if instance.content_type_id is None:
+        return
+    # 在函数内部 import 避免循环依赖
+    from likes.services import LikeService
+    # 不直接更新 Tweet / Comment 那一行的 likes_count， 而是更新一个随机的分片
+    # 热门 tweet 的点赞不会都去抢同一个行锁
+    LikeService.incr_likes_count(instance.content_type_id, instance.object_id, delta)
+    # 新的点赞插入到 object 在 cache 中的点赞列表里， 取消点赞的时候让列表失效
+    if delta > 0:
+        LikeService.push_cached_likes(instance)
+    else:
+        LikeService.invalidate_cached_likes(instance.content_type_id, [instance.object_id])
+
+
+def incr_likes_count(sender, instance, created, **kwargs):
+    if not created:
+        return
+    _update_likes_count(instance, 1)
+
+
+def decr_likes_count(sender, instance, **kwargs):
+    _update_likes_count(instance, -1)
@@ -0,0 +1,106 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from likes.models import LikeCounterShard
+from likes.services import LikeService
+from tweets.models import Tweet
+
+# 不存在的 object_id， 压测的数据不会影响到真实的 tweet， 结束之后会被删掉
+BENCHMARK_OBJECT_ID = 0
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure like counter throughput when many threads like the same tweet '
+        'concurrently, with a single counter row versus sharded counter rows. '
+        'Run it against MySQL: SQLite locks the whole database on every write.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--likes-per-thread', type=int, default=50)
+        parser.add_argument(
+            '--shards',
+            type=int,
+            default=settings.LIKE_COUNTER_SHARDS,
+            help='Number of counter shards for the sharded run.',
+        )
+        parser.add_argument(
+            '--hold-ms',
+            type=float,
+            default=5,
+            help=(
+                'Milliseconds each transaction keeps running after the counter '
+                'update, standing in for the rest of the like request.'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        content_type_id = LikeService.get_content_type_id(Tweet)
+        results = {}
+        for shards in [1, options['shards']]:
+            results[shards] = self.run(content_type_id, shards, options)
+            self.stdout.write('{} shard(s): {} likes in {:.2f}s ({:.1f} likes/s)'.format(
+                shards,
+                results[shards]['likes'],
+                results[shards]['elapsed'],
+                results[shards]['throughput'],
+            ))
+        self.stdout.write('speedup: {:.2f}x'.format(
+            results[options['shards']]['throughput'] / results[1]['throughput'],
+        ))
+
+    def run(self, content_type_id, shards, options):
+        self.cleanup(content_type_id)
+        errors = []
+
+        def worker():
+            try:
+                for i in range(options['likes_per_thread']):
+                    with transaction.atomic():
+                        LikeService.incr_likes_count(
+                            content_type_id,
+                            BENCHMARK_OBJECT_ID,
+                            1,
+                            shards=shards,
+                        )
+                        # 行锁会一直持有到 transaction 结束
+                        time.sleep(options['hold_ms'] / 1000)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # 每个线程都有自己的数据库连接， 用完之后要关掉
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker)
+            for i in range(options['threads'])
+        ]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        if errors:
+            raise errors[0]
+
+        likes = sum(LikeCounterShard.objects.filter(
+            content_type_id=content_type_id,
+            object_id=BENCHMARK_OBJECT_ID,
+        ).values_list('count', flat=True))
+        self.cleanup(content_type_id)
+        return {
+            'likes': likes,
+            'elapsed': elapsed,
+            'throughput': likes / elapsed if elapsed else 0,
+        }
+
+    def cleanup(self, content_type_id):
+        LikeCounterShard.objects.filter(
+            content_type_id=content_type_id,
+            object_id=BENCHMARK_OBJECT_ID,
+        ).delete()
@@ -1,7 +1,9 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
+from likes.listeners import incr_likes_count, decr_likes_count
 
 
 class Like(models.Model):
@@ -37,4 +39,38 @@ class Like(models.Model):
             self.user,
             self.content_type,
             self.content_type_id,
-        )
\ No newline at end of file
+        )
+
+
+class LikeCounterShard(models.Model):
+    """
+    点赞数的分片计数器
+    热门 tweet 的点赞如果都去更新 Tweet 那一行的 likes_count， 所有的点赞都会排队等同一个行锁
+    这里每次点赞 / 取消点赞随机更新 (content_type, object_id) 的 K 个分片中的一个， 锁被分散到了 K 行上
+    分片中的计数会由 fold_like_counters_task 定期合并回 Tweet / Comment 的 likes_count 中
+    真实的点赞数 = likes_count + 所有分片中的 count
+    """
+    content_type = models.ForeignKey(
+        ContentType,
+        on_delete=models.SET_NULL,
+        null=True,
+    )
+    object_id = models.PositiveIntegerField()
+    shard = models.PositiveSmallIntegerField()
+    # 还没有被合并的增量， 取消点赞的时候可能是负数
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'shard'),)
+
+    def __str__(self):
+        return '{} {} shard {}: {}'.format(
+            self.content_type,
+            self.object_id,
+            self.shard,
+            self.count,
+        )
+
+
+post_save.connect(incr_likes_count, sender=Like)
+post_delete.connect(decr_likes_count, sender=Like)
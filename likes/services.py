@@ -0,0 +1,556 @@
+import random
+import uuid
+
+from accounts.services import UserService
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from likes.models import Like, LikeCounterShard
+from likes.tasks import invalidate_folded_objects_task
+from twitter.cache import (
+    LIKE_BUFFER_EVENT_PATTERN,
+    LIKE_BUFFER_HEAD_KEY,
+    LIKE_BUFFER_HOLE_PATTERN,
+    LIKE_BUFFER_LOCK_KEY,
+    LIKE_BUFFER_TAIL_KEY,
+    LIKE_OVERLAY_PATTERN,
+    OBJECT_LIKES_PATTERN,
+    PENDING_LIKES_COUNT_PATTERN,
+)
+from utils.list_cache import ListCacheHelper
+from utils.object_cache import ObjectCacheHelper
+from utils.queryset_helpers import evaluate_sliced_querysets
+
+
+class LikeService(object):
+
+    @classmethod
+    def get_content_type_id(cls, model_class):
+        """
+        Like 表是通用的， 每次查询都需要 content_type_id
+        ContentType.objects 自己会把解析过的 content type 缓存在进程内， 只有第一次会查数据库
+        """
+        return ContentType.objects.get_for_model(model_class).id
+
+    @classmethod
+    def get_likes_key(cls, content_type_id, object_id):
+        return OBJECT_LIKES_PATTERN.format(
+            content_type_id=content_type_id,
+            object_id=object_id,
+        )
+
+    @classmethod
+    def likes_for(cls, model_class, object_ids):
+        """
+        返回 {object_id: [like, ...]}， 每个 object 只有最新的 LIKES_PREVIEW_SIZE 个点赞， 按照 created_at 倒序
+        每个 object 的点赞在 cache 中以 (id, user_id, created_at) 的形式单独保存， 长度有上限， 热门 tweet 也不会变大
+        cache miss 的 objects 每个都走 ('content_type', 'object_id', 'created_at') 的联合索引只读最新的几条，
+        MySQL 上合成一次 UNION ALL 的 query
+        返回的 like 没有 user， 需要的时候用 UserService.attach_users 批量挂上
+        """
+        content_type_id = cls.get_content_type_id(model_class)
+        limit = settings.LIKES_PREVIEW_SIZE
+        keys = {
+            cls.get_likes_key(content_type_id, object_id): object_id
+            for object_id in set(object_ids)
+        }
+
+        def load_from_db(missing_keys):
+            entries = {key: [] for key in missing_keys}
+            for like_id, object_id, user_id, created_at in evaluate_sliced_querysets([
+                Like.objects.filter(
+                    content_type_id=content_type_id,
+                    object_id=keys[key],
+                ).order_by('-created_at', '-id').values_list(
+                    'id', 'object_id', 'user_id', 'created_at',
+                )[:limit]
+                for key in missing_keys
+            ]):
+                entries[cls.get_likes_key(content_type_id, object_id)].append(
+                    (like_id, user_id, created_at),
+                )
+            # UNION ALL 之后的顺序是不确定的， 每个 object 再排一次
+            for object_entries in entries.values():
+                object_entries.sort(key=lambda entry: (entry[2], entry[0]), reverse=True)
+            return entries
+
+        entries = ListCacheHelper.load_many_entries(list(keys), load_from_db)
+        return {
+            object_id: [
+                Like(
+                    id=like_id,
+                    user_id=user_id,
+                    content_type_id=content_type_id,
+                    object_id=object_id,
+                    created_at=created_at,
+                )
+                for like_id, user_id, created_at in entries[key]
+            ]
+            for key, object_id in keys.items()
+        }
+
+    @classmethod
+    def likes_for_tweets(cls, tweet_ids):
+        # 在函数内部 import 避免循环依赖
+        from tweets.models import Tweet
+        return cls.likes_for(Tweet, tweet_ids)
+
+    @classmethod
+    def likes_for_comments(cls, comment_ids):
+        from comments.models import Comment
+        return cls.likes_for(Comment, comment_ids)
+
+    @classmethod
+    def attach_likes_preview(cls, objects):
+        """
+        objects 是同一种 model 的 instances， 给每一个挂上 preview_likes （最新的几个点赞， 带着点赞的 user）
+        所有 objects 一次 likes_for， 所有点赞的 users 一次 UserService.attach_users
+        """
+        if not objects:
+            return objects
+        likes = cls.likes_for(objects[0].__class__, [obj.id for obj in objects])
+        UserService.attach_users([like for object_likes in likes.values() for like in object_likes])
+        for obj in objects:
+            obj.preview_likes = likes[obj.id]
+        return objects
+
+    @classmethod
+    def push_cached_likes(cls, like):
+        # 新的点赞直接插入到 object 在 cache 中的列表里
+        ListCacheHelper.push_entries(
+            {
+                cls.get_likes_key(like.content_type_id, like.object_id): (
+                    like.id,
+                    like.user_id,
+                    like.created_at,
+                ),
+            },
+            fields=('id', 'user_id', 'created_at'),
+            limit=settings.LIKES_PREVIEW_SIZE,
+        )
+
+    @classmethod
+    def invalidate_cached_likes(cls, content_type_id, object_ids):
+        ListCacheHelper.invalidate_many([
+            cls.get_likes_key(content_type_id, object_id)
+            for object_id in object_ids
+        ])
+
+    @classmethod
+    def incr_likes_count(cls, content_type_id, object_id, delta, shards=None):
+        """
+        随机选一个分片用 F() 原子地加上 delta
+        分片不存在的时候创建， 并发创建同一个分片的时候唯一索引会冲突， 冲突之后再 update 一次
+        """
+        if shards is None:
+            shards = settings.LIKE_COUNTER_SHARDS
+        shard = random.randrange(shards)
+        queryset = LikeCounterShard.objects.filter(
+            content_type_id=content_type_id,
+            object_id=object_id,
+            shard=shard,
+        )
+        if queryset.update(count=F('count') + delta):
+            return
+        try:
+            # savepoint， 冲突的时候不会让外层的 transaction 失效
+            with transaction.atomic():
+                LikeCounterShard.objects.create(
+                    content_type_id=content_type_id,
+                    object_id=object_id,
+                    shard=shard,
+                    count=delta,
+                )
+        except IntegrityError:
+            queryset.update(count=F('count') + delta)
+
+    @classmethod
+    def get_pending_key(cls, content_type_id, object_id):
+        return PENDING_LIKES_COUNT_PATTERN.format(
+            content_type_id=content_type_id,
+            object_id=object_id,
+        )
+
+    @classmethod
+    def count_pending_likes(cls, content_type_id, object_ids):
+        # {object_id: 所有分片中还没有被合并的点赞数之和}， 直接查数据库
+        return {
+            row['object_id']: row['total']
+            for row in LikeCounterShard.objects.filter(
+                content_type_id=content_type_id,
+                object_id__in=object_ids,
+            ).values('object_id').annotate(total=Sum('count')).order_by()
+        }
+
+    @classmethod
+    def get_pending_likes_counts(cls, content_type_id, object_ids):
+        """
+        和 count_pending_likes 一样， 但是结果会在 cache 中保存 PENDING_LIKES_COUNT_CACHE_TIMEOUT 秒
+        热门 tweet 被频繁读取的时候不需要每次都去对分片求和， 代价是点赞数会有几秒钟的延迟
+        """
+        keys = {
+            cls.get_pending_key(content_type_id, object_id): object_id
+            for object_id in object_ids
+        }
+        counts = {
+            keys[key]: count
+            for key, count in cache.get_many(keys.keys()).items()
+        }
+        missing_ids = set(object_ids) - set(counts.keys())
+        if missing_ids:
+            db_counts = cls.count_pending_likes(content_type_id, missing_ids)
+            db_counts = {
+                object_id: db_counts.get(object_id, 0)
+                for object_id in missing_ids
+            }
+            cache.set_many(
+                {
+                    cls.get_pending_key(content_type_id, object_id): count
+                    for object_id, count in db_counts.items()
+                },
+                timeout=settings.PENDING_LIKES_COUNT_CACHE_TIMEOUT,
+            )
+            counts.update(db_counts)
+        return counts
+
+    @classmethod
+    def prime_likes_counts(cls, objects):
+        """
+        objects 是同一种 model （Tweet 或者 Comment） 的 instances
+        把分片中还没有被合并的点赞数加到 likes_count 上， 之后序列化的时候显示的就是真实的点赞数
+        注意被 prime 过的 instance 不能再 save， 否则分片中的计数会被重复计算
+        """
+        if not objects:
+            return objects
+        content_type_id = cls.get_content_type_id(objects[0].__class__)
+        pending = cls.get_pending_likes_counts(
+            content_type_id,
+            {obj.id for obj in objects},
+        )
+        for obj in objects:
+            obj.likes_count += pending.get(obj.id, 0)
+        return objects
+
+    @classmethod
+    def get_liked_object_ids(cls, user, content_type_id, object_ids):
+        """
+        user 在 object_ids 中给哪些点过赞
+        一页的数据只需要一次 object_id__in 的 query， 走 ('user', 'content_type', 'created_at') 的联合索引
+        """
+        if not object_ids:
+            return set()
+        return set(Like.objects.filter(
+            user_id=user.id,
+            content_type_id=content_type_id,
+            object_id__in=object_ids,
+        ).values_list('object_id', flat=True))
+
+    @classmethod
+    def prime_has_liked(cls, objects, user):
+        # 给 objects （同一种 model） 批量设置 has_liked， 未登录的用户都是 False
+        if not objects:
+            return objects
+        liked_ids, overlay = set(), {}
+        if user is not None and user.is_authenticated:
+            content_type_id = cls.get_content_type_id(objects[0].__class__)
+            object_ids = {obj.id for obj in objects}
+            liked_ids = cls.get_liked_object_ids(user, content_type_id, object_ids)
+            if settings.LIKE_WRITE_BEHIND:
+                overlay = LikeBufferService.get_overlay(user.id, content_type_id, object_ids)
+        for obj in objects:
+            obj.has_liked = obj.id in liked_ids
+            # 还在 write-behind 队列中的点赞 / 取消点赞， 只对点赞的人自己修正 has_liked 和点赞数
+            liked = overlay.get(obj.id, obj.has_liked)
+            if liked != obj.has_liked:
+                obj.has_liked = liked
+                if hasattr(obj, 'likes_count'):
+                    obj.likes_count = max(obj.likes_count + (1 if liked else -1), 0)
+        return objects
+
+    @classmethod
+    def fold_counter(cls, content_type_id, object_id):
+        # 把一个 object 的所有分片合并到 likes_count 中， 返回合并的点赞数
+        model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+        with transaction.atomic():
+            # 锁住这些分片， 合并的过程中对这些分片的点赞会等待合并完成
+            shards = list(LikeCounterShard.objects.select_for_update().filter(
+                content_type_id=content_type_id,
+                object_id=object_id,
+            ))
+            total = sum(shard.count for shard in shards)
+            if total:
+                model_class.objects.filter(id=object_id).update(
+                    likes_count=F('likes_count') + total,
+                )
+            # 合并之后直接删掉分片， 分片表中只保存还没有合并的计数， 定期扫描的时候很快
+            LikeCounterShard.objects.filter(
+                id__in=[shard.id for shard in shards],
+            ).delete()
+        cls.invalidate_folded_objects([(content_type_id, object_id)])
+        return total
+
+    @classmethod
+    def invalidate_folded_objects(cls, targets):
+        # targets 是 [(content_type_id, object_id), ...]， 删掉这些 object 的 cache 和分片计数的 cache
+        for content_type_id, object_id in targets:
+            model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+            ObjectCacheHelper.invalidate_cached_object(model_class, object_id)
+            cache.delete(cls.get_pending_key(content_type_id, object_id))
+
+    @classmethod
+    def fold_counters(cls, batch_size):
+        """
+        按照主键逐批扫描分片表， 把扫描到的 object 的分片合并掉
+        返回 (合并了多少个 object, 合并了多少点赞数)
+        """
+        objects_folded, likes_folded = 0, 0
+        folded_targets = []
+        last_id = 0
+        while True:
+            rows = list(LikeCounterShard.objects.filter(
+                id__gt=last_id,
+            ).order_by('id').values_list(
+                'id', 'content_type_id', 'object_id',
+            )[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            # 同一个 object 的多个分片只需要合并一次
+            targets = dict.fromkeys(
+                (content_type_id, object_id)
+                for _, content_type_id, object_id in rows
+                if content_type_id is not None
+            )
+            for content_type_id, object_id in targets:
+                likes_folded += cls.fold_counter(content_type_id, object_id)
+                objects_folded += 1
+            folded_targets.extend(targets)
+        if folded_targets:
+            # 合并之前从数据库读到的旧 object （likes_count 还没有加上分片）可能在合并之后才写进 cache，
+            # 这时分片已经被删掉了， 点赞数会少算到 cache 过期为止
+            # 过一段时间再删一次 cache， 让这种并发读写回去的旧数据最多只存在这么久
+            invalidate_folded_objects_task.apply_async(
+                args=(folded_targets,),
+                countdown=settings.LIKE_COUNTER_FOLD_REINVALIDATE_DELAY,
+            )
+        return objects_folded, likes_folded
+
+
+class LikeBufferService(object):
+    """
+    点赞 / 取消点赞的 write-behind 队列（LIKE_WRITE_BEHIND 打开的时候使用）
+    - 队列存在 cache 中， 用 cache.incr 原子地分配递增的 slot， 每个事件存在自己的 slot 里
+    - flush 的时候按 slot 的顺序读出一批事件， 同一个 (user, object) 只保留最后一个事件
+      先点赞再取消点赞的两个事件会相互抵消
+    - 新的点赞一次 bulk_create， 取消的点赞一次按 id 删除， 点赞数按 object 合并之后每个 object 只更新一次
+    - flush 之前， 点赞的人通过 overlay 可以马上看到自己的点赞 / 取消点赞（read-your-writes）
+    """
+
+    @classmethod
+    def get_event_key(cls, slot):
+        return LIKE_BUFFER_EVENT_PATTERN.format(slot=slot)
+
+    @classmethod
+    def get_overlay_key(cls, user_id, content_type_id, object_id):
+        return LIKE_OVERLAY_PATTERN.format(
+            user_id=user_id,
+            content_type_id=content_type_id,
+            object_id=object_id,
+        )
+
+    @classmethod
+    def _allocate_slot(cls):
+        try:
+            return cache.incr(LIKE_BUFFER_TAIL_KEY)
+        except ValueError:
+            # 第一次使用的时候计数器还不存在
+            cache.add(LIKE_BUFFER_TAIL_KEY, 0, timeout=None)
+            return cache.incr(LIKE_BUFFER_TAIL_KEY)
+
+    @classmethod
+    def push(cls, user_id, content_type_id, object_id, liked):
+        # liked 为 True 表示点赞， False 表示取消点赞
+        slot = cls._allocate_slot()
+        cache.set(
+            cls.get_event_key(slot),
+            (user_id, content_type_id, object_id, liked),
+            timeout=None,
+        )
+        cache.set(
+            cls.get_overlay_key(user_id, content_type_id, object_id),
+            (liked, slot),
+            timeout=settings.LIKE_OVERLAY_TIMEOUT,
+        )
+        return slot
+
+    @classmethod
+    def get_overlay(cls, user_id, content_type_id, object_ids):
+        # {object_id: liked}， 只包含 user 还没有被 flush 的点赞 / 取消点赞
+        keys = {
+            cls.get_overlay_key(user_id, content_type_id, object_id): object_id
+            for object_id in object_ids
+        }
+        return {
+            keys[key]: liked
+            for key, (liked, _) in cache.get_many(keys.keys()).items()
+        }
+
+    @classmethod
+    def flush(cls, batch_size):
+        """
+        返回 (处理了多少个事件, 合并之后写入了多少个 (user, object) 的状态)
+        用 cache.add 做一个简单的锁， 同一时间只有一个 flush 在执行
+        锁中存的是这次 flush 自己的 token， 结束的时候只释放自己的锁
+        """
+        token = uuid.uuid4().hex
+        if not cache.add(LIKE_BUFFER_LOCK_KEY, token, timeout=settings.LIKE_BUFFER_LOCK_TIMEOUT):
+            return 0, 0
+        try:
+            head = cache.get(LIKE_BUFFER_HEAD_KEY, 0)
+            tail = cache.get(LIKE_BUFFER_TAIL_KEY, 0)
+            last_slot = min(tail, head + batch_size)
+            cached_events = cache.get_many([
+                cls.get_event_key(slot)
+                for slot in range(head + 1, last_slot + 1)
+            ])
+
+            # {(user_id, content_type_id, object_id): (liked, slot)}
+            states = {}
+            flushed_slot = head
+            for slot in range(head + 1, last_slot + 1):
+                event = cached_events.get(cls.get_event_key(slot))
+                if event is None:
+                    # 写入方 incr 之后还没来得及 set， 下次 flush 再处理
+                    # 连续两次 flush 都不存在， 说明写入方在中间挂掉了， 直接跳过这个 slot
+                    if cache.add(LIKE_BUFFER_HOLE_PATTERN.format(slot=slot), 1, timeout=3600):
+                        break
+                else:
+                    user_id, content_type_id, object_id, liked = event
+                    states[(user_id, content_type_id, object_id)] = (liked, slot)
+                flushed_slot = slot
+
+            cls._apply(states)
+            cache.set(LIKE_BUFFER_HEAD_KEY, flushed_slot, timeout=None)
+            cache.delete_many([
+                cls.get_event_key(slot)
+                for slot in range(head + 1, flushed_slot + 1)
+            ])
+            cls._clear_overlays(states)
+            return flushed_slot - head, len(states)
+        finally:
+            # 锁过期之后可能已经被另一个 flush 拿到了， 不能把别人的锁删掉
+            if cache.get(LIKE_BUFFER_LOCK_KEY) == token:
+                cache.delete(LIKE_BUFFER_LOCK_KEY)
+
+    @classmethod
+    def _apply(cls, states):
+        # {content_type_id: {(user_id, object_id): liked}}
+        by_content_type = {}
+        for (user_id, content_type_id, object_id), (liked, _) in states.items():
+            by_content_type.setdefault(content_type_id, {})[(user_id, object_id)] = liked
+
+        for content_type_id, targets in by_content_type.items():
+            # 一次 query 查出这些 (user, object) 中已经存在的点赞， 取了一个超集再在内存中过滤
+            existing = {
+                (user_id, object_id): like_id
+                for like_id, user_id, object_id in Like.objects.filter(
+                    content_type_id=content_type_id,
+                    user_id__in={user_id for user_id, _ in targets},
+                    object_id__in={object_id for _, object_id in targets},
+                ).values_list('id', 'user_id', 'object_id')
+                if (user_id, object_id) in targets
+            }
+            to_create = [
+                Like(user_id=user_id, content_type_id=content_type_id, object_id=object_id)
+                for (user_id, object_id), liked in targets.items()
+                if liked and (user_id, object_id) not in existing
+            ]
+            to_delete = {
+                key: existing[key]
+                for key, liked in targets.items()
+                if not liked and key in existing
+            }
+
+            with transaction.atomic():
+                created = cls._insert_likes(to_create)
+                deleted = cls._delete_likes(to_delete.values())
+                # bulk_create / _raw_delete 都不会触发 signal， 点赞数按照 object 合并之后各更新一次
+                # 只算真正写入和删除的行， 其他请求在这期间直接点赞 / 取消点赞的时候已经更新过点赞数了
+                deltas = {}
+                for like in created:
+                    deltas[like.object_id] = deltas.get(like.object_id, 0) + 1
+                for _, object_id in deleted:
+                    deltas[object_id] = deltas.get(object_id, 0) - 1
+                for object_id, delta in deltas.items():
+                    if delta:
+                        LikeService.incr_likes_count(content_type_id, object_id, delta)
+
+            object_ids = {object_id for _, object_id in targets}
+            cache.delete_many([
+                LikeService.get_pending_key(content_type_id, object_id)
+                for object_id in object_ids
+            ])
+            # 写入和删除的点赞都没有经过 signal， 这些 object 的点赞列表直接失效
+            LikeService.invalidate_cached_likes(content_type_id, object_ids)
+
+    @classmethod
+    def _insert_likes(cls, likes):
+        """
+        返回真正写入数据库的点赞
+        正常情况下一次 bulk_create 就全部写入了， 其他请求在这期间直接写入了同一个点赞的时候唯一索引会冲突，
+        这时再一条一条地写入， 跳过已经存在的点赞
+        """
+        if not likes:
+            return []
+        try:
+            # savepoint， 冲突的时候不会让外层的 transaction 失效
+            with transaction.atomic():
+                Like.objects.bulk_create(
+                    likes,
+                    batch_size=settings.LIKE_BUFFER_FLUSH_BATCH_SIZE,
+                )
+            return likes
+        except IntegrityError:
+            pass
+        created = []
+        for like in likes:
+            try:
+                with transaction.atomic():
+                    Like.objects.bulk_create([like])
+            except IntegrityError:
+                continue
+            created.append(like)
+        return created
+
+    @classmethod
+    def _delete_likes(cls, like_ids):
+        """
+        返回真正被删除的点赞 [(id, object_id), ...]
+        先锁住这些行， 其他请求在这期间已经直接删掉的点赞不会被算进去
+        """
+        like_ids = list(like_ids)
+        if not like_ids:
+            return []
+        deleted = list(Like.objects.select_for_update().filter(
+            id__in=like_ids,
+        ).values_list('id', 'object_id'))
+        if deleted:
+            Like.objects.filter(
+                id__in=[like_id for like_id, _ in deleted],
+            )._raw_delete(Like.objects.db)
+        return deleted
+
+    @classmethod
+    def _clear_overlays(cls, states):
+        # 只删除已经写入数据库的 overlay， flush 的过程中又有新的事件的话 overlay 需要保留
+        keys = {
+            cls.get_overlay_key(*target): slot
+            for target, (_, slot) in states.items()
+        }
+        cache.delete_many([
+            key
+            for key, (_, slot) in cache.get_many(keys.keys()).items()
+            if slot <= keys[key]
+        ])
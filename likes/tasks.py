@@ -0,0 +1,46 @@
+from celery import shared_task
+from django.conf import settings
+from django.db import DatabaseError
+
+ONE_HOUR = 60 * 60
+
+
+# 合并是幂等的， 已经合并过的分片会被删掉， 所以数据库出错的时候可以放心重试
+@shared_task(
+    time_limit=ONE_HOUR,
+    autoretry_for=(DatabaseError,),
+    retry_backoff=True,
+    max_retries=3,
+)
+def fold_like_counters_task():
+    # import 写在里面避免循环依赖
+    from likes.services import LikeService
+
+    objects_folded, likes_folded = LikeService.fold_counters(
+        batch_size=settings.LIKE_COUNTER_FOLD_BATCH_SIZE,
+    )
+    return '{} objects folded, {} likes folded'.format(objects_folded, likes_folded)
+
+
+# 只是删除 cache， 重复执行没有影响
+@shared_task(time_limit=ONE_HOUR)
+def invalidate_folded_objects_task(targets):
+    from likes.services import LikeService
+
+    # 经过 celery 序列化之后 tuple 会变成 list
+    LikeService.invalidate_folded_objects(
+        (content_type_id, object_id) for content_type_id, object_id in targets
+    )
+    return '{} objects invalidated'.format(len(targets))
+
+
+# 同一时间只会有一个 flush 在执行（LikeBufferService.flush 中有锁）， 打开 LIKE_WRITE_BEHIND 之后 beat 每隔几秒触发一次
+# time_limit 不能比锁的过期时间 LIKE_BUFFER_LOCK_TIMEOUT 长
+@shared_task(time_limit=ONE_HOUR)
+def flush_like_buffer_task():
+    from likes.services import LikeBufferService
+
+    events, applied = LikeBufferService.flush(
+        batch_size=settings.LIKE_BUFFER_FLUSH_BATCH_SIZE,
+    )
+    return '{} events flushed, {} likes applied'.format(events, applied)
@@ -0,0 +1,157 @@
+from comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from likes.models import LikeCounterShard
+from likes.services import LikeService
+from likes.tasks import fold_like_counters_task, invalidate_folded_objects_task
+from testing.testcases import TestCase
+from tweets.models import Tweet
+from tweets.services import TweetService
+from utils.object_cache import ObjectCacheHelper
+
+
+class LikeCounterTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.tweet = self.create_tweet(self.linghu)
+        self.tweet_type_id = ContentType.objects.get_for_model(self.tweet).id
+
+    @override_settings(LIKE_COUNTER_SHARDS=4)
+    def test_likes_go_to_shards(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(20)]
+        likes = [self.create_like(user, self.tweet) for user in users]
+        likes[0].delete()
+
+        # Tweet 那一行不会被更新， 点赞分散在不超过 4 个分片上
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+        shards = LikeCounterShard.objects.filter(object_id=self.tweet.id)
+        self.assertLessEqual(shards.count(), 4)
+        self.assertEqual(sum(shard.count for shard in shards), 19)
+
+        # 读的时候把分片加起来， 结果会被 cache 住
+        self.assertEqual(
+            LikeService.get_pending_likes_counts(self.tweet_type_id, [self.tweet.id]),
+            {self.tweet.id: 19},
+        )
+        with self.assertNumQueries(0):
+            LikeService.get_pending_likes_counts(self.tweet_type_id, [self.tweet.id])
+        # 没有分片的 object 返回 0
+        self.assertEqual(
+            LikeService.get_pending_likes_counts(self.tweet_type_id, [-1]),
+            {-1: 0},
+        )
+
+    def test_fold_counters(self):
+        comment = self.create_comment(self.linghu, self.tweet)
+        for i in range(3):
+            user = self.create_user('user{}'.format(i))
+            self.create_like(user, self.tweet)
+            self.create_like(user, comment)
+        self.create_like(self.linghu, self.tweet)
+        # 让 tweet 和分片的计数都进入 cache
+        self.assertEqual(TweetService.hydrate_tweets([self.tweet.id])[0].likes_count, 4)
+
+        msg = fold_like_counters_task()
+        self.assertEqual(msg, '2 objects folded, 7 likes folded')
+        self.assertEqual(LikeCounterShard.objects.count(), 0)
+        # 合并之后 cache 失效， 点赞数不会被重复计算
+        self.assertEqual(TweetService.get_by_id(self.tweet.id).likes_count, 4)
+        self.assertEqual(TweetService.hydrate_tweets([self.tweet.id])[0].likes_count, 4)
+        comment.refresh_from_db()
+        self.assertEqual(comment.likes_count, 3)
+
+        # 合并之后的点赞和取消点赞会记在新的分片中
+        like = self.create_like(self.create_user('late'), self.tweet)
+        like.delete()
+        self.create_like(self.create_user('later'), self.tweet)
+        self.assertEqual(fold_like_counters_task(), '1 objects folded, 1 likes folded')
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 5)
+        self.assertEqual(fold_like_counters_task(), '0 objects folded, 0 likes folded')
+
+    def test_reinvalidate_after_fold(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        for user in users:
+            self.create_like(user, self.tweet)
+        # 合并之前从数据库中读到的 tweet， likes_count 还是 0
+        stale_tweet = Tweet.objects.get(id=self.tweet.id)
+        fold_like_counters_task()
+        self.assertEqual(TweetService.hydrate_tweets([self.tweet.id])[0].likes_count, 3)
+
+        # 旧的 tweet 在合并之后才被写回 cache， 分片已经没有了， 点赞数会少算
+        cache.set(ObjectCacheHelper.get_key(Tweet, self.tweet.id), stale_tweet)
+        self.assertEqual(TweetService.hydrate_tweets([self.tweet.id])[0].likes_count, 0)
+
+        # 延迟执行的第二次删除让 cache 重新从数据库中读取
+        msg = invalidate_folded_objects_task([[self.tweet_type_id, self.tweet.id]])
+        self.assertEqual(msg, '1 objects invalidated')
+        self.assertEqual(TweetService.hydrate_tweets([self.tweet.id])[0].likes_count, 3)
+
+
+class LikeServiceTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+
+    def test_get_content_type_id(self):
+        tweet = self.create_tweet(self.linghu)
+        self.assertEqual(
+            LikeService.get_content_type_id(Tweet),
+            ContentType.objects.get_for_model(tweet).id,
+        )
+        with self.assertNumQueries(0):
+            LikeService.get_content_type_id(Tweet)
+            LikeService.get_content_type_id(Comment)
+
+    @override_settings(LIKES_PREVIEW_SIZE=2)
+    def test_likes_for(self):
+        tweets = [self.create_tweet(self.linghu) for i in range(3)]
+        comment = self.create_comment(self.linghu, tweets[0])
+        self.create_like(self.linghu, tweets[0])
+        like2 = self.create_like(self.dongxie, tweets[0])
+        like3 = self.create_like(self.create_user('user0'), tweets[0])
+        like4 = self.create_like(self.dongxie, tweets[1])
+        self.create_like(self.dongxie, comment)
+
+        # 每个 tweet 一条只读最新 2 条的 query （MySQL 上合成一次 UNION ALL）， 每个 tweet 的点赞按照时间倒序
+        with self.assertNumQueries(1 if connection.features.supports_slicing_ordering_in_compound else 3):
+            likes = LikeService.likes_for_tweets([t.id for t in tweets])
+        self.assertEqual(
+            {
+                tweet_id: [like.id for like in tweet_likes]
+                for tweet_id, tweet_likes in likes.items()
+            },
+            {
+                tweets[0].id: [like3.id, like2.id],
+                tweets[1].id: [like4.id],
+                tweets[2].id: [],
+            },
+        )
+        self.assertEqual(likes[tweets[0].id][1].user_id, self.dongxie.id)
+        self.assertEqual(likes[tweets[0].id][1].created_at, like2.created_at)
+
+        # 每个 tweet 的点赞单独 cache， 只有 miss 的部分会去查数据库
+        with self.assertNumQueries(0):
+            LikeService.likes_for_tweets([tweets[0].id, tweets[1].id])
+        likes = LikeService.likes_for_comments([comment.id])
+        self.assertEqual([like.user_id for like in likes[comment.id]], [self.dongxie.id])
+
+        # 新的点赞直接插入到 cache 中， 长度不会超过上限
+        like5 = self.create_like(self.create_user('user1'), tweets[0])
+        like6 = self.create_like(self.linghu, tweets[2])
+        with self.assertNumQueries(0):
+            likes = LikeService.likes_for_tweets([t.id for t in tweets])
+        self.assertEqual([like.id for like in likes[tweets[0].id]], [like5.id, like3.id])
+        self.assertEqual([like.id for like in likes[tweets[2].id]], [like6.id])
+
+        # 取消点赞之后对应 object 的 cache 失效， 重建的时候会读到更早的点赞
+        like5.delete()
+        likes = LikeService.likes_for_tweets([tweets[0].id])
+        self.assertEqual([like.id for like in likes[tweets[0].id]], [like3.id, like2.id])
@@ -1,8 +1,3 @@
-from django.contrib import admin
-from newsfeeds.models import NewsFeed
-
-
-@admin.register(NewsFeed)
-class NewsFeedAdmin(admin.ModelAdmin):
-    list_display = ('user', 'tweet', 'created_at')
-    date_hierarchy = 'created_at'
+# NewsFeed 按照 user_id 分库存储， 不在 default 库上
+# admin 的列表页没有办法跨所有分库查询和翻页， 所以不在 admin 中注册 NewsFeed
+# 需要排查某个用户的 inbox 的时候， 使用 NewsFeed.objects.for_user(user_id)
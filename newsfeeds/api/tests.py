@@ -1,17 +1,26 @@
+from accounts.services import UserService
+from django.test import override_settings
 from newsfeeds.models import NewsFeed
+from newsfeeds.routers import get_newsfeed_database
+from newsfeeds.services import NewsFeedService
 from friendships.models import Friendship
+from friendships.services import FriendshipService
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from utils.paginations import EndlessPagination
 
 
 NEWSFEEDS_URL = '/api/newsfeeds/'
 POST_TWEETS_URL = '/api/tweets/'
 FOLLOW_URL = '/api/friendships/{}/follow/'
+UNFOLLOW_URL = '/api/friendships/{}/unfollow/'
 
 
 class NewsFeedApiTests(TestCase):
 
     def setUp(self):
+        self.clear_cache()
         self.linghu = self.create_user('linghu')
         self.linghu_client = APIClient()
         self.linghu_client.force_authenticate(self.linghu)
@@ -45,3 +54,350 @@ class NewsFeedApiTests(TestCase):
         response = self.linghu_client.get(NEWSFEEDS_URL)
         self.assertEqual(len(response.data['newsfeeds']), 2)
         self.assertEqual(response.data['newsfeeds'][0]['tweet']['id'], posted_tweet_id)
+
+    def test_pagination(self):
+        page_size = EndlessPagination.page_size
+        followed_user = self.create_user('followed')
+        newsfeeds = []
+        for i in range(page_size * 2):
+            tweet = self.create_tweet(followed_user)
+            newsfeed = self.create_newsfeed(self.linghu, tweet)
+            newsfeeds.append(newsfeed)
+
+        newsfeeds = newsfeeds[::-1]
+
+        # pull the first page
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        self.assertEqual(response.data['has_next_page'], True)
+        results = response.data['newsfeeds']
+        self.assertEqual(len(results), page_size)
+        self.assertEqual(results[0]['id'], newsfeeds[0].id)
+        self.assertEqual(results[1]['id'], newsfeeds[1].id)
+        self.assertEqual(results[page_size - 1]['id'], newsfeeds[page_size - 1].id)
+
+        # pull the second page
+        response = self.linghu_client.get(NEWSFEEDS_URL, {
+            'created_at__lt': newsfeeds[page_size - 1].created_at,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        results = response.data['newsfeeds']
+        self.assertEqual(len(results), page_size)
+        self.assertEqual(results[0]['id'], newsfeeds[page_size].id)
+        self.assertEqual(results[1]['id'], newsfeeds[page_size + 1].id)
+        self.assertEqual(
+            results[page_size - 1]['id'],
+            newsfeeds[2 * page_size - 1].id,
+        )
+
+        # pull latest newsfeeds
+        response = self.linghu_client.get(NEWSFEEDS_URL, {
+            'created_at__gt': newsfeeds[0].created_at,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(len(response.data['newsfeeds']), 0)
+
+        tweet = self.create_tweet(followed_user)
+        new_newsfeed = self.create_newsfeed(self.linghu, tweet)
+
+        response = self.linghu_client.get(NEWSFEEDS_URL, {
+            'created_at__gt': newsfeeds[0].created_at,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(len(response.data['newsfeeds']), 1)
+        self.assertEqual(response.data['newsfeeds'][0]['id'], new_newsfeed.id)
+
+        # 非法的时间参数
+        response = self.linghu_client.get(NEWSFEEDS_URL, {
+            'created_at__lt': 'not a datetime',
+        })
+        self.assertEqual(response.status_code, 400)
+        # 格式正确但是不存在的时间
+        response = self.linghu_client.get(NEWSFEEDS_URL, {
+            'created_at__lt': '2020-13-01T00:00:00',
+        })
+        self.assertEqual(response.status_code, 400)
+        # 没有时区的时间按照 UTC 处理， cache 和数据库中翻页的结果一样
+        naive = newsfeeds[page_size - 1].created_at.replace(tzinfo=None)
+        for limit in [page_size * 4, page_size]:
+            self.clear_cache()
+            with override_settings(NEWSFEED_CACHE_LIMIT=limit):
+                response = self.linghu_client.get(NEWSFEEDS_URL, {
+                    'created_at__lt': naive.isoformat(),
+                })
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                response.data['newsfeeds'][0]['id'],
+                newsfeeds[page_size].id,
+            )
+
+    def test_pagination_with_same_created_at(self):
+        # created_at 相同的时候， 带上 tweet_id__lt 翻页不会跳过被切在两页之间的 newsfeeds
+        page_size = EndlessPagination.page_size
+        followed_user = self.create_user('followed')
+        for i in range(page_size + 5):
+            self.create_newsfeed(self.linghu, self.create_tweet(followed_user))
+        queryset = NewsFeed.objects.for_user(self.linghu.id)
+        queryset.update(created_at=queryset.first().created_at)
+        expected_ids = sorted(queryset.values_list('tweet_id', flat=True), reverse=True)
+
+        # 分别从 cache 和数据库中翻页
+        for limit in [10, 50]:
+            self.clear_cache()
+            with override_settings(NEWSFEED_CACHE_LIMIT=limit):
+                response = self.linghu_client.get(NEWSFEEDS_URL)
+                first_page = response.data['newsfeeds']
+                self.assertEqual(response.data['has_next_page'], True)
+                response = self.linghu_client.get(NEWSFEEDS_URL, {
+                    'created_at__lt': first_page[-1]['created_at'],
+                    'tweet_id__lt': first_page[-1]['tweet']['id'],
+                })
+                second_page = response.data['newsfeeds']
+                self.assertEqual(response.data['has_next_page'], False)
+            self.assertEqual(
+                [newsfeed['tweet']['id'] for newsfeed in first_page + second_page],
+                expected_ids,
+            )
+
+    @override_settings(NEWSFEED_CACHE_LIMIT=EndlessPagination.page_size + 5)
+    def test_pagination_beyond_cache(self):
+        page_size = EndlessPagination.page_size
+        followed_user = self.create_user('followed')
+        newsfeeds = []
+        for i in range(page_size * 2):
+            tweet = self.create_tweet(followed_user)
+            newsfeeds.append(self.create_newsfeed(self.linghu, tweet))
+        newsfeeds = newsfeeds[::-1]
+
+        # 第一页可以完全从 cache 中得到
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [f['id'] for f in response.data['newsfeeds']],
+            [f.id for f in newsfeeds[:page_size]],
+        )
+
+        # 第二页超出了 cache 的范围， 需要回到数据库中查询
+        response = self.linghu_client.get(NEWSFEEDS_URL, {
+            'created_at__lt': newsfeeds[page_size - 1].created_at,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [f['id'] for f in response.data['newsfeeds']],
+            [f.id for f in newsfeeds[page_size:]],
+        )
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=1)
+    def test_celebrity_tweets_are_pulled(self):
+        celebrity = self.create_user('celebrity')
+        celebrity_client = APIClient()
+        celebrity_client.force_authenticate(celebrity)
+        self.create_friendship(self.linghu, celebrity)
+        self.create_friendship(self.dongxie, celebrity)
+
+        self.linghu_client.post(POST_TWEETS_URL, {'content': 'linghu tweet 1'})
+        response = celebrity_client.post(POST_TWEETS_URL, {
+            'content': 'celebrity tweet',
+        })
+        celebrity_tweet_id = response.data['id']
+        self.linghu_client.post(POST_TWEETS_URL, {'content': 'linghu tweet 2'})
+
+        # 明星用户发的 tweet 不会被 fanout 到 follower 的 inbox 中
+        self.assertEqual(
+            self.count_newsfeeds(tweet_id=celebrity_tweet_id),
+            1,
+        )
+        self.assertEqual(
+            NewsFeed.objects.for_user(self.linghu.id).count(),
+            2,
+        )
+
+        # 但是 follower 读 newsfeed 的时候可以按时间顺序看到
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        results = response.data['newsfeeds']
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['tweet']['content'], 'linghu tweet 2')
+        self.assertEqual(results[1]['tweet']['id'], celebrity_tweet_id)
+        self.assertEqual(results[1]['id'], None)
+        self.assertEqual(results[2]['tweet']['content'], 'linghu tweet 1')
+
+        # 用 created_at__lt 翻页的时候也会从明星用户的 tweets 中翻页
+        response = self.linghu_client.get(NEWSFEEDS_URL, {
+            'created_at__lt': results[0]['created_at'],
+        })
+        self.assertEqual(
+            [f['tweet']['content'] for f in response.data['newsfeeds']],
+            ['celebrity tweet', 'linghu tweet 1'],
+        )
+
+        # 没有关注明星用户的人看不到
+        response = self.dongxie_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['newsfeeds']), 1)
+        self.assertEqual(
+            response.data['newsfeeds'][0]['tweet']['id'],
+            celebrity_tweet_id,
+        )
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=1)
+    def test_celebrity_tweets_pagination_with_same_created_at(self):
+        # 拉取的 tweets 没有 newsfeed id， 游标用 (created_at, tweet_id)， 和 inbox 中的 newsfeeds 一起翻页
+        page_size = EndlessPagination.page_size
+        celebrity = self.create_user('celebrity')
+        followed_user = self.create_user('followed')
+        self.create_friendship(self.linghu, celebrity)
+        self.create_friendship(self.dongxie, celebrity)
+        self.create_friendship(self.linghu, followed_user)
+        for i in range(page_size // 2 + 3):
+            self.create_tweet(celebrity)
+            self.create_newsfeed(self.linghu, self.create_tweet(followed_user))
+        created_at = NewsFeed.objects.for_user(self.linghu.id).first().created_at
+        Tweet.objects.update(created_at=created_at)
+        NewsFeed.objects.for_user(self.linghu.id).update(created_at=created_at)
+        self.clear_cache()
+        expected_ids = sorted(
+            Tweet.objects.values_list('id', flat=True),
+            reverse=True,
+        )
+
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        first_page = response.data['newsfeeds']
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(first_page[-1]['tweet']['user']['id'], celebrity.id)
+        response = self.linghu_client.get(NEWSFEEDS_URL, {
+            'created_at__lt': first_page[-1]['created_at'],
+            'tweet_id__lt': first_page[-1]['tweet']['id'],
+        })
+        second_page = response.data['newsfeeds']
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [newsfeed['tweet']['id'] for newsfeed in first_page + second_page],
+            expected_ids,
+        )
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=1)
+    def test_demoted_celebrity_tweets_are_backfilled(self):
+        celebrity = self.create_user('celebrity')
+        self.create_friendship(self.linghu, celebrity)
+        self.create_friendship(self.dongxie, celebrity)
+        tweets = [self.create_tweet(celebrity) for i in range(3)]
+        NewsFeedService.fanout_to_followers(tweets[-1])
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['newsfeeds']), 3)
+        self.assertEqual(NewsFeed.objects.for_user(self.linghu.id).count(), 0)
+
+        # follower 数量降到阈值以下之后， 之前没有 fanout 的 tweets 被补到了 followers 的 inbox 中
+        # 明星用户的 profile 在 cache 中， unfollow 的时候依然要按照更新之后的 follower 数量判断
+        UserService.get_profile(celebrity.id)
+        # 提交之后执行的有四个： 更新 dongxie 的 following ids， 两个人的 profile 失效， 以及降级的 backfill
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.dongxie_client.post(UNFOLLOW_URL.format(celebrity.id))
+        self.assertEqual(len(callbacks), 4)
+        self.assertEqual(FriendshipService.is_celebrity(celebrity.id), False)
+        self.assertEqual(
+            set(NewsFeed.objects.for_user(self.linghu.id).values_list('tweet_id', flat=True)),
+            {tweet.id for tweet in tweets},
+        )
+        self.assertEqual(NewsFeed.objects.for_user(self.dongxie.id).count(), 0)
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        self.assertEqual(
+            [f['tweet']['id'] for f in response.data['newsfeeds']],
+            [tweet.id for tweet in tweets[::-1]],
+        )
+
+        # cache 中已经标记为普通用户的时候， unfollow 不会再触发
+        self.create_friendship(self.dongxie, celebrity)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.dongxie_client.post(UNFOLLOW_URL.format(celebrity.id))
+        self.assertEqual(len(callbacks), 3)
+
+    @override_settings(
+        NEWSFEED_CELEBRITY_THRESHOLD=1,
+        USER_TWEETS_CACHE_LIMIT=EndlessPagination.page_size + 1,
+    )
+    def test_celebrity_tweets_pagination(self):
+        page_size = EndlessPagination.page_size
+        celebrity = self.create_user('celebrity')
+        self.create_friendship(self.linghu, celebrity)
+        self.create_friendship(self.dongxie, celebrity)
+
+        tweets = []
+        for i in range(page_size * 2):
+            tweets.append(self.create_tweet(celebrity, 'tweet {}'.format(i)))
+        tweets = tweets[::-1]
+        # 在成为明星用户之前 fanout 过的 tweet 不会重复出现
+        self.create_newsfeed(self.linghu, tweets[0])
+
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [f['tweet']['id'] for f in response.data['newsfeeds']],
+            [tweet.id for tweet in tweets[:page_size]],
+        )
+        self.assertNotEqual(response.data['newsfeeds'][0]['id'], None)
+
+        # 第二页超出了 cache 的范围， 从数据库中拉取
+        response = self.linghu_client.get(NEWSFEEDS_URL, {
+            'created_at__lt': tweets[page_size - 1].created_at,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [f['tweet']['id'] for f in response.data['newsfeeds']],
+            [tweet.id for tweet in tweets[page_size:]],
+        )
+
+    @override_settings(NEWSFEED_BACKFILL_LIMIT=2)
+    def test_follow_and_unfollow(self):
+        tweets = [self.create_tweet(self.dongxie) for i in range(3)]
+        self.linghu_client.post(POST_TWEETS_URL, {'content': 'Hello World'})
+        # 让 cache 存在
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['newsfeeds']), 1)
+
+        # 关注之后可以看到对方最近的 tweets， 按照 tweet 的时间排序
+        self.linghu_client.post(FOLLOW_URL.format(self.dongxie.id))
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        results = response.data['newsfeeds']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['tweet']['content'], 'Hello World')
+        self.assertEqual(results[1]['tweet']['id'], tweets[2].id)
+        self.assertEqual(results[2]['tweet']['id'], tweets[1].id)
+
+        # 取关之后看不到对方的 tweets 了
+        self.linghu_client.post(UNFOLLOW_URL.format(self.dongxie.id))
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        results = response.data['newsfeeds']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['tweet']['content'], 'Hello World')
+        self.assertEqual(NewsFeed.objects.for_user(self.linghu.id).count(), 1)
+
+    def test_constant_number_of_queries(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(5)]
+        for user in users:
+            self.create_friendship(self.linghu, user)
+            self.create_newsfeed(self.linghu, self.create_tweet(user))
+
+        # cache 全部 miss 的时候:
+        # inbox 所在的分库上: inbox 重建
+        # default 上: following 的人 + 这些人是否为明星用户 + tweets 的 id__in + users 的 id__in
+        # + 分片计数器中没有合并的点赞数 + 这一页中点过赞的 tweets
+        shard = get_newsfeed_database(self.linghu.id)
+        with self.assertNumQueries(1, using=shard), self.assertNumQueries(6):
+            response = self.linghu_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['newsfeeds']), 5)
+        self.assertEqual(
+            response.data['newsfeeds'][0]['tweet']['user']['username'],
+            'user4',
+        )
+
+        # cache 命中之后 following 的人也在 cache 中， 只需要查一次点过赞的 tweets
+        with self.assertNumQueries(0, using=shard), self.assertNumQueries(1):
+            self.linghu_client.get(NEWSFEEDS_URL)
+
+        # newsfeed 的数量增加之后 query 的数量不变
+        # 新的 tweets 不在 cache 中， 需要多一次 id__in 和一次点赞数的查询， users 都已经在 cache 中了
+        for user in users:
+            for i in range(3):
+                self.create_newsfeed(self.linghu, self.create_tweet(user))
+        with self.assertNumQueries(3):
+            response = self.linghu_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['newsfeeds']), 20)
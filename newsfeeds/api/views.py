@@ -4,16 +4,30 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from newsfeeds.models import NewsFeed
 from newsfeeds.api.serializers import NewsFeedSerializer
+from newsfeeds.services import NewsFeedService
+from utils.paginations import NewsFeedPagination
 
 
 class NewsFeedViewSet(viewsets.GenericViewSet):
     permission_classes = [IsAuthenticated]
+    pagination_class = NewsFeedPagination
 
     def get_queryset(self):
-        return NewsFeed.objects.filter(user=self.request.user)
+        # 只访问当前用户所在的分库， 走 ('user', 'created_at') 这个联合索引
+        return NewsFeed.objects.for_user(self.request.user.id)
 
     def list(self, request):
-        serializer = NewsFeedSerializer(self.get_queryset(), many=True)
+        # inbox 中的 newsfeeds 和关注的明星用户的 tweets 归并之后的一页
+        page = NewsFeedService.paginate_newsfeeds(
+            request.user.id,
+            self.paginator,
+            request,
+        )
+        serializer = NewsFeedSerializer(
+            NewsFeedService.hydrate_newsfeeds(page, viewer=request.user),
+            many=True,
+        )
         return Response({
             'newsfeeds': serializer.data,
-        }, status=status.HTTP_200_OK)
\ No newline at end of file
+            'has_next_page': self.paginator.has_next_page,
+        }, status=status.HTTP_200_OK)
@@ -0,0 +1,8 @@
+def update_cached_newsfeeds(sender, instance, **kwargs):
+    # 新建的 newsfeed 直接插入到 cache 中， 删除的时候让 cache 失效， 下次读的时候从数据库中重建
+    # 在函数内部 import 避免循环依赖
+    from newsfeeds.services import NewsFeedService
+    if kwargs.get('created'):
+        NewsFeedService.push_cached_newsfeeds([instance])
+        return
+    NewsFeedService.invalidate_cached_newsfeeds(instance.user_id)
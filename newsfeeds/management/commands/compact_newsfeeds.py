@@ -0,0 +1,80 @@
+import time
+
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from newsfeeds.services import NewsFeedService
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete newsfeeds beyond the per-user retention policy in small batches '
+        'along the (user, created_at) index.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-rows',
+            type=int,
+            default=settings.NEWSFEED_MAX_ROWS_PER_USER,
+            help='Keep at most this many newsfeeds per user.',
+        )
+        parser.add_argument(
+            '--max-age-days',
+            type=int,
+            default=settings.NEWSFEED_RETENTION_DAYS,
+            help='Delete newsfeeds older than this many days.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.NEWSFEED_DELETE_BATCH_SIZE,
+            help='Number of rows removed by each DELETE statement.',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0,
+            help='Seconds to sleep between two batches, to throttle the load.',
+        )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['max_age_days'])
+        start = time.time()
+        users_scanned, users_compacted, reclaimed = 0, 0, 0
+
+        # 按照主键逐批遍历所有用户， 不会一次性把所有用户读到内存里
+        last_user_id = 0
+        while True:
+            user_ids = list(User.objects.filter(
+                id__gt=last_user_id,
+            ).order_by('id').values_list('id', flat=True)[:1000])
+            if not user_ids:
+                break
+            last_user_id = user_ids[-1]
+            for user_id in user_ids:
+                deleted = NewsFeedService.compact_inbox(
+                    user_id,
+                    max_rows=options['max_rows'],
+                    before=before,
+                    batch_size=options['batch_size'],
+                    sleep=options['sleep'],
+                )
+                users_scanned += 1
+                if deleted:
+                    users_compacted += 1
+                    reclaimed += deleted
+
+        elapsed = time.time() - start
+        self.stdout.write(
+            '{} users scanned, {} users compacted, {} rows reclaimed '
+            'in {:.2f}s ({:.1f} rows/s)'.format(
+                users_scanned,
+                users_compacted,
+                reclaimed,
+                elapsed,
+                reclaimed / elapsed if elapsed else 0,
+            )
+        )
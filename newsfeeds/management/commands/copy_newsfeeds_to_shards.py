@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from newsfeeds.models import NewsFeed
+from newsfeeds.routers import group_by_database
+from newsfeeds.services import NewsFeedService
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the newsfeeds stored on the default database before sharding to '
+        'the shard of each user, in batches ordered by id. Safe to run again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of rows read from default and written per batch.',
+        )
+        parser.add_argument(
+            '--start-id',
+            type=int,
+            default=0,
+            help='Only copy rows whose id is greater than this, to resume an interrupted run.',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = options['start_id']
+        scanned = 0
+
+        # 分库之前的表还在 default 上， 按照主键逐批读出来
+        queryset = NewsFeed.objects.using(DEFAULT_DB_ALIAS).filter(
+            user_id__isnull=False,
+            tweet_id__isnull=False,
+        ).order_by('id')
+        while True:
+            rows = list(queryset.filter(id__gt=last_id).values_list(
+                'id', 'user_id', 'tweet_id', 'created_at',
+            )[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            scanned += len(rows)
+
+            rows_by_user = {}
+            for _, user_id, tweet_id, created_at in rows:
+                rows_by_user.setdefault(user_id, []).append((tweet_id, created_at))
+            for database, user_ids in group_by_database(rows_by_user).items():
+                # 不复制 id， 分库上的 id 是各自自增的
+                # ('user', 'tweet') 是唯一索引， 已经复制过的和切换之后 fanout 写入的都会被忽略， 所以可以重复执行
+                NewsFeed.objects.using(database).bulk_create(
+                    [
+                        NewsFeed(user_id=user_id, tweet_id=tweet_id, created_at=created_at)
+                        for user_id in user_ids
+                        for tweet_id, created_at in rows_by_user[user_id]
+                    ],
+                    batch_size=batch_size,
+                    ignore_conflicts=True,
+                )
+            NewsFeedService.invalidate_many_cached_newsfeeds(list(rows_by_user))
+            self.stdout.write('copied up to id {}'.format(last_id))
+
+        self.stdout.write('{} newsfeeds scanned, last id {}'.format(scanned, last_id))
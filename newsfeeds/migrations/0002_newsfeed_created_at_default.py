@@ -0,0 +1,19 @@
+# Generated by Django 3.1.3 on 2026-10-18 17:43
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsfeeds', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='newsfeed',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.3 on 2026-10-18 17:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tweets', '0002_auto_20210505_0528'),
+        ('newsfeeds', '0002_newsfeed_created_at_default'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='newsfeed',
+            name='tweet',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='tweets.tweet'),
+        ),
+        migrations.AlterField(
+            model_name='newsfeed',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
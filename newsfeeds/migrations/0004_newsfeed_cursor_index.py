@@ -0,0 +1,20 @@
+# Generated by Django 3.1.3 on 2026-10-18 18:39
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('tweets', '0003_auto_20261018_1755'),
+        ('newsfeeds', '0003_newsfeed_sharding'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='newsfeed',
+            index_together={('user', 'created_at', 'tweet')},
+        ),
+    ]
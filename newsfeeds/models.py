@@ -1,20 +1,53 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+from newsfeeds.listeners import update_cached_newsfeeds
+from newsfeeds.routers import get_newsfeed_database
 from tweets.models import Tweet
 
 
+class NewsFeedManager(models.Manager):
+
+    def shard_for(self, user_id):
+        # user_id 的 inbox 所在分库上的 manager， 用于 create / bulk_create 等操作
+        return self.db_manager(get_newsfeed_database(user_id))
+
+    def for_user(self, user_id):
+        return self.shard_for(user_id).filter(user_id=user_id)
+
+
 class NewsFeed(models.Model):
     # 注意此处的user指的不是谁发的贴 而是谁能看到该帖子（tweet）
-    # on_delete=models.SET_NULL 否则默认是cascade会产生级联删除
-    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
-    tweet = models.ForeignKey(Tweet, on_delete=models.SET_NULL, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # NewsFeed 按照 user_id 分库存储， 和 User / Tweet 不在同一个库上
+    # 所以不能建立外键约束（db_constraint=False）， 也不能让数据库或者 django 去做级联操作（DO_NOTHING）
+    user = models.ForeignKey(
+        User,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        db_constraint=False,
+    )
+    tweet = models.ForeignKey(
+        Tweet,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        db_constraint=False,
+    )
+    # 异步 fanout 的时候会把 tweet 的创建时间写进来， 而不是 fanout 执行的时间
+    # 这样 newsfeed 的顺序不会受到 message queue 延迟的影响
+    created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
-        index_together = (('user', 'created_at'),)  # 此处限定排序是按照用户的newsfeed排列
+        # 此处限定排序是按照用户的newsfeed排列， tweet 是翻页游标 (created_at, tweet_id) 的第二项
+        index_together = (('user', 'created_at', 'tweet'),)
         unique_together = (('user', 'tweet'),)  # 此处限定同一个用户不能看到两条相同的tweet
         ordering = ('-created_at',)
 
+    objects = NewsFeedManager()
+
     def __str__(self):
         return f'{self.created_at} inbox of {self.user}: {self.tweet}'
 
+
+post_save.connect(update_cached_newsfeeds, sender=NewsFeed)
+post_delete.connect(update_cached_newsfeeds, sender=NewsFeed)
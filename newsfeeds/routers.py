@@ -0,0 +1,56 @@
+from django.conf import settings
+
+NEWSFEEDS_APP_LABEL = 'newsfeeds'
+
+
+def get_newsfeed_database(user_id):
+    """
+    按照 user_id 把 NewsFeed 分到 NEWSFEED_DATABASES 中的某一个库上
+    同一个用户的 inbox 一定在同一个库上， 读 inbox 的时候只需要访问一个库
+    user_id 是自增的， 直接取模就可以比较均匀地分布
+    """
+    databases = settings.NEWSFEED_DATABASES
+    return databases[user_id % len(databases)]
+
+
+def group_by_database(user_ids):
+    # {database: [user_id, ...]}
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(get_newsfeed_database(user_id), []).append(user_id)
+    return groups
+
+
+class NewsFeedRouter(object):
+    """
+    NewsFeed 的表只存在于 NEWSFEED_DATABASES 这些分库上， 其他的表只存在于 default 上
+    查询 NewsFeed 的时候需要通过 NewsFeed.objects.for_user / shard_for 指定分库
+    """
+
+    def _is_newsfeed(self, model):
+        return model._meta.app_label == NEWSFEEDS_APP_LABEL
+
+    def db_for_read(self, model, **hints):
+        # instance 也可能是给 NewsFeed 的外键赋值时传进来的 User / Tweet， 只有 NewsFeed 本身才按 user_id 路由
+        instance = hints.get('instance')
+        if not self._is_newsfeed(model) or not isinstance(instance, model):
+            return None
+        if instance.user_id is None:
+            return None
+        return get_newsfeed_database(instance.user_id)
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # NewsFeed 和 User / Tweet 不在同一个库上， 但是依然允许通过 user_id / tweet_id 关联
+        if self._is_newsfeed(obj1) or self._is_newsfeed(obj2):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.NEWSFEED_DATABASES:
+            return app_label == NEWSFEEDS_APP_LABEL
+        if app_label == NEWSFEEDS_APP_LABEL:
+            return False
+        return None
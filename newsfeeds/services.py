@@ -1,5 +1,22 @@
+import heapq
+import time
+
+from accounts.models import UserProfile
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from friendships.services import FriendshipService
 from newsfeeds.models import NewsFeed
+from newsfeeds.routers import get_newsfeed_database
+from newsfeeds.tasks import (
+    backfill_demoted_celebrity_task,
+    backfill_newsfeeds_task,
+    fanout_newsfeeds_main_task,
+    remove_newsfeeds_task,
+)
+from tweets.services import TweetService
+from twitter.cache import USER_NEWSFEEDS_PATTERN
+from utils.list_cache import ListCacheHelper
 
 
 class NewsFeedService(object):
@@ -16,12 +33,255 @@ class NewsFeedService(object):
         #         tweet=tweet,
         #     )
 
-        # 正确的方法： 使用bulk_create, 会把insert语句合成一条
-        newsfeeds = [
-            NewsFeed(user=follower, tweet=tweet)  # 由于此处没有.save 所以不会产生数据库存储请求操作
-            for follower in FriendshipService.get_followers(tweet.user)
+        # 之前的方法： 使用bulk_create, 会把insert语句合成一条
+        # 但是 follower 很多的时候， 发帖的请求需要等这一条巨大的 insert 执行完才能返回
+        # newsfeeds = [
+        #     NewsFeed(user=follower, tweet=tweet)
+        #     for follower in FriendshipService.get_followers(tweet.user)
+        # ]
+        # NewsFeed.objects.bulk_create(newsfeeds)
+
+        # 现在的方法： 用户自己的 newsfeed 同步写入， 保证发帖之后自己马上能看到
+        # 给 followers 的 fanout 交给 celery 在后台异步执行
+        NewsFeed.objects.shard_for(tweet.user_id).create(
+            user_id=tweet.user_id,
+            tweet_id=tweet.id,
+            created_at=tweet.created_at,
+        )
+        # 这一行代码会在 message queue 里创建一个 fanout 的任务， 不会等待任务执行完成
+        fanout_newsfeeds_main_task.delay(
+            tweet.id,
+            tweet.user_id,
+            tweet.created_at.isoformat(),
+        )
+
+    @classmethod
+    def backfill_newsfeeds(cls, user_id, to_user_ids):
+        # 关注之后异步地把对方最近的 tweets 补到 inbox 中
+        backfill_newsfeeds_task.delay(user_id, list(to_user_ids))
+
+    @classmethod
+    def remove_newsfeeds(cls, user_id, to_user_id):
+        # 取关之后异步地把对方的 tweets 从 inbox 中删掉
+        remove_newsfeeds_task.delay(user_id, to_user_id)
+
+    @classmethod
+    def demote_celebrity_if_needed(cls, user_id):
+        """
+        user_id 的 follower 减少之后调用
+        明星用户的 tweets 没有 fanout 过， follower 数量降到阈值以下之后也不会再被拉取， 需要补到 followers 的 inbox 中
+        """
+        flag = FriendshipService.get_cached_celebrity_flag(user_id)
+        # 当前是按照普通用户 fanout 的， 不需要补
+        if flag is False:
+            return
+        # 还在 unfollow 的 transaction 中， cache 中的 profile 提交之后才会失效， 需要从数据库中读这次更新之后的数量
+        followers_count = UserProfile.objects.filter(user_id=user_id).values_list(
+            'followers_count',
+            flat=True,
+        ).first() or 0
+        threshold = settings.NEWSFEED_CELEBRITY_THRESHOLD
+        if followers_count > threshold:
+            return
+        # 刚好降到阈值说明之前是明星用户， cache 中的标记已经过期的时候靠这个来判断
+        # 并发的 unfollow 一次跨过阈值的时候 cache 中的标记还在
+        if followers_count < threshold and flag is None:
+            return
+        if FriendshipService.start_celebrity_demotion(user_id):
+            # unfollow 提交之后再去扫 followers， 否则刚取关的人也会被补进去
+            transaction.on_commit(lambda: backfill_demoted_celebrity_task.delay(user_id))
+
+    @classmethod
+    def compact_inbox(cls, user_id, max_rows, before, batch_size, sleep=0):
+        """
+        删除 inbox 中超出 max_rows 条的旧数据， 以及所有早于 before 的数据
+        每次只按主键删除 batch_size 条， 每条 DELETE 语句持有锁的时间都很短
+        返回删除的条数
+        """
+        database = get_newsfeed_database(user_id)
+        queryset = NewsFeed.objects.for_user(user_id)
+        # 走 ('user', 'created_at') 的联合索引找到第 max_rows + 1 新的那一条
+        boundary = list(queryset.order_by('-created_at', '-id').values_list(
+            'created_at', 'id',
+        )[max_rows:max_rows + 1])
+        condition = Q(created_at__lt=before)
+        if boundary:
+            created_at, newsfeed_id = boundary[0]
+            condition |= Q(created_at__lt=created_at)
+            condition |= Q(created_at=created_at, id__lte=newsfeed_id)
+
+        deleted = 0
+        while True:
+            newsfeed_ids = list(queryset.filter(condition).order_by(
+                'created_at',
+            ).values_list('id', flat=True)[:batch_size])
+            if not newsfeed_ids:
+                break
+            # 直接按主键删除， 不需要像 delete() 那样先把每一行读出来再逐行发 post_delete 的 signal
+            deleted += NewsFeed.objects.shard_for(user_id).filter(
+                id__in=newsfeed_ids,
+            )._raw_delete(database)
+            if len(newsfeed_ids) < batch_size:
+                break
+            if sleep:
+                time.sleep(sleep)
+
+        if deleted:
+            cls.invalidate_cached_newsfeeds(user_id)
+        return deleted
+
+    @classmethod
+    def get_cache_key(cls, user_id):
+        return USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+
+    # cache 中只存 (newsfeed_id, tweet_id, created_at)
+    CACHE_FIELDS = ('id', 'tweet_id', 'created_at')
+    # 和 NewsFeedPagination 的游标一致， 按照 (created_at, tweet_id) 排序
+    CACHE_ORDERING = ('-created_at', '-tweet_id')
+
+    @classmethod
+    def get_cached_newsfeeds(cls, user_id):
+        # 读出来之后拼成不需要访问数据库的 NewsFeed 对象
+        entries = ListCacheHelper.load_entries(
+            key=cls.get_cache_key(user_id),
+            queryset=NewsFeed.objects.for_user(user_id),
+            fields=cls.CACHE_FIELDS,
+            limit=settings.NEWSFEED_CACHE_LIMIT,
+            ordering=cls.CACHE_ORDERING,
+        )
+        return [
+            NewsFeed(
+                id=newsfeed_id,
+                user_id=user_id,
+                tweet_id=tweet_id,
+                created_at=created_at,
+            )
+            for newsfeed_id, tweet_id, created_at in entries
         ]
-        # 由于用户自己不是自己的follower
-        # 此处是把用户本身也加入到follower中使得自己也可以看到自己的newsfeed
-        newsfeeds.append(NewsFeed(user=tweet.user, tweet=tweet))
-        NewsFeed.objects.bulk_create(newsfeeds)
\ No newline at end of file
+
+    @classmethod
+    def push_cached_newsfeeds(cls, newsfeeds):
+        # 新的 newsfeeds 直接插入到各自 user 的 cache 中， 读的时候不会因为 fanout 而 miss
+        # 每个 user 最多一条， 一个 fanout batch 中的所有 follower 一起处理
+        ListCacheHelper.push_entries(
+            {
+                cls.get_cache_key(newsfeed.user_id): (
+                    newsfeed.id,
+                    newsfeed.tweet_id,
+                    newsfeed.created_at,
+                )
+                for newsfeed in newsfeeds
+            },
+            fields=cls.CACHE_FIELDS,
+            limit=settings.NEWSFEED_CACHE_LIMIT,
+            ordering=cls.CACHE_ORDERING,
+        )
+
+    @classmethod
+    def invalidate_cached_newsfeeds(cls, user_id):
+        ListCacheHelper.invalidate(cls.get_cache_key(user_id))
+
+    @classmethod
+    def invalidate_many_cached_newsfeeds(cls, user_ids):
+        # 补进来的旧 newsfeeds 会插在 cache 中间， 这一批 user 的 cache 直接失效， 下次读的时候再重建
+        ListCacheHelper.invalidate_many(
+            [cls.get_cache_key(user_id) for user_id in user_ids],
+        )
+
+    @classmethod
+    def paginate_inbox(cls, user_id, paginator, request):
+        # 优先从 cache 中翻页， cache 覆盖不到的时候再去查数据库
+        page = paginator.paginate_cached_list(
+            cls.get_cached_newsfeeds(user_id),
+            request,
+            limit=settings.NEWSFEED_CACHE_LIMIT,
+            id_field='tweet_id',
+        )
+        if page is None:
+            # 走 ('user', 'created_at', 'tweet') 这个联合索引
+            page = paginator.paginate_queryset(
+                NewsFeed.objects.for_user(user_id),
+                request,
+                id_field='tweet_id',
+            )
+        return page
+
+    @classmethod
+    def paginate_celebrity_tweets(cls, user_id, celebrity_id, paginator, request):
+        """
+        明星用户的 tweets 不会被 fanout 到 follower 的 inbox 中
+        这里把明星用户这一页的 tweets 包装成 newsfeed， 这些 newsfeed 并不存在于数据库中， 所以没有 id
+        游标中的 tweet_id 和 Tweet 自己的 id 是一样的， 直接用 timeline 的翻页
+        """
+        return [
+            NewsFeed(user_id=user_id, tweet_id=tweet.id, created_at=tweet.created_at)
+            for tweet in TweetService.paginate_user_tweets(
+                celebrity_id,
+                paginator,
+                request,
+            )
+        ]
+
+    @classmethod
+    def paginate_newsfeeds(cls, user_id, paginator, request):
+        """
+        push/pull 结合:
+        - 普通用户的 tweets 在发帖的时候就 fanout 到了 inbox 中（push）
+        - 明星用户的 tweets 在读的时候再拉取（pull）
+        每个来源各自翻出一页， 然后按照 (created_at, tweet_id) 做 k 路归并， 取最新的一页
+        """
+        pages = [cls.paginate_inbox(user_id, paginator, request)]
+        has_next_page = paginator.has_next_page
+
+        # 只读一次 cache， 不会每次都检查所有关注的人是否为明星用户
+        celebrity_ids = FriendshipService.get_celebrity_following_ids(user_id)
+        for celebrity_id in celebrity_ids:
+            pages.append(cls.paginate_celebrity_tweets(
+                user_id,
+                celebrity_id,
+                paginator,
+                request,
+            ))
+            has_next_page = has_next_page or paginator.has_next_page
+
+        newsfeeds = []
+        seen_tweet_ids = set()
+        merged = heapq.merge(
+            *pages,
+            key=lambda newsfeed: (newsfeed.created_at, newsfeed.tweet_id),
+            reverse=True,
+        )
+        for newsfeed in merged:
+            # 成为明星用户之前发的 tweets 可能已经在 inbox 中了， 需要去重
+            if newsfeed.tweet_id in seen_tweet_ids:
+                continue
+            seen_tweet_ids.add(newsfeed.tweet_id)
+            newsfeeds.append(newsfeed)
+
+        # 每个来源都最多取了一页， 所以归并之后的前 page_size 条一定是正确的
+        paginator.has_next_page = has_next_page or len(newsfeeds) > paginator.page_size
+        return newsfeeds[:paginator.page_size]
+
+    @classmethod
+    def hydrate_newsfeeds(cls, newsfeeds, viewer=None):
+        """
+        NewsFeedSerializer -> TweetSerializer -> UserSerializerForTweet
+        如果直接序列化， 每条 newsfeed 都会产生一次 tweet 的 query 和一次 user 的 query （N + 1 Queries）
+        这里先收集所有的 tweet_id 和 user_id， 各用一次 cache 的 multi-get （miss 的部分再用一次 id__in 的 query）
+        批量取出来之后挂到对应的对象上， 之后序列化的时候就不会再访问数据库了
+        """
+        tweets = {
+            tweet.id: tweet
+            for tweet in TweetService.hydrate_tweets(
+                [newsfeed.tweet_id for newsfeed in newsfeeds],
+                viewer=viewer,
+            )
+        }
+        # NewsFeed 和 Tweet 不在同一个库上， 没有级联删除， 已经被删掉的 tweet 对应的 newsfeed 直接跳过
+        hydrated = []
+        for newsfeed in newsfeeds:
+            if newsfeed.tweet_id not in tweets:
+                continue
+            newsfeed.tweet = tweets[newsfeed.tweet_id]
+            hydrated.append(newsfeed)
+        return hydrated
@@ -0,0 +1,201 @@
+from celery import shared_task
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils.dateparse import parse_datetime
+from friendships.models import Friendship
+from friendships.services import FriendshipService
+from newsfeeds.models import NewsFeed
+from newsfeeds.routers import get_newsfeed_database, group_by_database
+from tweets.models import Tweet
+from tweets.services import TweetService
+from utils.queryset_helpers import iterate_by_created_at
+
+ONE_HOUR = 60 * 60
+
+
+# 每个 batch 的 bulk_create 是幂等的（ignore_conflicts）， 所以数据库出错的时候可以放心重试
+@shared_task(
+    time_limit=ONE_HOUR,
+    autoretry_for=(DatabaseError,),
+    retry_backoff=True,
+    max_retries=3,
+)
+def fanout_newsfeeds_batch_task(tweet_id, created_at, follower_ids):
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedService
+
+    # 通过 celery 传过来的时间是字符串
+    created_at = parse_datetime(created_at)
+    newsfeeds = []
+    # main task 已经按分库拆好了 batch， 这里再按分库分组一次， 保证每个分库只有一次 bulk_create
+    for database, user_ids in group_by_database(follower_ids).items():
+        NewsFeed.objects.using(database).bulk_create(
+            [
+                NewsFeed(user_id=follower_id, tweet_id=tweet_id, created_at=created_at)
+                for follower_id in user_ids
+            ],
+            batch_size=settings.NEWSFEED_BULK_CREATE_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        # MySQL 的 bulk_create 不会返回自增的 id， 走 ('user', 'tweet') 的唯一索引再读一次
+        newsfeeds.extend(NewsFeed.objects.using(database).filter(
+            user_id__in=user_ids,
+            tweet_id=tweet_id,
+        ).only('id', 'user_id', 'tweet_id', 'created_at'))
+    # bulk_create 不会触发 post_save 的 signal， 所以需要手动把新的 newsfeeds 插入到这些 follower 的 cache 中
+    NewsFeedService.push_cached_newsfeeds(newsfeeds)
+    return '{} newsfeeds created'.format(len(newsfeeds))
+
+
+@shared_task(
+    time_limit=ONE_HOUR,
+    autoretry_for=(DatabaseError,),
+    retry_backoff=True,
+    max_retries=3,
+)
+def fanout_newsfeeds_main_task(tweet_id, tweet_user_id, created_at):
+    # 明星用户的 follower 太多， 不做 fanout
+    # follower 读取 newsfeed 的时候会直接去拉取明星用户最近的 tweets
+    if FriendshipService.is_celebrity(tweet_user_id):
+        return 'celebrity user {}, fanout skipped.'.format(tweet_user_id)
+
+    # 把所有 followers 拆成固定大小的 batch， 每个 batch 再按照分库拆开， 是一个单独的 task
+    # 这些 task 会被不同的 worker 并行地执行， 每个 task 只写一个分库
+    # follower ids 是按 batch 从数据库中流式读出来的， 不论 follower 有多少内存占用都是固定的
+    followers_count, batches = 0, 0
+    for follower_ids in FriendshipService.get_follower_id_chunks(
+        tweet_user_id,
+        chunk_size=settings.NEWSFEED_FANOUT_BATCH_SIZE,
+    ):
+        for user_ids in group_by_database(follower_ids).values():
+            fanout_newsfeeds_batch_task.delay(tweet_id, created_at, user_ids)
+            batches += 1
+        followers_count += len(follower_ids)
+
+    return '{} newsfeeds going to fanout, {} batches created.'.format(
+        followers_count,
+        batches,
+    )
+
+
+@shared_task(
+    time_limit=ONE_HOUR,
+    autoretry_for=(DatabaseError,),
+    retry_backoff=True,
+    max_retries=3,
+)
+def backfill_newsfeeds_task(user_id, to_user_ids):
+    """
+    关注之后把被关注的人最近的 tweets 补到自己的 inbox 中
+    明星用户的 tweets 在读的时候会被拉取， 不需要补
+    """
+    from newsfeeds.services import NewsFeedService
+
+    to_user_ids = set(to_user_ids) - FriendshipService.get_celebrity_ids(to_user_ids)
+    if not to_user_ids:
+        return '0 newsfeeds backfilled'
+    # 每个人最多取 NEWSFEED_BACKFILL_LIMIT 条， 每个人单独走 Tweet 的 ('user', 'created_at') 联合索引
+    tweets_by_user = {to_user_id: [] for to_user_id in to_user_ids}
+    for tweet_id, to_user_id, created_at in TweetService.get_recent_tweet_rows(
+        to_user_ids,
+        settings.NEWSFEED_BACKFILL_LIMIT,
+    ):
+        tweets_by_user[to_user_id].append((tweet_id, created_at))
+    # 快速地关注又取关的时候， 取关的 remove_newsfeeds_task 可能已经先执行完了
+    # 写入之前再确认一次关注关系还在， 否则补进来的 newsfeeds 就不会再被删掉了
+    following_ids = set(Friendship.objects.filter(
+        from_user_id=user_id,
+        to_user_id__in=to_user_ids,
+    ).values_list('to_user_id', flat=True))
+    newsfeeds = [
+        NewsFeed(user_id=user_id, tweet_id=tweet_id, created_at=created_at)
+        for to_user_id, tweets in tweets_by_user.items()
+        if to_user_id in following_ids
+        for tweet_id, created_at in tweets
+    ]
+    # ('user', 'tweet') 是唯一索引， 已经在 inbox 里的 tweet 会被忽略
+    NewsFeed.objects.shard_for(user_id).bulk_create(
+        newsfeeds,
+        batch_size=settings.NEWSFEED_BULK_CREATE_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    # 补进来的是旧的 tweets， 会插在 cache 中间， 直接让 cache 失效更简单
+    NewsFeedService.invalidate_cached_newsfeeds(user_id)
+    return '{} newsfeeds backfilled'.format(len(newsfeeds))
+
+
+@shared_task(
+    time_limit=ONE_HOUR,
+    autoretry_for=(DatabaseError,),
+    retry_backoff=True,
+    max_retries=3,
+)
+def backfill_demoted_celebrity_task(user_id):
+    """
+    明星用户降级之后， 把他最近的 NEWSFEED_BACKFILL_LIMIT 条 tweets 补到所有 followers 的 inbox 中
+    这些 tweets 发出的时候没有 fanout， 降级之后也不会再被拉取
+    补完之后才清掉明星用户的标记， 在这之前读 newsfeed 的时候依然会去拉取
+    """
+    from newsfeeds.services import NewsFeedService
+
+    tweets = list(Tweet.objects.filter(
+        user_id=user_id,
+    ).order_by('-created_at').values_list('id', 'created_at')[:settings.NEWSFEED_BACKFILL_LIMIT])
+    followers_count = 0
+    for follower_ids in FriendshipService.get_follower_id_chunks(
+        user_id,
+        chunk_size=settings.NEWSFEED_FANOUT_BATCH_SIZE,
+    ):
+        for database, user_ids in group_by_database(follower_ids).items():
+            NewsFeed.objects.using(database).bulk_create(
+                [
+                    NewsFeed(user_id=follower_id, tweet_id=tweet_id, created_at=created_at)
+                    for follower_id in user_ids
+                    for tweet_id, created_at in tweets
+                ],
+                batch_size=settings.NEWSFEED_BULK_CREATE_BATCH_SIZE,
+                ignore_conflicts=True,
+            )
+        NewsFeedService.invalidate_many_cached_newsfeeds(follower_ids)
+        followers_count += len(follower_ids)
+    FriendshipService.finish_celebrity_demotion(user_id)
+    return '{} tweets backfilled to {} followers'.format(len(tweets), followers_count)
+
+
+@shared_task(
+    time_limit=ONE_HOUR,
+    autoretry_for=(DatabaseError,),
+    retry_backoff=True,
+    max_retries=3,
+)
+def remove_newsfeeds_task(user_id, to_user_id):
+    """
+    取关之后把被取关的人的 tweets 从自己的 inbox 中删掉
+    按 batch 遍历自己的 inbox（有 compact_newsfeeds 的保留策略， 大小是有上限的）， 而不是对方所有的 tweets
+    每个 batch 用一次 Tweet 的 id__in 找出其中对方的 tweets， 再按主键删除， 避免长时间锁表
+    """
+    from newsfeeds.services import NewsFeedService
+
+    database = get_newsfeed_database(user_id)
+    deleted = 0
+    for rows in iterate_by_created_at(
+        NewsFeed.objects.for_user(user_id),
+        chunk_size=settings.NEWSFEED_DELETE_BATCH_SIZE,
+        fields=('tweet_id',),
+    ):
+        newsfeed_ids = {
+            tweet_id: newsfeed_id
+            for newsfeed_id, _, tweet_id in rows
+            if tweet_id is not None
+        }
+        tweet_ids = Tweet.objects.filter(
+            id__in=newsfeed_ids.keys(),
+            user_id=to_user_id,
+        ).values_list('id', flat=True)
+        to_delete = [newsfeed_ids[tweet_id] for tweet_id in tweet_ids]
+        if to_delete:
+            deleted += NewsFeed.objects.shard_for(user_id).filter(
+                id__in=to_delete,
+            )._raw_delete(database)
+    NewsFeedService.invalidate_cached_newsfeeds(user_id)
+    return '{} newsfeeds removed'.format(deleted)
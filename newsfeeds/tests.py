@@ -1,3 +1,433 @@
-from django.test import TestCase
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connections
+from django.test import override_settings
+from django.utils import timezone
+from io import StringIO
+from friendships.models import Friendship
+from friendships.services import FriendshipService
+from newsfeeds.models import NewsFeed
+from newsfeeds.routers import get_newsfeed_database, group_by_database
+from newsfeeds.services import NewsFeedService
+from newsfeeds.tasks import (
+    backfill_newsfeeds_task,
+    fanout_newsfeeds_batch_task,
+    fanout_newsfeeds_main_task,
+    remove_newsfeeds_task,
+)
+from testing.testcases import TestCase
+from utils.list_cache import ListCacheHelper
 
-# Create your tests here.
+
+class NewsFeedShardingTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+
+    def test_router(self):
+        self.assertNotEqual(
+            get_newsfeed_database(self.linghu.id),
+            get_newsfeed_database(self.dongxie.id),
+        )
+        self.assertEqual(
+            group_by_database([1, 2, 3, 4]),
+            {
+                get_newsfeed_database(1): [1, 3],
+                get_newsfeed_database(2): [2, 4],
+            },
+        )
+
+        tweet = self.create_tweet(self.dongxie)
+        newsfeed = self.create_newsfeed(self.linghu, tweet)
+        shard = get_newsfeed_database(self.linghu.id)
+        self.assertEqual(newsfeed._state.db, shard)
+        # 只存在于 linghu 所在的分库上
+        for database in settings.NEWSFEED_DATABASES:
+            self.assertEqual(
+                NewsFeed.objects.using(database).filter(tweet=tweet).exists(),
+                database == shard,
+            )
+
+        # 不指定分库的 save / delete 会按照 user_id 路由到正确的分库
+        newsfeed.created_at = tweet.created_at
+        newsfeed.save()
+        self.assertEqual(
+            NewsFeed.objects.for_user(self.linghu.id).get().created_at,
+            tweet.created_at,
+        )
+        newsfeed.delete()
+        self.assertEqual(NewsFeed.objects.for_user(self.linghu.id).count(), 0)
+
+    def test_deleted_tweet_is_skipped(self):
+        tweets = [self.create_tweet(self.dongxie) for i in range(2)]
+        for tweet in tweets:
+            self.create_newsfeed(self.linghu, tweet)
+        # 分库之后没有级联删除， newsfeed 还在， 但是不会再被返回
+        tweets[0].delete()
+        self.assertEqual(NewsFeed.objects.for_user(self.linghu.id).count(), 2)
+        newsfeeds = NewsFeedService.hydrate_newsfeeds(
+            list(NewsFeed.objects.for_user(self.linghu.id)),
+        )
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweets[1].id])
+
+
+class NewsFeedServiceTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+
+    def test_get_cached_newsfeeds(self):
+        newsfeed_ids = []
+        for i in range(3):
+            tweet = self.create_tweet(self.dongxie)
+            newsfeed = self.create_newsfeed(self.linghu, tweet)
+            newsfeed_ids.append(newsfeed.id)
+        newsfeed_ids = newsfeed_ids[::-1]
+
+        # cache miss 的时候从数据库中重建
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([f.id for f in newsfeeds], newsfeed_ids)
+
+        # cache hit 的时候不会访问数据库
+        with self.assertNumQueries(0):
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([f.id for f in newsfeeds], newsfeed_ids)
+
+        # 新创建的 newsfeed 直接插入到 cache 中， 不需要从数据库中重建
+        tweet = self.create_tweet(self.dongxie)
+        new_newsfeed = self.create_newsfeed(self.linghu, tweet)
+        shard = get_newsfeed_database(self.linghu.id)
+        with self.assertNumQueries(0, using=shard):
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        newsfeed_ids.insert(0, new_newsfeed.id)
+        self.assertEqual([f.id for f in newsfeeds], newsfeed_ids)
+        self.assertEqual(newsfeeds[0].tweet_id, tweet.id)
+
+        # 删除 newsfeed 之后 cache 会失效
+        new_newsfeed.delete()
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([f.id for f in newsfeeds], newsfeed_ids[1:])
+
+    @override_settings(NEWSFEED_CACHE_LIMIT=3)
+    def test_fanout_pushes_to_cache(self):
+        Friendship.objects.create(from_user=self.linghu, to_user=self.dongxie)
+        for i in range(3):
+            NewsFeedService.fanout_to_followers(self.create_tweet(self.dongxie))
+        # 让 linghu 的 cache 存在， dongxie 的 cache 不存在
+        NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        cache.delete(NewsFeedService.get_cache_key(self.dongxie.id))
+
+        tweet = self.create_tweet(self.dongxie)
+        NewsFeedService.fanout_to_followers(tweet)
+        # 重复执行的 batch task 不会在 cache 中留下重复的数据
+        fanout_newsfeeds_batch_task(tweet.id, tweet.created_at.isoformat(), [self.linghu.id])
+        shard = get_newsfeed_database(self.linghu.id)
+        with self.assertNumQueries(0, using=shard):
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        # cache 的长度不会超过上限
+        self.assertEqual(len(newsfeeds), 3)
+        self.assertEqual(newsfeeds[0].tweet_id, tweet.id)
+        self.assertEqual(
+            newsfeeds[0].id,
+            NewsFeed.objects.for_user(self.linghu.id).get(tweet=tweet).id,
+        )
+        expected_ids = list(NewsFeed.objects.for_user(
+            self.linghu.id,
+        ).order_by('-created_at', '-id').values_list('id', flat=True)[:3])
+        self.assertEqual([f.id for f in newsfeeds], expected_ids)
+
+        # 没有 cache 的用户在 fanout 的时候不会创建 cache， 而是在读的时候重建
+        self.assertIsNone(cache.get(NewsFeedService.get_cache_key(self.dongxie.id)))
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
+        self.assertEqual(len(newsfeeds), 3)
+        self.assertEqual(newsfeeds[0].tweet_id, tweet.id)
+
+    def test_rebuild_does_not_overwrite_newer_writes(self):
+        tweet = self.create_tweet(self.dongxie)
+        self.create_newsfeed(self.linghu, tweet)
+        key = NewsFeedService.get_cache_key(self.linghu.id)
+        cache.delete(key)
+
+        # 重建的 query 读到的是旧数据， 写回 cache 之前有新的写入
+        def write_during_rebuild(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            NewsFeedService.invalidate_cached_newsfeeds(self.linghu.id)
+            return result
+
+        shard = get_newsfeed_database(self.linghu.id)
+        with connections[shard].execute_wrapper(write_during_rebuild):
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id])
+        # 旧数据不会留在 cache 中
+        self.assertIsNone(cache.get(key))
+
+        # 没有并发写入的时候正常写回
+        NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertIsNotNone(cache.get(key))
+
+        # push 的时候 key 被别人锁住了， 直接删掉
+        cache.add(ListCacheHelper.get_lock_key(key), 'other', 5)
+        newsfeed = self.create_newsfeed(self.linghu, self.create_tweet(self.dongxie))
+        self.assertIsNone(cache.get(key))
+        cache.delete(ListCacheHelper.get_lock_key(key))
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual(newsfeeds[0].id, newsfeed.id)
+
+
+class NewsFeedTaskTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+
+    @override_settings(NEWSFEED_FANOUT_BATCH_SIZE=3)
+    def test_fanout_main_task(self):
+        tweet = self.create_tweet(self.linghu, 'tweet 1')
+        self.create_friendship(self.dongxie, self.linghu)
+        msg = fanout_newsfeeds_main_task(
+            tweet.id,
+            self.linghu.id,
+            tweet.created_at.isoformat(),
+        )
+        self.assertEqual(msg, '1 newsfeeds going to fanout, 1 batches created.')
+        self.assertEqual(self.count_newsfeeds(), 1)
+
+        for i in range(7):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.linghu)
+        tweet = self.create_tweet(self.linghu, 'tweet 2')
+        msg = fanout_newsfeeds_main_task(
+            tweet.id,
+            self.linghu.id,
+            tweet.created_at.isoformat(),
+        )
+        # 每个 batch 按照分库再拆开， 每个 task 只写一个分库
+        batches = sum(
+            len(group_by_database(follower_ids))
+            for follower_ids in FriendshipService.get_follower_id_chunks(
+                self.linghu.id,
+                chunk_size=3,
+            )
+        )
+        self.assertEqual(
+            msg,
+            '8 newsfeeds going to fanout, {} batches created.'.format(batches),
+        )
+        self.assertEqual(self.count_newsfeeds(tweet=tweet), 8)
+        # newsfeed 写在 follower 所在的分库上， 时间和 tweet 的创建时间一致
+        for friendship in Friendship.objects.filter(to_user=self.linghu):
+            newsfeed = NewsFeed.objects.for_user(friendship.from_user_id).get(
+                tweet=tweet,
+            )
+            self.assertEqual(newsfeed.created_at, tweet.created_at)
+
+        # 重试的时候不会重复创建
+        fanout_newsfeeds_main_task(
+            tweet.id,
+            self.linghu.id,
+            tweet.created_at.isoformat(),
+        )
+        self.assertEqual(self.count_newsfeeds(tweet=tweet), 8)
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=1)
+    def test_celebrity_is_not_fanned_out(self):
+        for i in range(2):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(user, self.linghu)
+        tweet = self.create_tweet(self.linghu)
+        msg = fanout_newsfeeds_main_task(
+            tweet.id,
+            self.linghu.id,
+            tweet.created_at.isoformat(),
+        )
+        self.assertEqual(
+            msg,
+            'celebrity user {}, fanout skipped.'.format(self.linghu.id),
+        )
+        self.assertEqual(self.count_newsfeeds(tweet=tweet), 0)
+
+    @override_settings(NEWSFEED_BACKFILL_LIMIT=2, NEWSFEED_DELETE_BATCH_SIZE=2)
+    def test_backfill_and_remove(self):
+        tweets = [self.create_tweet(self.dongxie) for i in range(5)]
+        # 已经在 inbox 中的 tweet 不会重复创建
+        self.create_newsfeed(self.linghu, tweets[4])
+        self.create_friendship(self.linghu, self.dongxie)
+
+        msg = backfill_newsfeeds_task(self.linghu.id, [self.dongxie.id])
+        self.assertEqual(msg, '2 newsfeeds backfilled')
+        newsfeeds = NewsFeed.objects.for_user(self.linghu.id).order_by('-created_at')
+        self.assertEqual(
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+            [tweets[4].id, tweets[3].id],
+        )
+        self.assertEqual(newsfeeds[1].created_at, tweets[3].created_at)
+
+        # 其他用户的 tweets 不会被删掉
+        other_tweet = self.create_tweet(self.create_user('other'))
+        self.create_newsfeed(self.linghu, other_tweet)
+        self.create_newsfeed(self.linghu, tweets[0])
+        msg = remove_newsfeeds_task(self.linghu.id, self.dongxie.id)
+        self.assertEqual(msg, '3 newsfeeds removed')
+        self.assertEqual(
+            list(NewsFeed.objects.for_user(self.linghu.id).values_list(
+                'tweet_id', flat=True,
+            )),
+            [other_tweet.id],
+        )
+
+    @override_settings(NEWSFEED_DELETE_BATCH_SIZE=2)
+    def test_remove_scans_inbox(self):
+        tweets = [self.create_tweet(self.dongxie) for i in range(3)]
+        other_tweet = self.create_tweet(self.create_user('other'))
+        for tweet in [tweets[0], other_tweet, tweets[2]]:
+            self.create_newsfeed(self.linghu, tweet)
+        # 对方发了很多 tweets 也只和 inbox 的大小有关: 每个 batch 读一次 inbox， 一次 Tweet 的 id__in
+        for i in range(10):
+            self.create_tweet(self.dongxie)
+        shard = get_newsfeed_database(self.linghu.id)
+        with self.assertNumQueries(2), self.assertNumQueries(4, using=shard):
+            msg = remove_newsfeeds_task(self.linghu.id, self.dongxie.id)
+        self.assertEqual(msg, '2 newsfeeds removed')
+        self.assertEqual(
+            list(NewsFeed.objects.for_user(self.linghu.id).values_list('tweet_id', flat=True)),
+            [other_tweet.id],
+        )
+
+    def test_backfill_after_unfollow(self):
+        # 取关之后才执行的 backfill 不会再把对方的 tweets 补进来
+        self.create_tweet(self.dongxie)
+        friendship = self.create_friendship(self.linghu, self.dongxie)
+        friendship.delete()
+        msg = backfill_newsfeeds_task(self.linghu.id, [self.dongxie.id])
+        self.assertEqual(msg, '0 newsfeeds backfilled')
+        self.assertEqual(NewsFeed.objects.for_user(self.linghu.id).count(), 0)
+
+    @override_settings(NEWSFEED_CELEBRITY_THRESHOLD=1)
+    def test_backfill_skips_celebrity(self):
+        self.create_tweet(self.dongxie)
+        self.create_friendship(self.create_user('fan'), self.dongxie)
+        self.create_friendship(self.linghu, self.dongxie)
+        msg = backfill_newsfeeds_task(self.linghu.id, [self.dongxie.id])
+        self.assertEqual(msg, '0 newsfeeds backfilled')
+
+
+class CompactNewsFeedsCommandTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+
+    def test_compact_newsfeeds(self):
+        newsfeeds = [
+            self.create_newsfeed(self.linghu, self.create_tweet(self.dongxie))
+            for i in range(5)
+        ]
+        # 太旧的 newsfeed
+        old_newsfeed = self.create_newsfeed(
+            self.dongxie,
+            self.create_tweet(self.linghu),
+        )
+        NewsFeed.objects.for_user(self.dongxie.id).filter(
+            id=old_newsfeed.id,
+        ).update(created_at=timezone.now() - timedelta(days=10))
+        recent_newsfeed = self.create_newsfeed(
+            self.dongxie,
+            self.create_tweet(self.linghu),
+        )
+        # 让 cache 存在
+        NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+
+        out = StringIO()
+        call_command(
+            'compact_newsfeeds',
+            max_rows=2,
+            max_age_days=5,
+            batch_size=2,
+            stdout=out,
+        )
+        self.assertIn(
+            '2 users scanned, 2 users compacted, 4 rows reclaimed',
+            out.getvalue(),
+        )
+        self.assertIn('rows/s', out.getvalue())
+        self.assertEqual(
+            set(NewsFeed.objects.for_user(self.linghu.id).values_list(
+                'id', flat=True,
+            )),
+            {newsfeeds[3].id, newsfeeds[4].id},
+        )
+        self.assertEqual(
+            list(NewsFeed.objects.for_user(self.dongxie.id).values_list(
+                'id', flat=True,
+            )),
+            [recent_newsfeed.id],
+        )
+        # cache 失效之后重建的数据是正确的
+        self.assertEqual(
+            [f.id for f in NewsFeedService.get_cached_newsfeeds(self.linghu.id)],
+            [newsfeeds[4].id, newsfeeds[3].id],
+        )
+
+        # 再执行一次什么都不会删
+        out = StringIO()
+        call_command('compact_newsfeeds', max_rows=2, max_age_days=5, stdout=out)
+        self.assertIn('0 users compacted, 0 rows reclaimed', out.getvalue())
+
+
+class CopyNewsFeedsToShardsCommandTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+        # 分库之前的 deployment 在 default 上还有一张 newsfeeds 的表， 测试的 default 库上没有， 这里手动建一张
+        with connections['default'].cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE newsfeeds_newsfeed ('
+                'id integer NOT NULL PRIMARY KEY AUTOINCREMENT, '
+                'created_at datetime NOT NULL, '
+                'tweet_id integer NULL, '
+                'user_id integer NULL)'
+            )
+
+    def test_copy_newsfeeds_to_shards(self):
+        tweets = [self.create_tweet(self.dongxie) for i in range(3)]
+        legacy = NewsFeed.objects.using('default')
+        for tweet in tweets:
+            legacy.create(user_id=self.linghu.id, tweet_id=tweet.id, created_at=tweet.created_at)
+        legacy.create(user_id=self.dongxie.id, tweet_id=tweets[0].id, created_at=tweets[0].created_at)
+        # 被删掉的用户的 newsfeed 不会被复制
+        legacy.create(user_id=None, tweet_id=tweets[1].id, created_at=tweets[1].created_at)
+        # 切换之前已经在分库上的 newsfeed 不会重复
+        self.create_newsfeed(self.linghu, tweets[2])
+        # 让 cache 存在
+        NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+
+        out = StringIO()
+        call_command('copy_newsfeeds_to_shards', batch_size=2, stdout=out)
+        self.assertIn('4 newsfeeds scanned', out.getvalue())
+        self.assertEqual(
+            list(NewsFeed.objects.for_user(self.linghu.id).values_list('tweet_id', flat=True)),
+            [tweets[2].id, tweets[1].id, tweets[0].id],
+        )
+        self.assertEqual(
+            list(NewsFeed.objects.for_user(self.dongxie.id).values_list('tweet_id', flat=True)),
+            [tweets[0].id],
+        )
+        # 复制之后 cache 失效， 重建的数据是完整的
+        self.assertEqual(
+            [f.tweet_id for f in NewsFeedService.get_cached_newsfeeds(self.linghu.id)],
+            [tweets[2].id, tweets[1].id, tweets[0].id],
+        )
+
+        # 再执行一次不会有重复的数据
+        call_command('copy_newsfeeds_to_shards', stdout=StringIO())
+        self.assertEqual(self.count_newsfeeds(), 4)
@@ -18,6 +18,9 @@ sudo dpkg -i mysql-apt-config_0.8.15-1_all.deb
 sudo DEBIAN_FRONTEND=noninteractivate apt-get install -y mysql-server
 sudo apt-get install -y libmysqlclient-dev
 
+# 安装 redis， 用作 cache 和 celery 的 message queue
+sudo apt-get install -y redis
+
 if [ ! -f "/usr/bin/pip" ]; then
   sudo apt-get install -y python3-pip
   sudo apt-get install -y python-setuptools
@@ -46,6 +49,8 @@ sudo mysql -u root << EOF
 	flush privileges;
 	show databases;
 	CREATE DATABASE IF NOT EXISTS twitter;
+	CREATE DATABASE IF NOT EXISTS twitter_newsfeeds_0;
+	CREATE DATABASE IF NOT EXISTS twitter_newsfeeds_1;
 EOF
 # fi
 
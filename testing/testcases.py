@@ -1,13 +1,42 @@
 from comments.models import Comment
+from django.conf import settings
 from django.contrib.auth.models import User
+from contextlib import contextmanager
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from friendships.models import Friendship
 from django.test import TestCase as DjangoTestCase
 from rest_framework.test import APIClient
 from tweets.models import Tweet
 from likes.models import Like
-from django.contrib.contenttypes.models import ContentType
+from likes.services import LikeService
+from newsfeeds.models import NewsFeed
 
 
 class TestCase(DjangoTestCase):
+    # NewsFeed 分库存储， 每个 test 都需要能访问所有的数据库
+    databases = '__all__'
+
+    @classmethod
+    @contextmanager
+    def captureOnCommitCallbacks(cls, *, using=DEFAULT_DB_ALIAS, execute=False):
+        # TestCase 中的 transaction 最后都会回滚， on_commit 的回调不会执行
+        # Django 3.2 才有这个方法， 这里是同样的实现， 升级之后可以直接删掉
+        callbacks = []
+        start_count = len(connections[using].run_on_commit)
+        try:
+            yield callbacks
+        finally:
+            callbacks[:] = [
+                func for _, func in connections[using].run_on_commit[start_count:]
+            ]
+            if execute:
+                for callback in callbacks:
+                    callback()
+
+    def clear_cache(self):
+        # locmem cache 在整个测试进程中是共享的， 每个 test 开始前都要清空
+        cache.clear()
 
     @property
     def anonymous_client(self):
@@ -38,8 +67,21 @@ class TestCase(DjangoTestCase):
     def create_like(self, user, target):
         # target is comment or tweet
         instance, _ = Like.objects.get_or_create(
-            content_type=ContentType.objects.get_for_model(target.__class__),
+            content_type_id=LikeService.get_content_type_id(target.__class__),
             object_id=target.id,
             user=user,
         )
         return instance
+
+    def create_newsfeed(self, user, tweet):
+        return NewsFeed.objects.shard_for(user.id).create(user=user, tweet=tweet)
+
+    def count_newsfeeds(self, **kwargs):
+        # 不知道 user_id 的时候需要把所有分库上的数量加起来
+        return sum(
+            NewsFeed.objects.using(database).filter(**kwargs).count()
+            for database in settings.NEWSFEED_DATABASES
+        )
+
+    def create_friendship(self, from_user, to_user):
+        return Friendship.objects.create(from_user=from_user, to_user=to_user)
@@ -2,33 +2,73 @@ from rest_framework import serializers
 from tweets.models import Tweet
 from accounts.api.serializers import UserSerializer
 from accounts.api.serializers import UserSerializerForTweet
-from comments.api.serializers import CommentSerializer
+from comments.api.serializers import CommentSerializerWithLikes
+from likes.api.serializers import LikeSerializer
 
 
 class TweetSerializer(serializers.ModelSerializer):
     user = UserSerializerForTweet()
+    # 由 LikeService.prime_has_liked 批量设置， 一页只需要一次 query
+    # 没有经过 prime 的 tweet （比如刚刚创建的） 显示为 False
+    has_liked = serializers.BooleanField(read_only=True, default=False)
 
     class Meta:
         model = Tweet
-        fields = ('id', 'user', 'created_at', 'content')
+        fields = (
+            'id',
+            'user',
+            'created_at',
+            'content',
+            'likes_count',
+            'comments_count',
+            'has_liked',
+        )
 
 
 class TweetSerializerWithComments(serializers.ModelSerializer):
     user = UserSerializer()
     # <HOMEWORK> 使用 serializer.SerializerMethodField 的方式实现comments
-    comments = CommentSerializer(source='comment_set', many=True)
+    # 不能直接用 comment_set， 否则热门 tweet 的所有评论都会被读出来
+    # 只显示 CommentService.attach_comments_preview 取出来的最新的几条
+    comments = CommentSerializerWithLikes(source='preview_comments', many=True)
+    # 最新的几个点赞， 由 LikeService.attach_likes_preview 设置
+    likes = LikeSerializer(source='preview_likes', many=True)
+    # 用来通过 CommentViewSet.list 获取更早的评论， 没有更多评论的时候为 None
+    next_comments_cursor = serializers.SerializerMethodField()
+    has_liked = serializers.BooleanField(read_only=True, default=False)
 
     # <HOMEWORK实现>
     # comments = serializers.SerializerMethodField()
 
     class Meta:
         model = Tweet
-        fields = ('id', 'user', 'comments', 'created_at', 'content')
+        fields = (
+            'id',
+            'user',
+            'comments',
+            'next_comments_cursor',
+            'likes',
+            'created_at',
+            'content',
+            'likes_count',
+            'comments_count',
+            'has_liked',
+        )
 
     # <HOMEWORK实现>
     # def get_comments(self, obj):
     #     return CommentSerializer(obj.comments_set.all(), many=True).data
 
+    def get_next_comments_cursor(self, obj):
+        if not obj.has_more_comments:
+            return None
+        last_comment = obj.preview_comments[-1]
+        return {
+            'tweet_id': obj.id,
+            'created_at__lt': last_comment.created_at,
+            'id__lt': last_comment.id,
+        }
+
 
 class TweetSerializerForCreate(serializers.ModelSerializer):
     content = serializers.CharField(min_length=6, max_length=140)
@@ -1,6 +1,10 @@
+from django.core.cache import cache
+from django.test import override_settings
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
 from tweets.models import Tweet
+from tweets.services import TweetService
+from utils.paginations import EndlessPagination
 
 
 # 注意要加'/'结尾 不然会产生301 redirect
@@ -12,6 +16,7 @@ TWEET_RETRIEVE_API = '/api/tweets/{}/'
 class TweetApiTests(TestCase):
 
     def setUp(self):
+        self.clear_cache()
         self.user1 = self.create_user('user1', 'user1@jiuzhang.com')
         self.tweets1 = [
             self.create_tweet(self.user1)
@@ -41,6 +46,17 @@ class TweetApiTests(TestCase):
         self.assertEqual(response.data['tweets'][0]['id'], self.tweets2[1].id)
         self.assertEqual(response.data['tweets'][1]['id'], self.tweets2[0].id)
 
+        # user_id 必须是整数， 带前导 0 的和不带的是同一个 timeline， 也是同一个 cache key
+        response = self.anonymous_client.get(TWEET_LIST_API, {'user_id': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual('user_id' in response.data['errors'], True)
+        self.clear_cache()
+        response = self.anonymous_client.get(TWEET_LIST_API, {'user_id': '0{}'.format(self.user2.id)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['tweets']), 2)
+        self.assertNotEqual(cache.get(TweetService.get_cache_key(self.user2.id)), None)
+        self.assertEqual(cache.get(TweetService.get_cache_key('0{}'.format(self.user2.id))), None)
+
     def test_create_api(self):
         # 必须登录
         response = self.anonymous_client.post(TWEET_CREATE_API)
@@ -85,4 +101,137 @@ class TweetApiTests(TestCase):
         # 检验在非当前tweet下的comment是否会被计算进去
         self.create_comment(self.user1, self.create_tweet(self.user2), 'wow')
         response = self.anonymous_client.get(url)
-        self.assertEqual(len(response.data['comments']), 2)
\ No newline at end of file
+        self.assertEqual(len(response.data['comments']), 2)
+        # 最新的评论在前面
+        self.assertEqual(response.data['comments'][0]['content'], 'hmm...')
+        self.assertEqual(response.data['next_comments_cursor'], None)
+
+    @override_settings(LIKES_PREVIEW_SIZE=2)
+    def test_retrieve_likes_preview(self):
+        tweet = self.create_tweet(self.user1)
+        comments = [self.create_comment(self.user1, tweet, str(i)) for i in range(2)]
+        url = TWEET_RETRIEVE_API.format(tweet.id)
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.data['likes'], [])
+        self.assertEqual(response.data['comments'][0]['likes'], [])
+
+        users = [self.create_user('user{}'.format(i + 3)) for i in range(3)]
+        for user in users:
+            self.create_like(user, tweet)
+        self.create_like(self.user2, comments[1])
+        # 点赞都在 cache 中， 只需要查一次最新的评论
+        self.anonymous_client.get(url)
+        with self.assertNumQueries(1):
+            response = self.anonymous_client.get(url)
+        # 只显示最新的两个点赞
+        self.assertEqual(
+            [like['user']['username'] for like in response.data['likes']],
+            ['user5', 'user4'],
+        )
+        self.assertEqual(
+            [like['user']['username'] for like in response.data['comments'][0]['likes']],
+            ['user2'],
+        )
+        self.assertEqual(response.data['comments'][1]['likes'], [])
+
+    @override_settings(COMMENTS_PREVIEW_SIZE=3)
+    def test_retrieve_comments_preview(self):
+        tweet = self.create_tweet(self.user1)
+        url = TWEET_RETRIEVE_API.format(tweet.id)
+        for i in range(5):
+            self.create_comment(self.user2, tweet, str(i))
+            self.create_comment(self.create_user('user{}'.format(i + 3)), tweet, str(i))
+        self.anonymous_client.get(url)
+
+        # tweet， users 和点赞数都在 cache 中之后， 只需要查一次最新的评论
+        with self.assertNumQueries(1):
+            response = self.anonymous_client.get(url)
+        comments = response.data['comments']
+        self.assertEqual([comment['content'] for comment in comments], ['4', '4', '3'])
+        self.assertEqual(comments[0]['user']['username'], 'user7')
+        self.assertEqual(response.data['comments_count'], 10)
+
+        # 通过 cursor 从 comments 的 list api 中获取更早的评论
+        cursor = response.data['next_comments_cursor']
+        self.assertEqual(cursor['tweet_id'], tweet.id)
+        self.assertEqual(cursor['id__lt'], comments[-1]['id'])
+        response = self.anonymous_client.get('/api/comments/', cursor)
+        self.assertEqual(len(response.data['comments']), 7)
+        self.assertEqual(response.data['comments'][0]['id'], comments[-1]['id'] - 1)
+
+    @override_settings(USER_TWEETS_CACHE_LIMIT=30)
+    def test_list_pagination(self):
+        page_size = EndlessPagination.page_size
+        tweets = self.tweets1 + [
+            self.create_tweet(self.user1)
+            for i in range(page_size * 2 - len(self.tweets1))
+        ]
+        tweets = tweets[::-1]
+
+        # 第一页
+        response = self.anonymous_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [tweet['id'] for tweet in response.data['tweets']],
+            [tweet.id for tweet in tweets[:page_size]],
+        )
+
+        # 第二页超出了 cache 的范围， 从数据库中翻页
+        response = self.anonymous_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'created_at__lt': tweets[page_size - 1].created_at,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [tweet['id'] for tweet in response.data['tweets']],
+            [tweet.id for tweet in tweets[page_size:]],
+        )
+
+        # 下拉刷新
+        new_tweet = self.create_tweet(self.user1)
+        response = self.anonymous_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'created_at__gt': tweets[0].created_at,
+        })
+        self.assertEqual(len(response.data['tweets']), 1)
+        self.assertEqual(response.data['tweets'][0]['id'], new_tweet.id)
+
+    def test_list_pagination_with_same_created_at(self):
+        # created_at 相同的时候， 带上 id__lt 翻页不会跳过被切在两页之间的 tweets
+        page_size = EndlessPagination.page_size
+        for i in range(page_size + 5):
+            self.create_tweet(self.user1)
+        created_at = self.tweets1[0].created_at
+        Tweet.objects.filter(user=self.user1).update(created_at=created_at)
+        expected_ids = sorted(
+            Tweet.objects.filter(user=self.user1).values_list('id', flat=True),
+            reverse=True,
+        )
+
+        # 分别从数据库和 cache 中翻页
+        for limit in [10, 50]:
+            self.clear_cache()
+            with override_settings(USER_TWEETS_CACHE_LIMIT=limit):
+                response = self.anonymous_client.get(TWEET_LIST_API, {
+                    'user_id': self.user1.id,
+                })
+                first_page = response.data['tweets']
+                self.assertEqual(response.data['has_next_page'], True)
+                response = self.anonymous_client.get(TWEET_LIST_API, {
+                    'user_id': self.user1.id,
+                    'created_at__lt': first_page[-1]['created_at'],
+                    'id__lt': first_page[-1]['id'],
+                })
+                second_page = response.data['tweets']
+                self.assertEqual(response.data['has_next_page'], False)
+            self.assertEqual(
+                [tweet['id'] for tweet in first_page + second_page],
+                expected_ids,
+            )
+
+        response = self.anonymous_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'created_at__lt': first_page[-1]['created_at'],
+            'id__lt': 'abc',
+        })
+        self.assertEqual(response.status_code, 400)
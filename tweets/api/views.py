@@ -1,3 +1,4 @@
+from django.http import Http404
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from tweets.api.serializers import \
@@ -6,13 +7,18 @@ from tweets.api.serializers import \
     TweetSerializerWithComments
 from rest_framework.response import Response
 from tweets.models import Tweet
+from comments.services import CommentService
+from likes.services import LikeService
 from newsfeeds.services import NewsFeedService
+from tweets.services import TweetService
 from utils.decorators import required_params
+from utils.paginations import EndlessPagination
 
 
 class TweetViewSet(viewsets.GenericViewSet):
     serializer_class = TweetSerializerForCreate
     queryset = Tweet.objects.all()
+    pagination_class = EndlessPagination
 
     def get_permissions(self):
         if self.action in ['list', 'retrieve']:
@@ -28,15 +34,42 @@ class TweetViewSet(viewsets.GenericViewSet):
 
         # 此处的搜索需要建立联合索引 来加快搜索速度
         # 需要在tweets -- models -- Tweet中建立联合索引
-        tweets = Tweet.objects.filter(
-            user_id=request.query_params['user_id']
-        ).order_by('-created_at')
+        # 按照 (created_at, id) 翻页， 每次只返回一页， 最新的一页从 cache 中读取
+        # user_id 会用来拼 cache 的 key， 先转成 int， 否则 ?user_id=03 和 ?user_id=3 会是两个 key
+        try:
+            user_id = int(request.query_params['user_id'])
+        except ValueError:
+            return Response({
+                "success": False,
+                "message": "Please check input",
+                "errors": {'user_id': ['A valid integer is required.']},
+            }, status=400)
+        page = TweetService.paginate_user_tweets(
+            user_id,
+            self.paginator,
+            request,
+        )
+        tweets = TweetService.hydrate_tweets(
+            [tweet.id for tweet in page],
+            viewer=request.user,
+        )
         serializer = TweetSerializer(tweets, many=True)  # many=True说明会返回一个list of dict
-        return Response({'tweets': serializer.data})
+        return Response({
+            'tweets': serializer.data,
+            'has_next_page': self.paginator.has_next_page,
+        })
 
     def retrieve(self, request, *args, **kwargs):
-        # 如果要使用get_object 一定要先定义query_set
-        tweet = self.get_object()
+        # 不使用 get_object， 而是先从 cache 中读取 tweet 和 tweet.user
+        tweet = TweetService.get_by_id(kwargs['pk'])
+        if tweet is None:
+            raise Http404
+        TweetService.prepare_for_serialization([tweet], viewer=request.user)
+        # 只带上最新的几条评论， 不论 tweet 有多少评论 query 的数量都是固定的
+        CommentService.attach_comments_preview(tweet)
+        # tweet 和这几条评论各自最新的几个点赞， 每种 model 一次 likes_for
+        LikeService.attach_likes_preview([tweet])
+        LikeService.attach_likes_preview(tweet.preview_comments)
         return Response(TweetSerializerWithComments(tweet).data)
 
     def create(self, request):
@@ -53,5 +86,6 @@ class TweetViewSet(viewsets.GenericViewSet):
 
         # save will trigger create method in TweetSerializerForCreate
         tweet = serializer.save()
+        # fanout 是异步执行的， tweet 写入数据库之后请求就可以返回了
         NewsFeedService.fanout_to_followers(tweet)
         return Response(TweetSerializer(tweet).data, status=201)
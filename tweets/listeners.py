@@ -0,0 +1,12 @@
+def update_cached_tweets(sender, instance, **kwargs):
+    # 新建的 tweet 直接插入到 timeline 的 cache 中， 删除的时候让 cache 失效， 下次读的时候从数据库中重建
+    # update 不会改变 (id, created_at)， 不需要处理
+    if kwargs.get('created') is False:
+        return
+
+    # 在函数内部 import 避免循环依赖
+    from tweets.services import TweetService
+    if kwargs.get('created'):
+        TweetService.push_cached_tweets([instance])
+        return
+    TweetService.invalidate_cached_tweets(instance.user_id)
@@ -0,0 +1,108 @@
+from comments.models import Comment
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F
+from likes.models import Like
+from likes.services import LikeService
+from tweets.models import Tweet
+from utils.object_cache import ObjectCacheHelper
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the denormalized likes_count / comments_count of tweets and '
+        'the likes_count of comments in batches of primary keys.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of tweets or comments recounted by each batch.',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        tweet_type_id = LikeService.get_content_type_id(Tweet)
+        comment_type_id = LikeService.get_content_type_id(Comment)
+
+        tweets_scanned, tweets_fixed = self.recount(Tweet, {
+            'likes_count': lambda ids: self.count_likes(tweet_type_id, ids),
+            'comments_count': self.count_comments,
+        }, batch_size)
+        comments_scanned, comments_fixed = self.recount(Comment, {
+            'likes_count': lambda ids: self.count_likes(comment_type_id, ids),
+        }, batch_size)
+
+        self.stdout.write(
+            '{} tweets scanned, {} tweets fixed, '
+            '{} comments scanned, {} comments fixed'.format(
+                tweets_scanned,
+                tweets_fixed,
+                comments_scanned,
+                comments_fixed,
+            )
+        )
+
+    def count_likes(self, content_type_id, object_ids):
+        # 走 ('content_type', 'object_id', 'created_at') 的联合索引
+        counts = {
+            row['object_id']: row['count']
+            for row in Like.objects.filter(
+                content_type_id=content_type_id,
+                object_id__in=object_ids,
+            ).values('object_id').annotate(count=Count('id')).order_by()
+        }
+        # 分片计数器中还没有合并的部分不应该算在 likes_count 里
+        pending = LikeService.count_pending_likes(content_type_id, object_ids)
+        return {
+            object_id: counts.get(object_id, 0) - pending.get(object_id, 0)
+            for object_id in set(counts) | set(pending)
+        }
+
+    def count_comments(self, tweet_ids):
+        # 走 ('tweet', 'created_at') 的联合索引
+        return {
+            row['tweet_id']: row['count']
+            for row in Comment.objects.filter(
+                tweet_id__in=tweet_ids,
+            ).values('tweet_id').annotate(count=Count('id')).order_by()
+        }
+
+    def recount(self, model_class, counters, batch_size):
+        """
+        counters: {field: 一个 batch 的 ids -> {id: 真实的数量}}
+        按照主键逐批遍历， 每个 batch 对每种 counter 只做一次 GROUP BY 的 query
+        只更新不一致的行， 而且是用 F() 加上差值， 不会覆盖掉遍历过程中发生的点赞和评论
+        """
+        scanned, fixed = 0, 0
+        last_id = 0
+        while True:
+            rows = list(model_class.objects.filter(
+                id__gt=last_id,
+            ).order_by('id').values('id', *counters.keys())[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            object_ids = [row['id'] for row in rows]
+            actual = {
+                field: count(object_ids)
+                for field, count in counters.items()
+            }
+            for row in rows:
+                deltas = {
+                    field: actual[field].get(row['id'], 0) - row[field]
+                    for field in counters
+                }
+                changes = {
+                    field: F(field) + delta
+                    for field, delta in deltas.items()
+                    if delta
+                }
+                if not changes:
+                    continue
+                model_class.objects.filter(id=row['id']).update(**changes)
+                ObjectCacheHelper.invalidate_cached_object(model_class, row['id'])
+                fixed += 1
+            scanned += len(rows)
+        return scanned, fixed
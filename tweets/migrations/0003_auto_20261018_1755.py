@@ -0,0 +1,23 @@
+# Generated by Django 3.1.3 on 2026-10-18 17:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweets', '0002_auto_20210505_0528'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tweet',
+            name='comments_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tweet',
+            name='likes_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
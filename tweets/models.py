@@ -1,8 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from tweets.listeners import update_cached_tweets
+from utils.listeners import invalidate_object_cache
 from utils.time_helpers import utc_now
 from likes.models import Like
-from django.contrib.contenttypes.models import ContentType
+from likes.services import LikeService
 # from comments.models import Comment
 
 # django 内部支持的一种方法：
@@ -26,6 +29,13 @@ class Tweet(models.Model):
     content = models.CharField(max_length=255)
     # auto_now 创建的时候自动把当前时间填入
     created_at = models.DateTimeField(auto_now_add=True)
+    # 冗余存储的点赞数和评论数， 显示的时候不需要再去 likes / comments 表中 COUNT(*)
+    # comments_count 在 Comment 创建和删除的时候通过 F() 原子地更新
+    # 点赞不直接更新这一行， 而是写到 LikeCounterShard 的分片中， 再由 fold_like_counters_task 定期合并到 likes_count
+    # 所以 likes_count 可能落后， 真实的点赞数 = likes_count + 还没有合并的分片， 显示之前用 LikeService.prime_likes_counts 加上
+    # 和真实数据的偏差可以通过 python manage.py recount_counters 修正
+    likes_count = models.IntegerField(default=0)
+    comments_count = models.IntegerField(default=0)
 
     class Meta:
         # 建立联合索引
@@ -49,7 +59,7 @@ class Tweet(models.Model):
     @property
     def like_set(self):
         return Like.objects.filter(
-            content_type=ContentType.objects.get_for_model(Tweet),
+            content_type_id=LikeService.get_content_type_id(Tweet),
             object_id=self.id,
         ).order_by('-created_at')
 
@@ -57,3 +67,9 @@ class Tweet(models.Model):
         # 这里是执行print(Tweet instance)的时候显示的内容
         # python3.0 format的写法 f'{variable}'
         return f'{self.created_at} {self.user} {self.content}'
+
+
+post_save.connect(update_cached_tweets, sender=Tweet)
+post_delete.connect(update_cached_tweets, sender=Tweet)
+post_save.connect(invalidate_object_cache, sender=Tweet)
+post_delete.connect(invalidate_object_cache, sender=Tweet)
@@ -0,0 +1,107 @@
+from accounts.services import UserService
+from django.conf import settings
+from likes.services import LikeService
+from tweets.models import Tweet
+from twitter.cache import USER_TWEETS_PATTERN
+from utils.list_cache import ListCacheHelper
+from utils.object_cache import ObjectCacheHelper
+from utils.queryset_helpers import evaluate_sliced_querysets
+
+
+class TweetService(object):
+
+    @classmethod
+    def get_by_id(cls, tweet_id):
+        # 不存在的时候返回 None
+        return ObjectCacheHelper.get_object(Tweet, tweet_id)
+
+    @classmethod
+    def get_by_ids(cls, tweet_ids):
+        # 一次 cache 的 multi-get， miss 的部分再用一次 id__in 的 query， 返回 {tweet_id: tweet}
+        return ObjectCacheHelper.get_objects(Tweet, tweet_ids)
+
+    @classmethod
+    def hydrate_tweets(cls, tweet_ids, viewer=None):
+        """
+        按照 tweet_ids 的顺序返回 tweets， 已经被删掉的 tweet 会被跳过
+        tweet 和 tweet.user 都各自用一次 multi-get 批量取出来， 序列化的时候不会再产生 N + 1 Queries
+        viewer 是当前登录的用户， 用来判断是否点过赞
+        """
+        tweets = cls.get_by_ids(tweet_ids)
+        cls.prepare_for_serialization(list(tweets.values()), viewer)
+        return [tweets[tweet_id] for tweet_id in tweet_ids if tweet_id in tweets]
+
+    @classmethod
+    def prepare_for_serialization(cls, tweets, viewer=None):
+        # 批量挂上 tweet.user， 加上分片计数器中还没有合并的点赞数， 以及 viewer 是否点过赞
+        UserService.attach_users(tweets)
+        LikeService.prime_likes_counts(tweets)
+        return LikeService.prime_has_liked(tweets, viewer)
+
+    @classmethod
+    def paginate_user_tweets(cls, user_id, paginator, request):
+        """
+        用户的 timeline， 返回这一页的 Tweet， 只有 id 和 created_at
+        最新的 USER_TWEETS_CACHE_LIMIT 条从 cache 中翻页， 更早的再走 ('user', 'created_at') 的联合索引
+        """
+        tweets = [
+            Tweet(id=tweet_id, user_id=user_id, created_at=created_at)
+            for tweet_id, created_at in cls.get_cached_tweet_entries(user_id)
+        ]
+        page = paginator.paginate_cached_list(
+            tweets,
+            request,
+            limit=settings.USER_TWEETS_CACHE_LIMIT,
+        )
+        if page is not None:
+            return page
+        return paginator.paginate_queryset(
+            Tweet.objects.filter(user_id=user_id).only('id', 'user_id', 'created_at'),
+            request,
+        )
+
+    @classmethod
+    def get_cache_stats(cls):
+        # {'hits': ..., 'misses': ..., 'hit_rate': ...}， 用于监控 tweet cache 的命中率
+        return ObjectCacheHelper.get_stats(Tweet)
+
+    @classmethod
+    def get_cache_key(cls, user_id):
+        return USER_TWEETS_PATTERN.format(user_id=user_id)
+
+    @classmethod
+    def get_cached_tweet_entries(cls, user_id):
+        # cache 中只存 (tweet_id, created_at)
+        # cache miss 的时候走 ('user', 'created_at') 的联合索引重建
+        return ListCacheHelper.load_entries(
+            key=cls.get_cache_key(user_id),
+            queryset=Tweet.objects.filter(user_id=user_id),
+            fields=('id', 'created_at'),
+            limit=settings.USER_TWEETS_CACHE_LIMIT,
+        )
+
+    @classmethod
+    def push_cached_tweets(cls, tweets):
+        # 新的 tweet 直接插入到作者 timeline 的 cache 中
+        ListCacheHelper.push_entries(
+            {cls.get_cache_key(tweet.user_id): (tweet.id, tweet.created_at) for tweet in tweets},
+            fields=('id', 'created_at'),
+            limit=settings.USER_TWEETS_CACHE_LIMIT,
+        )
+
+    @classmethod
+    def invalidate_cached_tweets(cls, user_id):
+        ListCacheHelper.invalidate(cls.get_cache_key(user_id))
+
+    @classmethod
+    def get_recent_tweet_rows(cls, user_ids, limit):
+        """
+        每个 user 最近的 limit 条 tweets， 返回 [(tweet_id, user_id, created_at), ...]
+        每个 user 单独走 ('user', 'created_at') 的联合索引， 只读 limit 条， 不会因为某个人的 tweets 很多而变慢
+        """
+        return evaluate_sliced_querysets([
+            Tweet.objects.filter(user_id=user_id).order_by('-created_at').values_list(
+                'id', 'user_id', 'created_at',
+            )[:limit]
+            for user_id in user_ids
+        ])
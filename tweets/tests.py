@@ -1,6 +1,12 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from comments.models import Comment
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from io import StringIO
+from likes.services import LikeService
 from tweets.models import Tweet
+from tweets.services import TweetService
 from datetime import timedelta
 from utils.time_helpers import utc_now
 from testing.testcases import TestCase
@@ -9,6 +15,7 @@ from testing.testcases import TestCase
 class TweetTests(TestCase):
 
     def setUp(self):
+        self.clear_cache()
         self.user = User.objects.create_user(username='garyyz')
         self.tweet = Tweet.objects.create(user=self.user, content='LALALA')
 
@@ -28,3 +35,150 @@ class TweetTests(TestCase):
         self.create_like(chenmo, self.tweet)
         self.assertEqual(self.tweet.like_set.count(), 2)
 
+
+class TweetCountersTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+        self.tweet = self.create_tweet(self.linghu)
+
+    def test_counters(self):
+        # 先让 tweet 进入 object cache
+        TweetService.get_by_id(self.tweet.id)
+
+        like = self.create_like(self.dongxie, self.tweet)
+        self.create_like(self.linghu, self.tweet)
+        comment = self.create_comment(self.dongxie, self.tweet)
+        self.create_comment(self.linghu, self.tweet)
+        comment.content = 'updated'
+        comment.save()
+        # 评论数更新之后 cache 中的旧数据会失效
+        tweet = TweetService.get_by_id(self.tweet.id)
+        self.assertEqual(tweet.comments_count, 2)
+        # 点赞数先记在分片计数器中， 读的时候加上
+        self.assertEqual(tweet.likes_count, 0)
+        tweet = TweetService.hydrate_tweets([self.tweet.id])[0]
+        self.assertEqual(tweet.likes_count, 2)
+
+        like.delete()
+        comment.delete()
+        self.clear_cache()
+        tweet = TweetService.hydrate_tweets([self.tweet.id])[0]
+        self.assertEqual(tweet.likes_count, 1)
+        self.assertEqual(tweet.comments_count, 1)
+
+    def test_recount_counters(self):
+        comment = self.create_comment(self.dongxie, self.tweet)
+        self.create_like(self.dongxie, self.tweet)
+        self.create_like(self.linghu, comment)
+        other_tweet = self.create_tweet(self.dongxie)
+        # 制造不一致的计数
+        Tweet.objects.filter(id=self.tweet.id).update(likes_count=5, comments_count=0)
+        Comment.objects.filter(id=comment.id).update(likes_count=3)
+        TweetService.get_by_id(self.tweet.id)
+
+        out = StringIO()
+        call_command('recount_counters', batch_size=1, stdout=out)
+        self.assertIn(
+            '2 tweets scanned, 1 tweets fixed, 1 comments scanned, 1 comments fixed',
+            out.getvalue(),
+        )
+        # 分片计数器中还没有合并的点赞不会被算进 likes_count
+        tweet = TweetService.get_by_id(self.tweet.id)
+        self.assertEqual(tweet.likes_count, 0)
+        self.assertEqual(tweet.comments_count, 1)
+        self.assertEqual(TweetService.hydrate_tweets([self.tweet.id])[0].likes_count, 1)
+        comment.refresh_from_db()
+        self.assertEqual(comment.likes_count, 0)
+        self.assertEqual(LikeService.prime_likes_counts([comment])[0].likes_count, 1)
+        other_tweet.refresh_from_db()
+        self.assertEqual(other_tweet.likes_count, 0)
+
+        # 计数都正确的时候不会更新任何数据
+        out = StringIO()
+        call_command('recount_counters', stdout=out)
+        self.assertIn('0 tweets fixed', out.getvalue())
+        self.assertIn('0 comments fixed', out.getvalue())
+
+
+class TweetServiceTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.linghu = self.create_user('linghu')
+
+    def test_get_cached_tweet_entries(self):
+        tweet_ids = [self.create_tweet(self.linghu).id for i in range(3)]
+        tweet_ids = tweet_ids[::-1]
+
+        # cache miss 的时候从数据库中重建
+        entries = TweetService.get_cached_tweet_entries(self.linghu.id)
+        self.assertEqual([tweet_id for tweet_id, _ in entries], tweet_ids)
+
+        # 新的 tweet 直接插入到 cache 中
+        new_tweet = self.create_tweet(self.linghu)
+        with self.assertNumQueries(0):
+            entries = TweetService.get_cached_tweet_entries(self.linghu.id)
+        self.assertEqual(entries[0], (new_tweet.id, new_tweet.created_at))
+        with self.assertNumQueries(0):
+            TweetService.get_cached_tweet_entries(self.linghu.id)
+
+        # 删除 tweet 之后 cache 失效
+        new_tweet.delete()
+        entries = TweetService.get_cached_tweet_entries(self.linghu.id)
+        self.assertEqual([tweet_id for tweet_id, _ in entries], tweet_ids)
+
+    def test_get_by_id(self):
+        tweets = [self.create_tweet(self.linghu) for i in range(3)]
+
+        # 第一次从数据库中读取， 之后从 cache 中读取
+        with self.assertNumQueries(1):
+            tweet = TweetService.get_by_id(tweets[0].id)
+        self.assertEqual(tweet.content, tweets[0].content)
+        with self.assertNumQueries(0):
+            tweet = TweetService.get_by_id(str(tweets[0].id))
+        self.assertEqual(tweet.id, tweets[0].id)
+
+        # 批量读取的时候 cache miss 的部分只需要一次 query
+        with self.assertNumQueries(1):
+            tweet_map = TweetService.get_by_ids([t.id for t in tweets] + [-1])
+        self.assertEqual(set(tweet_map.keys()), {t.id for t in tweets})
+        self.assertIsNone(TweetService.get_by_id(-1))
+        self.assertIsNone(TweetService.get_by_id('abc'))
+
+        # 修改和删除之后 cache 失效
+        tweets[0].content = 'updated'
+        tweets[0].save()
+        self.assertEqual(TweetService.get_by_id(tweets[0].id).content, 'updated')
+        tweets[0].delete()
+        self.assertIsNone(TweetService.get_by_id(tweets[0].id))
+
+    @override_settings(OBJECT_CACHE_STATS_SAMPLE_RATE=1)
+    def test_cache_version_and_stats(self):
+        tweet = self.create_tweet(self.linghu)
+        TweetService.get_by_id(tweet.id)
+        TweetService.get_by_id(tweet.id)
+        TweetService.get_by_ids([tweet.id, -1])
+        self.assertEqual(TweetService.get_cache_stats(), {
+            'hits': 2,
+            'misses': 2,
+            'hit_rate': 0.5,
+        })
+
+        # 版本号变化之后旧的 cache 不会再被读到
+        with override_settings(OBJECT_CACHE_VERSION=settings.OBJECT_CACHE_VERSION + 1):
+            with self.assertNumQueries(1):
+                TweetService.get_by_id(tweet.id)
+        self.assertEqual(TweetService.get_cache_stats()['misses'], 3)
+
+    def test_cache_stats_off_by_default(self):
+        tweet = self.create_tweet(self.linghu)
+        TweetService.get_by_id(tweet.id)
+        TweetService.get_by_id(tweet.id)
+        self.assertEqual(TweetService.get_cache_stats(), {
+            'hits': 0,
+            'misses': 0,
+            'hit_rate': 0,
+        })
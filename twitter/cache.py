@@ -0,0 +1,23 @@
+# 所有 cache key 的格式统一放在这里， 避免不同模块之间的 key 冲突
+USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
+LIST_CACHE_GENERATION_PATTERN = '{key}:generation'
+LIST_CACHE_LOCK_PATTERN = '{key}:lock'
+CELEBRITY_FLAG_PATTERN = 'is_celebrity:{user_id}'
+CELEBRITY_DEMOTION_PATTERN = 'celebrity_demotion:{user_id}'
+CELEBRITY_FOLLOWINGS_PATTERN = 'celebrity_followings:{user_id}'
+OBJECT_PATTERN = '{model}:v{version}:{object_id}'
+OBJECT_CACHE_HITS_PATTERN = 'object_cache_hits:{model}'
+OBJECT_CACHE_MISSES_PATTERN = 'object_cache_misses:{model}'
+PENDING_LIKES_COUNT_PATTERN = 'pending_likes_count:{content_type_id}:{object_id}'
+OBJECT_LIKES_PATTERN = 'likes:{content_type_id}:{object_id}'
+LIKE_BUFFER_TAIL_KEY = 'like_buffer:tail'
+LIKE_BUFFER_HEAD_KEY = 'like_buffer:head'
+LIKE_BUFFER_LOCK_KEY = 'like_buffer:lock'
+LIKE_BUFFER_EVENT_PATTERN = 'like_buffer:event:{slot}'
+LIKE_BUFFER_HOLE_PATTERN = 'like_buffer:hole:{slot}'
+LIKE_OVERLAY_PATTERN = 'like_overlay:{user_id}:{content_type_id}:{object_id}'
+FOLLOWING_IDS_PATTERN = 'following_ids:{user_id}'
+FOLLOWING_IDS_LOCK_PATTERN = 'following_ids_lock:{user_id}'
+FOLLOWING_IDS_GENERATION_PATTERN = 'following_ids_generation:{user_id}'
+USER_PATTERN = 'user:v3:{user_id}'
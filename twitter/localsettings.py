@@ -24,6 +24,13 @@ LOGGING = {
 }
 
 
+# 新的分库第一次 migrate 之前:
+#   CREATE DATABASE twitter_newsfeeds_0; CREATE DATABASE twitter_newsfeeds_1;
+#   python manage.py migrate --database=newsfeeds_0
+#   python manage.py migrate --database=newsfeeds_1
+# 分库上没有 auth_user / tweets_tweet 这两张表， newsfeeds 的 0001 还是会建外键（0003 再删掉），
+# 所以分库的连接上关掉了外键检查， 否则 MySQL 不允许建立指向不存在的表的外键
+# 单元测试不会用到这里的配置， 见 settings.py 末尾的 TESTING
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.mysql',
@@ -32,5 +39,24 @@ DATABASES = {
         'PORT': '3306',
         'USER': 'root',
         'PASSWORD': 'yourpassword', # 这里是自己下载mysql时候输入两次的那个密码
+    },
+    # NewsFeed 的分库， 和 settings.NEWSFEED_DATABASES 对应
+    'newsfeeds_0': {
+        'ENGINE': 'django.db.backends.mysql',
+        'NAME': 'twitter_newsfeeds_0',
+        'HOST': '0.0.0.0',
+        'PORT': '3306',
+        'USER': 'root',
+        'PASSWORD': 'yourpassword',
+        'OPTIONS': {'init_command': 'SET foreign_key_checks = 0'},
+    },
+    'newsfeeds_1': {
+        'ENGINE': 'django.db.backends.mysql',
+        'NAME': 'twitter_newsfeeds_1',
+        'HOST': '0.0.0.0',
+        'PORT': '3306',
+        'USER': 'root',
+        'PASSWORD': 'yourpassword',
+        'OPTIONS': {'init_command': 'SET foreign_key_checks = 0'},
+    },
 }
-}
\ No newline at end of file
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import sys
+
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -26,6 +28,9 @@ SECRET_KEY = 'w4%t&@yo0!y*3ysi80b03h7b2w11vxj#$u2n_b@96@zgij8o38'
 # 正常情况下 此处应该是False 然后从本地的 localsetting 文件中将其设置为True来overwrite
 DEBUG = True
 
+# 通过命令行参数判断当前是否在跑单元测试
+TESTING = ((" ".join(sys.argv)).find('manage.py test') != -1)
+
 ALLOWED_HOSTS = ['127.0.0.1', '192.168.33.10', 'localhost']
 INTERNAL_IPS = ['127.0.0.1', '192.168.33.10', 'localhost', '10.0.2.2']
 
@@ -47,6 +52,7 @@ INSTALLED_APPS = [
     'debug_toolbar',
 
     # project apps
+    'accounts',
     'tweets',
     'friendships',
     'newsfeeds',
@@ -59,8 +65,16 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
-    ]
+    ],
+    # 带了 Authorization: Token 请求头的请求不需要查 session， 其他的请求依然使用 session 登录
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'accounts.api.authentication.SignedTokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
 }
+# login / signup 返回的 token 的有效时间（秒）
+AUTH_TOKEN_MAX_AGE = 86400
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -95,7 +109,27 @@ WSGI_APPLICATION = 'twitter.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
-
+# MySQL 的配置在 localsettings 中 overwrite， 没有 localsettings 的时候使用多个 sqlite 数据库来模拟分库
+# 单元测试不依赖 MySQL， 始终跑在 sqlite 上（见文件末尾）
+# NewsFeed 按照 user_id 分布在 NEWSFEED_DATABASES 这几个库上， 其他的表都在 default 上
+# 分库的表需要单独 migrate: python manage.py migrate --database=newsfeeds_0
+SQLITE_DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+    },
+    'newsfeeds_0': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'newsfeeds_0.sqlite3',
+    },
+    'newsfeeds_1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'newsfeeds_1.sqlite3',
+    },
+}
+DATABASES = SQLITE_DATABASES
+NEWSFEED_DATABASES = ['newsfeeds_0', 'newsfeeds_1']
+DATABASE_ROUTERS = ['newsfeeds.routers.NewsFeedRouter']
 
 
 
@@ -138,8 +172,130 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# 线上使用 redis 作为 cache， 单元测试的时候使用进程内的 locmem 代替
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'TIMEOUT': 86400,
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+}
+if TESTING:
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'twitter-testing',
+        'TIMEOUT': 86400,
+    }
+
+# 每个用户的 newsfeed 在 cache 中最多保存多少条
+NEWSFEED_CACHE_LIMIT = 200
+# ListCacheHelper.push_entries 修改每个列表时加的锁的过期时间， 只需要覆盖一次读改写
+LIST_CACHE_LOCK_TIMEOUT = 5
+# ObjectCacheHelper 中 model instance 是 pickle 之后存的
+# model 的 fields 发生变化之后 +1， 旧版本的 cache 会被直接忽略， 不会被错误地 unpickle
+OBJECT_CACHE_VERSION = 2
+# 抽样统计 ObjectCacheHelper 的命中率（TweetService.get_cache_stats）， 0.01 表示记录 1% 的读取
+# 每次记录都会多两次 cache 的 round trip， 默认关闭
+OBJECT_CACHE_STATS_SAMPLE_RATE = 0
+
+
+# Celery Configuration Options
+# 启动 worker: celery -A twitter worker -l INFO
+# 单元测试的时候 task 会在当前进程中同步执行， 不需要启动 worker
+CELERY_BROKER_URL = 'redis://127.0.0.1:6379/2'
+CELERY_TIMEZONE = 'UTC'
+CELERY_TASK_ALWAYS_EAGER = TESTING
+CELERY_TASK_EAGER_PROPAGATES = TESTING
+# 定时任务， 需要另外启动 beat: celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    'fold-like-counters': {
+        'task': 'likes.tasks.fold_like_counters_task',
+        'schedule': 60,
+    },
+}
+
+# fanout 的时候每个 batch task 负责多少个 follower
+NEWSFEED_FANOUT_BATCH_SIZE = 1000
+# 每条 INSERT 语句最多写入多少条 newsfeed
+NEWSFEED_BULK_CREATE_BATCH_SIZE = 500
+# 关注之后从对方最近的 tweets 中补多少条到 inbox 中
+NEWSFEED_BACKFILL_LIMIT = 20
+# 取关之后按 batch 删除 inbox 中对方的 tweets， 每个 batch 的大小
+NEWSFEED_DELETE_BATCH_SIZE = 500
+# inbox 的保留策略， 由 python manage.py compact_newsfeeds 定期执行
+# 每个用户最多保留多少条 newsfeed
+NEWSFEED_MAX_ROWS_PER_USER = 1000
+# 超过多少天的 newsfeed 会被删除
+NEWSFEED_RETENTION_DAYS = 90
+
+# follower 数量超过这个值的用户（明星用户）发帖时不做 fanout（push）
+# 而是在 follower 读取 newsfeed 的时候再去拉取（pull）
+NEWSFEED_CELEBRITY_THRESHOLD = 10000
+# 是否为明星用户的标记在 cache 中保存的时间
+CELEBRITY_FLAG_CACHE_TIMEOUT = 3600
+# 每个用户关注的明星用户在 cache 中保存的时间， 关注的人变成明星用户之后最多这么多秒才会开始拉取
+CELEBRITY_FOLLOWINGS_CACHE_TIMEOUT = 60
+# 每个用户最近的 tweets 在 cache 中最多保存多少条
+USER_TWEETS_CACHE_LIMIT = 50
+
+# 批量关注每次最多可以关注多少人
+FRIENDSHIP_BULK_FOLLOW_LIMIT = 500
+# follow / unfollow 之后修改 cache 中 following ids 的锁的过期时间， 只需要覆盖一次读改写
+FOLLOWING_CACHE_LOCK_TIMEOUT = 5
+
+# 离线计算 "可能认识的人"， 由 python manage.py compute_recommendations 定期执行
+# 每个用户最多保存多少个推荐， 比 api 返回的多一些， 这样用户关注了其中的一些人之后还有足够的推荐可以显示
+FRIENDSHIP_RECOMMENDATIONS_STORED = 100
+# api 每次最多返回多少个推荐
+FRIENDSHIP_RECOMMENDATIONS_LIMIT = 20
+# 每次从数据库中读多少条 Friendship
+FRIENDSHIP_RECOMMENDATIONS_EDGE_CHUNK_SIZE = 100000
+# 每次为多少个用户计算推荐， 决定了计算过程中稀疏矩阵乘法的内存占用
+FRIENDSHIP_RECOMMENDATIONS_BLOCK_SIZE = 1000
+
+# tweet 详情页中显示最新的多少条评论
+COMMENTS_PREVIEW_SIZE = 10
+# tweet 详情页中每个 tweet / comment 显示最新的多少个点赞， 也是每个 object 的点赞列表在 cache 中保存的长度
+LIKES_PREVIEW_SIZE = 10
+
+# 每个 tweet / comment 的点赞数分成多少个分片计数
+LIKE_COUNTER_SHARDS = 16
+# 分片中还没有合并的点赞数在 cache 中保存的时间， 点赞数最多会有这么多秒的延迟
+PENDING_LIKES_COUNT_CACHE_TIMEOUT = 5
+# 合并分片的时候每次扫描多少个分片
+LIKE_COUNTER_FOLD_BATCH_SIZE = 1000
+# 合并之后过多少秒再删一次这些 object 的 cache， 需要比一次 cache miss 读数据库再写回 cache 的时间长
+LIKE_COUNTER_FOLD_REINVALIDATE_DELAY = 10
+# 点赞 / 取消点赞先写进 cache 中的队列， 再由 flush_like_buffer_task 批量写入数据库
+# 流量高峰的时候打开， 可以避免大量单行的 INSERT / DELETE， flush 的定时任务在本文件的最后注册
+LIKE_WRITE_BEHIND = False
+# 每次 flush 最多处理多少个事件
+LIKE_BUFFER_FLUSH_BATCH_SIZE = 1000
+# flush 的锁的过期时间， 不能比 flush_like_buffer_task 的 time_limit 短， 否则一次 flush 还没结束另一次就开始了
+LIKE_BUFFER_LOCK_TIMEOUT = 60 * 60
+# 还没有 flush 的点赞对点赞的人自己可见的时间， 正常情况下 flush 之后就会被删掉
+LIKE_OVERLAY_TIMEOUT = 3600
+
 # 此处是为了防止在production中由于找不到本地localsettings文件导致整个程序挂掉
 try:
     from .localsettings import *
 except:
     pass
+
+# localsettings 中的 DATABASES 是 MySQL， 单元测试还是用 sqlite 的分库
+if TESTING:
+    DATABASES = SQLITE_DATABASES
+
+# LIKE_WRITE_BEHIND 可能在 localsettings 中被打开， 所以 flush 的定时任务在这之后才注册
+# 关闭 LIKE_WRITE_BEHIND 之前要等队列中的事件都 flush 完
+if LIKE_WRITE_BEHIND:
+    CELERY_BEAT_SCHEDULE['flush-like-buffer'] = {
+        'task': 'likes.tasks.flush_like_buffer_task',
+        'schedule': 2,
+    }
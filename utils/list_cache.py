@@ -0,0 +1,135 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from twitter.cache import LIST_CACHE_GENERATION_PATTERN, LIST_CACHE_LOCK_PATTERN
+
+
+class ListCacheHelper(object):
+    """
+    在 cache 中为每个 key 维护一个长度有上限的列表， 列表按照 ordering（默认是 (created_at, id)）倒序排列
+    列表中的每个元素是一个 tuple， 和 fields 一一对应， 约定第一项是 id
+    只存 id 这类轻量的数据而不存整个 model instance， 这样 cache 占用的空间可控
+
+    cache 没有 compare-and-set， 这里用两样东西保证并发的时候 cache 中不会留下旧数据:
+    - generation: 每次写入（push / invalidate）之前都先换成一个新的随机值
+      从数据库中重建的读请求在 query 之前记下 generation， 写回之后再检查一次， 变了就说明 query 的结果可能是旧的， 删掉
+      写回用的是 cache.add， 不会覆盖已经存在的列表
+    - lock: push 是 get -> merge -> set， 每个 key 用 cache.add 加一个短暂的锁， 并发的 push 不会互相覆盖
+      拿不到锁的 key 直接删掉， 下一次读的时候重建
+    push 和 invalidate 都需要在数据库的写入提交之后调用
+    """
+
+    @classmethod
+    def get_generation_key(cls, key):
+        return LIST_CACHE_GENERATION_PATTERN.format(key=key)
+
+    @classmethod
+    def get_lock_key(cls, key):
+        return LIST_CACHE_LOCK_PATTERN.format(key=key)
+
+    @classmethod
+    def load_entries(cls, key, queryset, fields, limit, ordering=('-created_at', '-id')):
+        entries = cache.get(key)
+        if entries is not None:
+            return entries
+
+        # cache miss 的时候从数据库中 lazy 地重建
+        # queryset 需要调用方保证能走到 (xxx, created_at) 的联合索引
+        generation = cache.get(cls.get_generation_key(key))
+        queryset = queryset.order_by(*ordering)
+        entries = list(queryset.values_list(*fields)[:limit])
+        cls._write_back(key, entries, generation)
+        return entries
+
+    @classmethod
+    def load_many_entries(cls, keys, load_from_db):
+        """
+        批量版的 load_entries， 返回 {key: entries}
+        一次 cache 的 multi-get， miss 的 keys 交给 load_from_db(missing_keys) 一起从数据库中读出来， 返回 {key: entries}
+        load_from_db 需要保证每个 key 的 entries 按照 ordering 排好序并且不超过 limit 条
+        """
+        entries = cache.get_many(keys)
+        missing_keys = [key for key in keys if key not in entries]
+        if not missing_keys:
+            return entries
+
+        generations = cache.get_many([cls.get_generation_key(key) for key in missing_keys])
+        db_entries = load_from_db(missing_keys)
+        for key in missing_keys:
+            cls._write_back(key, db_entries[key], generations.get(cls.get_generation_key(key)))
+        entries.update(db_entries)
+        return entries
+
+    @classmethod
+    def _write_back(cls, key, entries, generation):
+        # generation 是 query 之前读到的， query 期间有新的写入的话这里的结果可能不包含它， 写回之后马上删掉
+        if cache.add(key, entries) and cache.get(cls.get_generation_key(key)) != generation:
+            cache.delete(key)
+
+    @classmethod
+    def push_entries(cls, key_to_entry, fields, limit, ordering=('-created_at', '-id')):
+        """
+        把新的数据插入到已经在 cache 中的列表里， 去重、排序之后只保留最新的 limit 条
+        不在 cache 中的 key 不会被创建， 下一次读的时候从数据库中重建
+        一个 fanout batch 中的所有 key 只需要几次 multi-get / multi-set， 每个 key 只多一次加锁
+        """
+        if not key_to_entry:
+            return
+        token = uuid.uuid4().hex
+        cache.set_many({cls.get_generation_key(key): token for key in key_to_entry})
+
+        cached_keys = cache.get_many(list(key_to_entry)).keys()
+        locked_keys, busy_keys = [], []
+        for key in cached_keys:
+            if cache.add(cls.get_lock_key(key), token, settings.LIST_CACHE_LOCK_TIMEOUT):
+                locked_keys.append(key)
+            else:
+                busy_keys.append(key)
+        cache.delete_many(busy_keys)
+        if not locked_keys:
+            return
+
+        try:
+            # 拿到锁之后重新读一次， 之前读到的列表可能已经被别的 push 改过了
+            cached_lists = cache.get_many(locked_keys)
+            cache.set_many({
+                key: cls._merge(entries, key_to_entry[key], fields, limit, ordering)
+                for key, entries in cached_lists.items()
+            })
+            # 没有拿锁的 invalidate 在这之间换掉了 generation， 刚写进去的列表可能是旧的
+            generations = cache.get_many([
+                cls.get_generation_key(key) for key in cached_lists
+            ])
+            cache.delete_many([
+                key for key in cached_lists
+                if generations.get(cls.get_generation_key(key)) != token
+            ])
+        finally:
+            lock_keys = [cls.get_lock_key(key) for key in locked_keys]
+            locks = cache.get_many(lock_keys)
+            cache.delete_many([
+                lock_key for lock_key in lock_keys
+                if locks.get(lock_key) == token
+            ])
+
+    @classmethod
+    def _merge(cls, entries, new_entry, fields, limit, ordering):
+        # 同一条数据可能已经被重建的读请求从数据库中读到了， 按 id 去重
+        entries = [entry for entry in entries if entry[0] != new_entry[0]]
+        entries.append(new_entry)
+        indexes = [fields.index(field.lstrip('-')) for field in ordering]
+        entries.sort(key=lambda entry: [entry[index] for index in indexes], reverse=True)
+        return entries[:limit]
+
+    @classmethod
+    def invalidate(cls, key):
+        cls.invalidate_many([key])
+
+    @classmethod
+    def invalidate_many(cls, keys):
+        # 先换掉 generation 再删， 正在重建的读请求不会再把旧数据写回来
+        # 一共两次 round trip， 和 key 的数量无关
+        token = uuid.uuid4().hex
+        cache.set_many({cls.get_generation_key(key): token for key in keys})
+        cache.delete_many(keys)
@@ -0,0 +1,6 @@
+from utils.object_cache import ObjectCacheHelper
+
+
+def invalidate_object_cache(sender, instance, **kwargs):
+    # 数据被修改或者删除之后， 让 cache 中的旧数据失效， 下次读的时候会从数据库中重新加载
+    ObjectCacheHelper.invalidate_cached_object(sender, instance.id)
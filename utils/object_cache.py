@@ -0,0 +1,115 @@
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from twitter.cache import (
+    OBJECT_CACHE_HITS_PATTERN,
+    OBJECT_CACHE_MISSES_PATTERN,
+    OBJECT_PATTERN,
+)
+
+
+class ObjectCacheHelper(object):
+    """
+    以 model_class + version + id 为 key， 把 model instance 整个存在 cache 中
+    批量读取的时候只需要一次 get_many， miss 的部分再用一次 id__in 的 query 从数据库中补上
+    """
+
+    @classmethod
+    def get_key(cls, model_class, object_id):
+        return OBJECT_PATTERN.format(
+            model=model_class.__name__,
+            version=settings.OBJECT_CACHE_VERSION,
+            object_id=object_id,
+        )
+
+    @classmethod
+    def _normalize_ids(cls, model_class, object_ids):
+        # url 中传进来的 id 是字符串， 统一转成和数据库中一致的类型， 非法的 id 直接忽略
+        normalized_ids = set()
+        for object_id in object_ids:
+            if object_id is None:
+                continue
+            try:
+                normalized_ids.add(model_class._meta.pk.to_python(object_id))
+            except ValidationError:
+                continue
+        return normalized_ids
+
+    @classmethod
+    def get_objects(cls, model_class, object_ids):
+        # 返回 {id: instance}， 数据库中也不存在的 id 不会出现在返回值中
+        object_ids = cls._normalize_ids(model_class, object_ids)
+        if not object_ids:
+            return {}
+
+        keys = {cls.get_key(model_class, object_id): object_id for object_id in object_ids}
+        cached_objects = cache.get_many(keys.keys())
+        objects = {keys[key]: obj for key, obj in cached_objects.items()}
+
+        missing_ids = object_ids - set(objects.keys())
+        if missing_ids:
+            # order_by() 去掉 model 默认的排序， 按 id 取数据不需要排序
+            # 用 pk 而不是 id， 主键不叫 id 的 model （比如 UserProfile） 也可以使用
+            db_objects = {
+                obj.pk: obj
+                for obj in model_class.objects.filter(pk__in=missing_ids).order_by()
+            }
+            cache.set_many({
+                cls.get_key(model_class, object_id): obj
+                for object_id, obj in db_objects.items()
+            })
+            objects.update(db_objects)
+
+        cls._record_stats(model_class, len(cached_objects), len(missing_ids))
+        return objects
+
+    @classmethod
+    def get_object(cls, model_class, object_id):
+        object_ids = cls._normalize_ids(model_class, [object_id])
+        if not object_ids:
+            return None
+        return cls.get_objects(model_class, object_ids).get(object_ids.pop())
+
+    @classmethod
+    def invalidate_cached_object(cls, model_class, object_id):
+        cache.delete(cls.get_key(model_class, object_id))
+
+    @classmethod
+    def _record_stats(cls, model_class, hits, misses):
+        """
+        每次记录都要多两次 cache.incr 的 round trip， 所以只按照 OBJECT_CACHE_STATS_SAMPLE_RATE 抽样记录
+        hits 和 misses 是同一批样本， 算出来的命中率不受采样的影响， 默认为 0 即不统计
+        """
+        sample_rate = settings.OBJECT_CACHE_STATS_SAMPLE_RATE
+        if not sample_rate or random.random() >= sample_rate:
+            return
+        cls._incr_stat(OBJECT_CACHE_HITS_PATTERN, model_class, hits)
+        cls._incr_stat(OBJECT_CACHE_MISSES_PATTERN, model_class, misses)
+
+    @classmethod
+    def _incr_stat(cls, pattern, model_class, delta):
+        if not delta:
+            return
+        key = pattern.format(model=model_class.__name__)
+        # 计数器存在 cache 中， 所有的 web server 共享同一份统计数据
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # key 不存在的时候 incr 会报错， 第一次需要先创建
+            if not cache.add(key, delta, timeout=None):
+                cache.incr(key, delta)
+
+    @classmethod
+    def get_stats(cls, model_class):
+        hits_key = OBJECT_CACHE_HITS_PATTERN.format(model=model_class.__name__)
+        misses_key = OBJECT_CACHE_MISSES_PATTERN.format(model=model_class.__name__)
+        stats = cache.get_many([hits_key, misses_key])
+        hits, misses = stats.get(hits_key, 0), stats.get(misses_key, 0)
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0,
+        }
@@ -0,0 +1,129 @@
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+
+
+class EndlessPagination(BasePagination):
+    """
+    基于 created_at 的无限下拉翻页（keyset pagination）
+    - created_at__lt: 向下翻页， 取比该时间更早的一页内容
+    - created_at__gt: 下拉刷新， 取比该时间更新的内容
+    两者都不带的时候返回最新的一页
+    排序按照 (created_at, id) 倒序， id 用来保证 created_at 相同的时候顺序是稳定的
+    向下翻页的时候可以再带上 id__lt（上一页最后一条的 id）， 游标就变成了 (created_at, id)，
+    created_at 相同的多条数据被切在两页之间的时候也不会被跳过
+    不会像 PageNumberPagination 那样执行 COUNT(*)， 而是多取一条数据来判断是否还有下一页
+    游标中的 id 默认比较的是 obj.id， 调用方可以通过 id_field 换成别的字段
+    """
+    page_size = 20
+    # 游标中 id 的那一部分对应的请求参数
+    cursor_id_param = 'id__lt'
+
+    def __init__(self):
+        super().__init__()
+        self.has_next_page = False
+
+    def to_html(self):
+        pass
+
+    def get_created_at(self, request, param):
+        # 格式正确但是不存在的时间（比如 2020-13-01T00:00:00）parse_datetime 会抛出 ValueError
+        try:
+            created_at = parse_datetime(request.query_params[param])
+        except ValueError:
+            created_at = None
+        if created_at is None:
+            raise ValidationError({
+                'message': '{} is not a valid datetime'.format(param),
+            })
+        # 没有带时区的时间按照当前时区处理， 否则和 cache 中带时区的 created_at 比较会抛出 TypeError
+        if timezone.is_naive(created_at):
+            created_at = timezone.make_aware(created_at)
+        return created_at
+
+    def get_id(self, request, param):
+        try:
+            return int(request.query_params[param])
+        except ValueError:
+            raise ValidationError({
+                'message': '{} is not a valid id'.format(param),
+            })
+
+    def get_cursor(self, request):
+        # 向下翻页的游标 (created_at, id)， 没有带 cursor_id_param 的时候 id 为 None
+        if 'created_at__lt' not in request.query_params:
+            return None, None
+        created_at__lt = self.get_created_at(request, 'created_at__lt')
+        if self.cursor_id_param not in request.query_params:
+            return created_at__lt, None
+        return created_at__lt, self.get_id(request, self.cursor_id_param)
+
+    def paginate_queryset(self, queryset, request, view=None, id_field='id'):
+        if 'created_at__gt' in request.query_params:
+            created_at__gt = self.get_created_at(request, 'created_at__gt')
+            queryset = queryset.filter(created_at__gt=created_at__gt)
+        created_at__lt, id__lt = self.get_cursor(request)
+        if created_at__lt is not None:
+            condition = Q(created_at__lt=created_at__lt)
+            if id__lt is not None:
+                # 可以走 (user, created_at) 的联合索引， 主键 id 本身就在二级索引里
+                condition |= Q(created_at=created_at__lt, **{id_field + '__lt': id__lt})
+            queryset = queryset.filter(condition)
+
+        # 多取一条用来判断是否还有下一页， 而不是去 COUNT(*)
+        queryset = queryset.order_by('-created_at', '-' + id_field)
+        objects = list(queryset[:self.page_size + 1])
+        self.has_next_page = len(objects) > self.page_size
+        return objects[:self.page_size]
+
+    def paginate_ordered_list(self, reverse_ordered_list, request, id_field='id'):
+        # 对一个已经按照 (created_at, id_field) 倒序排好的 list 在内存中做同样的翻页
+        objects = reverse_ordered_list
+        if 'created_at__gt' in request.query_params:
+            created_at__gt = self.get_created_at(request, 'created_at__gt')
+            objects = [obj for obj in objects if obj.created_at > created_at__gt]
+        created_at__lt, id__lt = self.get_cursor(request)
+        if created_at__lt is not None:
+            objects = [
+                obj for obj in objects
+                if self.is_before_cursor(obj, created_at__lt, id__lt, id_field)
+            ]
+
+        objects = objects[:self.page_size + 1]
+        self.has_next_page = len(objects) > self.page_size
+        return objects[:self.page_size]
+
+    def is_before_cursor(self, obj, created_at__lt, id__lt, id_field='id'):
+        if obj.created_at < created_at__lt:
+            return True
+        return id__lt is not None and obj.created_at == created_at__lt \
+            and getattr(obj, id_field) < id__lt
+
+    def paginate_cached_list(self, cached_list, request, limit, id_field='id'):
+        """
+        cache 中只保存了最新的 limit 条数据
+        如果这一页能完全从 cache 中得到就直接返回， 否则返回 None， 由调用方去查数据库
+        """
+        page = self.paginate_ordered_list(cached_list, request, id_field)
+        # 多取的那一条也在 cache 里， 说明这一页是完整的
+        if self.has_next_page:
+            return page
+        # cache 中的数据没有被截断过， 说明 cache 里就是全部的数据
+        if len(cached_list) < limit:
+            return page
+        # 下拉刷新取的是最新的数据， 一定都在 cache 中
+        if 'created_at__gt' in request.query_params \
+                and 'created_at__lt' not in request.query_params:
+            return page
+        return None
+
+
+class NewsFeedPagination(EndlessPagination):
+    """
+    newsfeed 的一页是 inbox 中的 newsfeeds 和从明星用户那里拉取的 tweets 归并出来的
+    拉取的那些没有 newsfeed id， 所以游标用 (created_at, tweet_id)， 两个来源都可以比较
+    inbox 中 newsfeed 的 created_at 就是 tweet 的 created_at， (user, tweet) 又是唯一的， 顺序是确定的
+    """
+    cursor_id_param = 'tweet_id__lt'
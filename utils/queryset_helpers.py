@@ -0,0 +1,41 @@
+from django.db import connection
+from django.db.models import Q
+
+
+def evaluate_sliced_querysets(querysets):
+    """
+    querysets 是若干个各自 order_by + 切片过的 values_list， 返回所有结果拼在一起的 list
+    每个 queryset 各自走自己的联合索引， 只读切片的那几条
+    数据库支持的时候（MySQL）用 UNION ALL 合成一次 round trip， 否则（sqlite）每个 queryset 一次 query
+    """
+    if not querysets:
+        return []
+    if len(querysets) > 1 and connection.features.supports_slicing_ordering_in_compound:
+        return list(querysets[0].union(*querysets[1:], all=True))
+    return [row for queryset in querysets for row in queryset]
+
+
+def iterate_by_created_at(queryset, chunk_size, fields=()):
+    """
+    沿着 (xxx, created_at) 的联合索引， 按照 (created_at, id) 正序做 keyset 翻页
+    每次只查 chunk_size 条， 逐批 yield 出 (id, created_at, *fields) 组成的 values_list
+    没有直接用 .iterator()， 因为 MySQL 的 driver 依然会把整个结果集读到内存里
+    """
+    last_created_at, last_id = None, None
+    while True:
+        chunk_queryset = queryset
+        if last_created_at is not None:
+            # created_at 可能相同， 用 id 来保证不重复也不遗漏
+            chunk_queryset = chunk_queryset.filter(
+                Q(created_at__gt=last_created_at) |
+                Q(created_at=last_created_at, id__gt=last_id)
+            )
+        rows = list(chunk_queryset.order_by('created_at', 'id').values_list(
+            'id', 'created_at', *fields,
+        )[:chunk_size])
+        if not rows:
+            return
+        last_id, last_created_at = rows[-1][0], rows[-1][1]
+        yield rows
+        if len(rows) < chunk_size:
+            return